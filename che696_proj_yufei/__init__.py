@@ -9,6 +9,7 @@ from __future__ import absolute_import
 
 # Add imports here
 from .image_proc import *
+from .analyser import PivAnalyser
 
 # Handle versioneer
 from ._version import get_versions
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+aio.py
+asyncio interface to the PIV analysis
+
+Decoding and correlation run in executors, so an event loop (e.g. an acquisition
+controller) stays responsive while pairs are analysed. Pass a ThreadPoolExecutor or a
+ProcessPoolExecutor for either stage, or None for the loop's default executor; a shared
+asyncio.Semaphore limits how many pairs are analysed at once. Cancelling a coroutine
+returns at once; work already running in an executor finishes there and is discarded.
+"""
+
+import asyncio
+import functools
+from collections import deque
+from .image_proc import load_image, analyse_images, SUCCESS, IO_ERROR, INVALID_DATA, DEF_PRECISION
+from .correlation import check_prefilter, DEF_BACKEND, DEF_MODE
+
+DEF_MAX_IN_FLIGHT = 4
+
+
+def decode_frame(image_path):
+    """
+    Image of image_path as a 2D Numpy array; raises the OSError of an unreadable file
+    """
+    image, ret = load_image(image_path)
+    if ret != SUCCESS:
+        raise ret
+    return image
+
+
+async def _limited(semaphore, coroutine):
+    if semaphore is None:
+        return await coroutine
+    async with semaphore:
+        return await coroutine
+
+
+async def piv_analysis_async(image_a_path, image_b_path, division_pixel, backend=DEF_BACKEND,
+                             precision=DEF_PRECISION, decode_executor=None, correlate_executor=None,
+                             semaphore=None, mode=DEF_MODE, prefilter=None):
+    """
+    Coroutine version of piv_analysis
+
+    Parameters
+    ----------
+    image_a_path : path of image 1
+    image_b_path : path of image 2
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    backend : correlation backend passed on to x_corr
+    precision : 'double' or 'single'
+    decode_executor : executor that reads the two images (concurrently); None for the loop's default
+    correlate_executor : executor that stripes and correlates them; None for the loop's default
+    semaphore : optional asyncio.Semaphore held while the pair is analysed
+    mode : correlation mode, see x_corr
+    prefilter : optional PreFilter of the stripes, see x_corr
+
+    Returns
+    -------
+    piv_result : displacement profile (column 2) versus y position (column 1), or IO_ERROR
+                 or INVALID_DATA as returned by piv_analysis
+    """
+    check_prefilter(mode, prefilter)
+    analyse = functools.partial(analyse_images, backend=backend, precision=precision, mode=mode, prefilter=prefilter)
+    return await _limited(semaphore, _analyse_pair(image_a_path, image_b_path, division_pixel, analyse,
+                                                   decode_executor, correlate_executor))
+
+
+async def _analyse_pair(image_a_path, image_b_path, division_pixel, analyse, decode_executor, correlate_executor):
+    loop = asyncio.get_running_loop()
+    (image_a, ret_a), (image_b, ret_b) = await asyncio.gather(
+        loop.run_in_executor(decode_executor, load_image, image_a_path),
+        loop.run_in_executor(decode_executor, load_image, image_b_path))
+    if (ret_a != SUCCESS) or (ret_b != SUCCESS):
+        return IO_ERROR
+    return await loop.run_in_executor(correlate_executor, analyse, image_a, image_b, division_pixel)
+
+
+class AsyncPairIterator(object):
+    """
+    Asynchronous iterator over the pairs of consecutive frames of a sequence
+
+    Yields (image_a_path, image_b_path, piv_results) in pair order while up to
+    max_in_flight pairs are decoded and correlated concurrently. Every frame is decoded
+    once for both of its pairs. An unreadable frame raises its OSError, as in iter_frames,
+    and frames of different sizes raise ValueError; either cancels the pairs still in
+    flight, as do aclose() and leaving ``async with``.
+
+        async with AsyncPairIterator(paths, 5) as pairs:
+            async for image_a_path, image_b_path, piv_results in pairs:
+                ...
+
+    Parameters
+    ----------
+    image_paths : paths of the frames in time order
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    backend : correlation backend passed on to x_corr
+    precision : 'double' or 'single'
+    max_in_flight : most pairs analysed at the same time by this iterator
+    decode_executor : executor that reads the frames; None for the loop's default
+    correlate_executor : executor that stripes and correlates them; None for the loop's default
+    semaphore : optional asyncio.Semaphore, e.g. shared with other work, held while a pair is analysed
+    mode : correlation mode, see x_corr
+    prefilter : optional PreFilter of the stripes, see x_corr
+    """
+
+    def __init__(self, image_paths, division_pixel, backend=DEF_BACKEND, precision=DEF_PRECISION,
+                 max_in_flight=DEF_MAX_IN_FLIGHT, decode_executor=None, correlate_executor=None, semaphore=None,
+                 mode=DEF_MODE, prefilter=None):
+        check_prefilter(mode, prefilter)
+        self.image_paths = list(image_paths)
+        self.division_pixel = division_pixel
+        self.backend = backend
+        self.precision = precision
+        self.mode = mode
+        self.prefilter = prefilter
+        self.max_in_flight = max_in_flight
+        self.decode_executor = decode_executor
+        self.correlate_executor = correlate_executor
+        self.semaphore = semaphore
+        self._next_pair = 0
+        self._next_frame = None
+        self._in_flight = deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def _decode(self, index):
+        loop = asyncio.get_running_loop()
+        return asyncio.ensure_future(loop.run_in_executor(self.decode_executor, decode_frame,
+                                                          self.image_paths[index]))
+
+    async def _pair(self, frame_a, frame_b):
+        image_a, image_b = await asyncio.gather(asyncio.shield(frame_a), asyncio.shield(frame_b))
+        loop = asyncio.get_running_loop()
+        analyse = functools.partial(analyse_images, backend=self.backend, precision=self.precision, mode=self.mode,
+                                    prefilter=self.prefilter)
+        piv_results = await loop.run_in_executor(self.correlate_executor, analyse, image_a, image_b,
+                                                 self.division_pixel)
+        if isinstance(piv_results, int) and piv_results == INVALID_DATA:
+            raise ValueError('Frames of a sequence have different sizes')
+        return piv_results
+
+    def _fill(self):
+        # frame i + 1 is decoded once, for pair i and pair i + 1
+        while len(self._in_flight) < self.max_in_flight and self._next_pair < len(self.image_paths) - 1:
+            pair = self._next_pair
+            frame_a = self._next_frame if self._next_frame is not None else self._decode(pair)
+            self._next_frame = self._decode(pair + 1)
+            task = asyncio.ensure_future(_limited(self.semaphore, self._pair(frame_a, self._next_frame)))
+            self._in_flight.append((pair, task))
+            self._next_pair += 1
+
+    async def __anext__(self):
+        self._fill()
+        if not self._in_flight:
+            raise StopAsyncIteration
+        pair, task = self._in_flight.popleft()
+        try:
+            piv_results = await task
+        except BaseException:
+            await self.aclose()
+            raise
+        self._fill()
+        return self.image_paths[pair], self.image_paths[pair + 1], piv_results
+
+    async def aclose(self):
+        """
+        Cancel the pairs in flight and stop the iteration
+        """
+        tasks = [task for pair, task in self._in_flight]
+        self._in_flight.clear()
+        self._next_pair = len(self.image_paths)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
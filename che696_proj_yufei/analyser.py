@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+analyser.py
+Reusable PIV analyser for a fixed frame shape
+
+For live monitoring every image pair has the same shape and parameters, so the stripe
+layout, FFT length and all work buffers are set up once. After that, analyse() works
+entirely in the preallocated buffers and creates no new arrays.
+"""
+
+import inspect
+import numpy as np
+from .correlation import fft_length, whiten, zncc_max_lag, check_prefilter, ZnccNormaliser, DEF_MODE
+from .image_proc import stripe_bounds, PRECISIONS, DEF_PRECISION
+from .background import RollingWindow
+
+# numpy >= 2.0 can write FFT results into an existing array
+_FFT_HAS_OUT = 'out' in inspect.signature(np.fft.rfft).parameters
+
+
+class PivAnalyser(object):
+    """
+    Stripe-averaged cross-correlation of frame pairs with a fixed shape
+
+    Gives the same results as piv_analysis on the same frames.
+
+    Parameters
+    ----------
+    frame_shape : (height, width) of the frames
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    precision : 'double' or 'single' floating point type of the work buffers
+    max_lag : optional largest displacement (pixels) to search for
+    mode : 'cross', 'phase' or 'zncc' correlation, as for x_corr
+    prefilter : optional PreFilter of the stripes, as for x_corr
+    background : optional Background of a sequence; every frame of the sequence is then
+                 given to push_background, and analyse subtracts the background of the
+                 frames pushed so far from both frames of a pair
+    """
+
+    def __init__(self, frame_shape, division_pixel, precision=DEF_PRECISION, max_lag=None, mode=DEF_MODE,
+                 prefilter=None, background=None):
+        check_prefilter(mode, prefilter)
+        height, width = frame_shape
+        self.frame_shape = (height, width)
+        self.division_pixel = division_pixel
+        self.dtype = np.dtype(PRECISIONS[precision])
+
+        # same stripe boundaries as divid_image; the last image row is never used
+        index_divid = stripe_bounds(height, division_pixel)
+        self.stripe_starts = index_divid[:-1]
+        self.n_stripes = self.stripe_starts.size
+        self.y_position = (index_divid[:-1] + index_divid[1:]) / 2.0
+        self.rows_per_stripe = np.diff(index_divid).astype(self.dtype)[:, np.newaxis]
+
+        self.nsamples = width
+        self.nfft = fft_length(width)
+        if max_lag is None or max_lag > width - 1:
+            max_lag = width - 1
+        if mode == 'zncc':
+            max_lag = min(max_lag, zncc_max_lag(width))
+        self.max_lag = max_lag
+        self.mode = mode
+
+        # frame converted to the working type, then stripe profiles and per-stripe statistics;
+        # per-stripe values are spread over a full-size scratch array because broadcasting
+        # ufuncs and ufuncs on strided views allocate temporary iteration buffers
+        self._frame = np.empty((height - 1, width), dtype=self.dtype)
+        self._stripes = np.empty((self.n_stripes, width), dtype=self.dtype)
+        self._scratch = np.empty((self.n_stripes, width), dtype=self.dtype)
+        self._row_stats = np.empty((self.n_stripes, 1), dtype=self.dtype)
+        # stripes of both frames, zero padded to the FFT length
+        self._padded = np.zeros((2, self.n_stripes, self.nfft), dtype=self.dtype)
+        complex_dtype = np.result_type(self.dtype, np.complex64)
+        self._spectra = np.empty((2, self.n_stripes, self.nfft // 2 + 1), dtype=complex_dtype)
+        self._circular = np.empty((self.n_stripes, self.nfft), dtype=self.dtype)
+        self._xcorr = np.empty((self.n_stripes, 2 * width - 1), dtype=self.dtype)
+        self._peak = np.empty(self.n_stripes, dtype=np.intp)
+        if mode == 'phase':
+            self._magnitude = np.empty((self.n_stripes, self.nfft // 2 + 1), dtype=self.dtype)
+            self._floor = np.empty_like(self._magnitude)
+        elif mode == 'zncc':
+            self._normaliser = ZnccNormaliser(self.n_stripes, width, self.dtype)
+        # taper and spectral gain, one row per stripe like the per-stripe statistics
+        self._window = self._gain = None
+        if prefilter is not None:
+            window = prefilter.window(width, self.dtype)
+            if window is not None:
+                self._window = np.tile(window, (self.n_stripes, 1))
+            gain = prefilter.gain(self.nfft, self.dtype)
+            if gain is not None:
+                self._gain = np.tile(gain, (self.n_stripes, 1))
+        # rolling background of the rows that are used, or of the raw stripe profiles
+        self.background = self.background_level = None
+        if background is not None:
+            shape = self._frame.shape if background.level == 'frame' else self._stripes.shape
+            self.background = RollingWindow(shape, background.window, background.method, self.dtype)
+            self.background_level = background.level
+        self.results = np.empty((self.n_stripes, 2))
+        self.results[:, 0] = self.y_position
+
+    def _profiles(self, frame, subtract):
+        # raw stripe profiles in self._stripes, less the background if subtract
+        stripes = self._stripes
+        np.copyto(self._frame, frame[:self.frame_shape[0] - 1], casting='unsafe')
+        if subtract and self.background_level == 'frame':
+            self._frame -= self.background.value
+        np.add.reduceat(self._frame, self.stripe_starts, axis=0, out=stripes)
+        np.copyto(self._scratch, self.rows_per_stripe)
+        stripes /= self._scratch
+        if subtract and self.background_level == 'stripe':
+            stripes -= self.background.value
+
+    def push_background(self, frame):
+        """
+        Add the next frame of the sequence to the rolling background
+
+        :param frame: 2D array with the frame shape; frames are pushed in time order, each once
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError("Expected a frame of shape {}, got {}".format(self.frame_shape, frame.shape))
+        if self.background_level == 'frame':
+            self.background.push(frame[:self.frame_shape[0] - 1])
+        else:
+            self._profiles(frame, False)
+            self.background.push(self._stripes)
+
+    def _divid(self, frame, k):
+        # stripe means in one pass, then the same normalization as divid_image
+        stripes = self._stripes
+        scratch = self._scratch
+        stats = self._row_stats
+        self._profiles(frame, self.background is not None)
+        np.add.reduce(stripes, axis=1, keepdims=True, out=stats)
+        stats /= self.nsamples
+        np.copyto(scratch, stats)
+        stripes -= scratch
+        np.einsum('ij,ij->i', stripes, stripes, out=stats[:, 0])
+        stats /= self.nsamples
+        np.sqrt(stats, out=stats)
+        np.copyto(scratch, stats)
+        stripes /= scratch
+        if self._window is not None:
+            stripes *= self._window
+        np.copyto(self._padded[k, :, :self.nsamples], stripes)
+
+    def analyse(self, frame_a, frame_b, out=None):
+        """
+        Displacement profile of one frame pair
+
+        :param frame_a: 2D array of frame 1, with the shape given at construction
+        :param frame_b: 2D array of frame 2
+        :param out: optional (n_stripes, 2) array for the results; by default the analyser's
+                    own results buffer is reused, so copy it to keep results between calls
+        :return: piv_results : displacement profile (column 2) versus y position (column 1)
+        """
+        if frame_a.shape != self.frame_shape or frame_b.shape != self.frame_shape:
+            raise ValueError("Expected frames of shape {}, got {} and {}".format(
+                self.frame_shape, frame_a.shape, frame_b.shape))
+        if out is None:
+            out = self.results
+        else:
+            out[:, 0] = self.y_position
+        self._divid(frame_a, 0)
+        self._divid(frame_b, 1)
+
+        spectra = self._spectra
+        if _FFT_HAS_OUT:
+            np.fft.rfft(self._padded, axis=-1, out=spectra)
+        else:
+            spectra[...] = np.fft.rfft(self._padded, axis=-1)
+        np.conjugate(spectra[1], out=spectra[1])
+        np.multiply(spectra[0], spectra[1], out=spectra[0])
+        if self.mode == 'phase':
+            whiten(spectra[0], self._magnitude, self._row_stats, self._floor)
+        if self._gain is not None:
+            # real and imaginary parts separately, as multiplying complex by real values makes a complex copy
+            np.multiply(spectra[0].real, self._gain, out=spectra[0].real)
+            np.multiply(spectra[0].imag, self._gain, out=spectra[0].imag)
+        if _FFT_HAS_OUT:
+            np.fft.irfft(spectra[0], self.nfft, axis=-1, out=self._circular)
+        else:
+            self._circular[...] = np.fft.irfft(spectra[0], self.nfft, axis=-1)
+
+        # reorder to lags 1-n .. n-1 so ties resolve as in x_corr
+        nsamples = self.nsamples
+        np.concatenate((self._circular[:, self.nfft - (nsamples - 1):], self._circular[:, :nsamples]),
+                       axis=1, out=self._xcorr)
+        if self.mode == 'zncc':
+            self._normaliser(self._xcorr, self._padded[0, :, :nsamples], self._padded[1, :, :nsamples])
+        if self.max_lag < nsamples - 1:
+            self._xcorr[:, :nsamples - 1 - self.max_lag] = -np.inf
+            self._xcorr[:, nsamples + self.max_lag:] = -np.inf
+        np.argmax(self._xcorr, axis=1, out=self._peak)
+        np.subtract(nsamples - 1, self._peak, out=out[:, 1])
+        return out
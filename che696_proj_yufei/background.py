@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+background.py
+Rolling background of a frame sequence
+
+Scratches, reflections and other static features are the same in every frame, so they
+correlate perfectly at zero lag and pull the displacement peak towards it. Subtracting
+the running mean or minimum of the last few frames removes them. The background is
+updated incrementally as each frame arrives, in O(H*W) work per frame and memory for a
+fixed number of frames, however long the sequence is. It can be kept for whole frames or,
+with division_pixel times less memory, for the stripe profiles the frames are reduced to.
+"""
+
+import numpy as np
+
+# running mean or minimum of the frames in the window
+BACKGROUND_METHODS = ('mean', 'min')
+DEF_BACKGROUND_METHOD = 'min'
+# whole frames, or their stripe profiles
+BACKGROUND_LEVELS = ('frame', 'stripe')
+DEF_BACKGROUND_LEVEL = 'frame'
+DEF_BACKGROUND_WINDOW = 10
+
+
+class Background(object):
+    """
+    How the background of a sequence is estimated; PivAnalyser keeps the RollingWindow
+
+    At the 'frame' level the background of every pixel is subtracted before the frames are
+    cut into stripes. At the 'stripe' level the background of the raw stripe profiles (the
+    mean of the rows of each stripe) is subtracted before they are normalized. Both give
+    the same result for the mean; for the minimum, the stripe level takes the minimum of
+    the stripe profiles, which keeps more of a background that varies within a stripe.
+
+    :param method: 'mean' or 'min' of the frames in the window
+    :param window: number of most recent frames the background is estimated from
+    :param level: 'frame' or 'stripe'
+    """
+
+    def __init__(self, method=DEF_BACKGROUND_METHOD, window=DEF_BACKGROUND_WINDOW, level=DEF_BACKGROUND_LEVEL):
+        if method not in BACKGROUND_METHODS:
+            raise ValueError("Unknown background method '{}', choose from {}".format(
+                method, ', '.join(BACKGROUND_METHODS)))
+        if level not in BACKGROUND_LEVELS:
+            raise ValueError("Unknown background level '{}', choose from {}".format(
+                level, ', '.join(BACKGROUND_LEVELS)))
+        if window < 2:
+            raise ValueError("A background window needs at least 2 frames, got {}".format(window))
+        self.method = method
+        self.window = int(window)
+        self.level = level
+
+    def params(self):
+        """
+        Parameters as a dict for JSON, from which Background(**params) makes the same model
+        """
+        return {'method': self.method, 'window': self.window, 'level': self.level}
+
+
+class RollingWindow(object):
+    """
+    Running mean or minimum of the last window arrays of a fixed shape
+
+    The mean keeps the window in a ring buffer with a running sum, which is summed afresh
+    every time the ring wraps around so that rounding errors do not pile up. The minimum
+    uses the van Herk / Gil-Werman scheme: the window is split at the start of the current
+    block of window frames, whose running minimum is kept, and the minima of the suffixes of
+    the previous block, computed once when that block was complete. Both cost a few array
+    operations per push and hold about window (mean) or 2 * window (min) arrays.
+
+    :param shape: shape of the arrays
+    :param window: number of most recent arrays in the window
+    :param method: 'mean' or 'min'
+    :param dtype: floating point type of the buffers
+    """
+
+    def __init__(self, shape, window, method=DEF_BACKGROUND_METHOD, dtype=np.float64):
+        if method not in BACKGROUND_METHODS:
+            raise ValueError("Unknown background method '{}', choose from {}".format(
+                method, ', '.join(BACKGROUND_METHODS)))
+        self.shape = tuple(shape)
+        self.window = window
+        self.method = method
+        self.count = 0
+        self._position = 0
+        self._ring = np.empty((window,) + self.shape, dtype=dtype)
+        self.value = np.zeros(self.shape, dtype=dtype)
+        if method == 'mean':
+            self._sum = np.zeros(self.shape, dtype=dtype)
+        else:
+            self._suffix_min = np.empty_like(self._ring)
+            self._prefix_min = np.empty(self.shape, dtype=dtype)
+
+    def __len__(self):
+        """
+        Number of arrays in the window, at most window
+        """
+        return min(self.count, self.window)
+
+    def push(self, values):
+        """
+        Add an array to the window, dropping the oldest one once the window is full
+
+        :param values: array of the window's shape (cast to its type)
+        :return: value, the mean or minimum of the arrays now in the window
+        """
+        position = self._position
+        if self.method == 'mean':
+            if self.count >= self.window:
+                self._sum -= self._ring[position]
+            np.copyto(self._ring[position], values, casting='unsafe')
+            if position == self.window - 1:
+                np.sum(self._ring, axis=0, out=self._sum)
+            else:
+                self._sum += self._ring[position]
+            np.divide(self._sum, min(self.count + 1, self.window), out=self.value)
+        else:
+            slot = self._ring[position]
+            np.copyto(slot, values, casting='unsafe')
+            if position == 0:
+                np.copyto(self._prefix_min, slot)
+            else:
+                np.minimum(self._prefix_min, slot, out=self._prefix_min)
+            if self.count < self.window or position == self.window - 1:
+                # the window lies within the current block
+                np.copyto(self.value, self._prefix_min)
+            else:
+                np.minimum(self._suffix_min[position + 1], self._prefix_min, out=self.value)
+            if position == self.window - 1:
+                # the block is complete: its suffix minima serve the next block
+                for i in range(self.window - 2, -1, -1):
+                    np.minimum(self._ring[i], self._ring[i + 1], out=self._ring[i])
+                self._ring, self._suffix_min = self._suffix_min, self._ring
+        self.count += 1
+        self._position = (position + 1) % self.window
+        return self.value
+
+    def reset(self):
+        """
+        Empty the window
+        """
+        self.count = 0
+        self._position = 0
+        self.value[...] = 0
+        if self.method == 'mean':
+            self._sum[...] = 0
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmark.py
+Synthetic shear-flow image pairs and timings of the PIV pipeline
+
+Run with ``python -m che696_proj_yufei.benchmark``.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import ndimage
+from .correlation import BACKENDS
+from .analyser import PivAnalyser
+from .image_proc import divid_image, x_corr, PRECISIONS, SUCCESS
+from .windows import analyse_windows, window_step, window_grid
+
+# (height, width, slip, shear rate) of the synthetic benchmark set; the displacement at
+# row y is slip + shear * y pixels, so both walls and the bulk are exercised
+SYNTHETIC_CASES = [(256, 512, 0.0, 0.05),
+                   (512, 1024, 2.0, 0.03),
+                   (1024, 1024, -5.0, 0.02),
+                   (1245, 1027, 0.0, 0.015)]
+
+
+def synthetic_pair(height, width, slip, shear, density=0.02, particle_size=1.5, seed=0):
+    """
+    Render a pair of particle images for a simple shear flow
+
+    Particles are placed at integer pixels and moved by the rounded local displacement,
+    so every stripe has an exactly known integer shift.
+
+    :param height: image height (pixels)
+    :param width: image width (pixels)
+    :param slip: displacement at y = 0 (pixels)
+    :param shear: change of displacement per pixel along y
+    :param density: particles per pixel
+    :param particle_size: standard deviation of the Gaussian particle images (pixels)
+    :param seed: seed of the random particle positions
+    :return: image_a, image_b : int32 arrays with values in 0..255
+    """
+    rng = np.random.RandomState(seed)
+    n_particles = int(density * height * width)
+    y = rng.randint(0, height, n_particles)
+    x = rng.randint(0, width, n_particles)
+    x_moved = (x + np.rint(slip + shear * y).astype(int)) % width
+    images = []
+    for x_particles in (x, x_moved):
+        image = np.zeros((height, width))
+        np.add.at(image, (y, x_particles), 1.0)
+        image = ndimage.gaussian_filter(image, particle_size, mode='wrap')
+        images.append(np.rint(255 * image / image.max()).astype(np.int32))
+    return images[0], images[1]
+
+
+def synthetic_set():
+    """
+    The synthetic benchmark pairs, as a list of (label, image_a, image_b)
+    """
+    pairs = []
+    for height, width, slip, shear in SYNTHETIC_CASES:
+        image_a, image_b = synthetic_pair(height, width, slip, shear)
+        pairs.append(('{}x{} slip={} shear={}'.format(height, width, slip, shear), image_a, image_b))
+    return pairs
+
+
+def time_call(func, repeat=5):
+    """
+    Best wall-clock time (seconds) of func() over repeat calls, after one warm-up call
+    """
+    func()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_pair(image_a, image_b, division_pixel, backend, precision, repeat=5):
+    """
+    Time striping plus correlation of one image pair
+
+    :return: best time in seconds
+    """
+    def run():
+        segments_a = divid_image(image_a, division_pixel, precision=precision)[0]
+        segments_b = divid_image(image_b, division_pixel, precision=precision)[0]
+        x_corr(segments_a, segments_b, backend=backend, precision=precision)
+    return time_call(run, repeat)
+
+
+def bench_windows(image_a, image_b, window_size, overlap, precision, repeat=5):
+    """
+    Time the 2D interrogation window analysis of one image pair
+
+    :return: best time in seconds, number of displacement vectors
+    """
+    y_position, x_position = window_grid(image_a.shape, window_size, window_step(window_size, overlap))
+    best = time_call(lambda: analyse_windows(image_a, image_b, window_size, overlap, precision=precision), repeat)
+    return best, y_position.size * x_position.size
+
+
+def analyser_latency(image_a, image_b, division_pixel, precision, n_calls=200):
+    """
+    Per-pair latency distribution of a warmed-up PivAnalyser
+
+    :return: dict of the 50th, 90th, 99th percentile and maximum latency in milliseconds
+    """
+    analyser = PivAnalyser(image_a.shape, division_pixel, precision=precision)
+    analyser.analyse(image_a, image_b)
+    latency = np.empty(n_calls)
+    for i in range(n_calls):
+        start = time.perf_counter()
+        analyser.analyse(image_a, image_b)
+        latency[i] = time.perf_counter() - start
+    p50, p90, p99 = 1000 * np.percentile(latency, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': 1000 * latency.max()}
+
+
+def parse_cmdline(argv):
+    """
+    Returns the parsed argument list and return code.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Time the PIV pipeline on the synthetic benchmark set")
+    parser.add_argument("-d", "--division_pixel", type=int, help="Thickness (number of pixels) of horizontal stripes",
+                        default=5)
+    parser.add_argument("-r", "--repeat", type=int, help="Timed runs per configuration", default=5)
+    parser.add_argument("-w", "--window_size", type=int, help="Size (pixels) of the 2D interrogation windows",
+                        default=32)
+    parser.add_argument("--overlap", type=float, help="Overlap fraction of the 2D interrogation windows",
+                        default=0.5)
+    parser.add_argument("-n", "--n_calls", type=int, help="Analyser calls per latency measurement", default=200)
+    args = parser.parse_args(argv)
+    return args, SUCCESS
+
+
+def main(argv=None):
+    args, ret = parse_cmdline(argv)
+    if ret != SUCCESS:
+        return ret
+    print("{:<36} {:<10} {:<8} {:>10}".format("case", "backend", "prec.", "time (ms)"))
+    for label, image_a, image_b in synthetic_set():
+        for backend in sorted(BACKENDS):
+            for precision in sorted(PRECISIONS):
+                best = bench_pair(image_a, image_b, args.division_pixel, backend, precision, args.repeat)
+                print("{:<36} {:<10} {:<8} {:>10.2f}".format(label, backend, precision, 1000 * best))
+
+    print("\n2D interrogation windows ({} px, overlap {}) versus stripes (scipy_fft)".format(args.window_size,
+                                                                                         args.overlap))
+    print("{:<36} {:<8} {:>12} {:>12} {:>8} {:>12}".format("case", "prec.", "stripes (ms)", "windows (ms)",
+                                                          "vectors", "vectors/s"))
+    for label, image_a, image_b in synthetic_set():
+        for precision in sorted(PRECISIONS):
+            stripes = bench_pair(image_a, image_b, args.division_pixel, 'scipy_fft', precision, args.repeat)
+            best, n_vectors = bench_windows(image_a, image_b, args.window_size, args.overlap, precision,
+                                            args.repeat)
+            print("{:<36} {:<8} {:>12.2f} {:>12.2f} {:>8} {:>12.0f}".format(label, precision, 1000 * stripes,
+                                                                           1000 * best, n_vectors, n_vectors / best))
+
+    print("\nPivAnalyser latency (ms)")
+    print("{:<36} {:<8} {:>8} {:>8} {:>8} {:>8}".format("case", "prec.", "p50", "p90", "p99", "max"))
+    for label, image_a, image_b in synthetic_set():
+        for precision in sorted(PRECISIONS):
+            latency = analyser_latency(image_a, image_b, args.division_pixel, precision, args.n_calls)
+            print("{:<36} {:<8} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {max:>8.2f}".format(label, precision,
+                                                                                       **latency))
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+calibration.py
+Rotation and lens dewarp of frames before they are cut into stripes
+
+The stripe analysis assumes that the flow runs exactly along the image x axis. A camera
+that is tilted by a few degrees, or whose lens bends straight lines, is corrected here as
+frames are loaded: every pixel of the corrected frame is sampled from the camera frame at
+a position given by a remap table, which is computed once per calibration and frame shape
+and then reused, so correcting a frame costs a few vectorised gathers.
+"""
+
+import json
+import numpy as np
+
+INTERPOLATIONS = ('nearest', 'bilinear')
+DEF_INTERPOLATION = 'bilinear'
+# steps of the search for the largest corrected frame that lies within the camera frame
+CROP_SEARCH_STEPS = 30
+
+
+class Calibration(object):
+    """
+    Tilt and radial lens distortion of a camera, as a correction of its frames
+
+    A point of the corrected frame at offset (u, v) pixels from the centre, with u along
+    the flow, lies at the offset p = u * (cos a, -sin a) + v * (sin a, cos a) of an ideal
+    camera tilted by the angle a, and the lens moves it to centre + p * (1 + k1 r^2 + k2 r^4),
+    where r is |p| divided by half the diagonal of the frame. The corrected frame is the
+    largest rectangle of the same aspect ratio around the centre that lies within the camera
+    frame, so its shape is slightly smaller.
+
+    :param angle: angle (degrees) of the flow direction to the image x axis, counter-clockwise
+                  as seen on screen, where y points down
+    :param k1: quadratic radial distortion coefficient; negative for barrel distortion
+    :param k2: quartic radial distortion coefficient
+    :param center: optional (x, y) pixel position of the optical axis; default the frame centre
+    :param interpolation: 'nearest' or 'bilinear'
+    """
+
+    def __init__(self, angle=0.0, k1=0.0, k2=0.0, center=None, interpolation=DEF_INTERPOLATION):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation '{}', choose from {}".format(
+                interpolation, ', '.join(INTERPOLATIONS)))
+        self.angle = float(angle)
+        self.k1 = float(k1)
+        self.k2 = float(k2)
+        self.center = None if center is None else tuple(float(c) for c in center)
+        if self.center is not None and len(self.center) != 2:
+            raise ValueError("The centre of a calibration is an (x, y) pair, got {}".format(center))
+        self.interpolation = interpolation
+        # frame shape -> RemapTable
+        self._tables = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Calibration from a JSON file of its params, e.g. {"angle": 2.5, "k1": -0.04}
+
+        Raises OSError if the file cannot be read and ValueError if it is not a calibration.
+        """
+        with open(path) as f:
+            try:
+                params = json.load(f)
+            except ValueError as e:
+                raise ValueError("Calibration file {} is not valid JSON: {}".format(path, e))
+        if not isinstance(params, dict):
+            raise ValueError("Calibration file {} does not hold a JSON object".format(path))
+        try:
+            return cls(**params)
+        except TypeError as e:
+            raise ValueError("Calibration file {}: {}".format(path, e))
+
+    def params(self):
+        """
+        Parameters as a dict for JSON, from which Calibration(**params) makes the same calibration
+        """
+        return {'angle': self.angle, 'k1': self.k1, 'k2': self.k2,
+                'center': None if self.center is None else list(self.center), 'interpolation': self.interpolation}
+
+    def reduced(self, reduce):
+        """
+        The same calibration for frames at 1/reduce of the resolution
+        """
+        center = None
+        if self.center is not None:
+            center = [(c + 0.5) / reduce - 0.5 for c in self.center]
+        return Calibration(self.angle, self.k1, self.k2, center, self.interpolation)
+
+    def source_points(self, frame_shape, shape):
+        """
+        Position in the camera frame of every pixel of a corrected frame
+
+        :param frame_shape: (height, width) of the camera frames
+        :param shape: (height, width) of the corrected frame, centred on the optical axis
+        :return: x, y : 2D arrays of the given shape
+        """
+        height, width = frame_shape
+        if self.center is None:
+            center_x, center_y = (width - 1) / 2.0, (height - 1) / 2.0
+        else:
+            center_x, center_y = self.center
+        u = np.arange(shape[1]) - (shape[1] - 1) / 2.0
+        v = np.arange(shape[0]) - (shape[0] - 1) / 2.0
+        u, v = np.meshgrid(u, v)
+        angle = np.radians(self.angle)
+        x = u * np.cos(angle) + v * np.sin(angle)
+        y = v * np.cos(angle) - u * np.sin(angle)
+        if self.k1 != 0 or self.k2 != 0:
+            r2 = (x * x + y * y) / ((height * height + width * width) / 4.0)
+            factor = 1 + r2 * (self.k1 + self.k2 * r2)
+            x *= factor
+            y *= factor
+        return x + center_x, y + center_y
+
+    def remap_table(self, frame_shape):
+        """
+        RemapTable of camera frames of frame_shape, computed on first use and then reused
+        """
+        frame_shape = tuple(frame_shape)
+        table = self._tables.get(frame_shape)
+        if table is None:
+            table = self._tables[frame_shape] = RemapTable(self, frame_shape)
+        return table
+
+    def apply(self, frame):
+        """
+        Corrected copy of a 2D frame, as a float64 array of remap_table(frame.shape).shape
+        """
+        return self.remap_table(frame.shape).apply(frame)
+
+
+class RemapTable(object):
+    """
+    Gather indices and interpolation weights of a Calibration for frames of one shape
+
+    With bilinear interpolation, each corrected pixel is the weighted sum of the 4 camera
+    pixels around its source position; the table holds their flat indices (int32) and
+    weights (float32), 32 bytes per pixel. With nearest interpolation it holds one index.
+
+    :param calibration: Calibration
+    :param frame_shape: (height, width) of the camera frames
+    """
+
+    def __init__(self, calibration, frame_shape):
+        height, width = frame_shape
+        if height < 2 or width < 2:
+            raise ValueError("Frames of shape {} are too small to resample".format(frame_shape))
+        self.frame_shape = (height, width)
+        self.shape = self._crop(calibration, self.frame_shape)
+        x, y = calibration.source_points(self.frame_shape, self.shape)
+        if calibration.interpolation == 'nearest':
+            index = np.rint(y).astype(np.int32) * width + np.rint(x).astype(np.int32)
+            self.index = index.ravel()[np.newaxis]
+            self.weights = None
+            return
+        # top left neighbour; the last row and column only as the far neighbours
+        x0 = np.minimum(np.floor(x), width - 2)
+        y0 = np.minimum(np.floor(y), height - 2)
+        fx = (x - x0).ravel()
+        fy = (y - y0).ravel()
+        corner = (y0.astype(np.int32) * width + x0.astype(np.int32)).ravel()
+        self.index = np.array([corner, corner + 1, corner + width, corner + width + 1], dtype=np.int32)
+        self.weights = np.array([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], dtype=np.float32)
+
+    @staticmethod
+    def _crop(calibration, frame_shape):
+        # largest corrected frame of the camera's aspect ratio whose source points all lie
+        # within the camera frame, by bisection of its scale
+        height, width = frame_shape
+
+        def shape_at(scale):
+            return max(1, int(height * scale)), max(1, int(width * scale))
+
+        def fits(scale):
+            x, y = calibration.source_points(frame_shape, shape_at(scale))
+            return x.min() >= 0 and y.min() >= 0 and x.max() <= width - 1 and y.max() <= height - 1
+
+        if fits(1.0):
+            return frame_shape
+        low, high = 0.0, 1.0
+        for _ in range(CROP_SEARCH_STEPS):
+            middle = (low + high) / 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle
+        shape = shape_at(low)
+        if min(shape) < 2 or not fits(low):
+            raise ValueError("The calibration leaves no part of frames of shape {}".format(frame_shape))
+        return shape
+
+    def apply(self, frame):
+        """
+        Corrected copy of a 2D frame of frame_shape, as a float64 array of the table's shape
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError("Expected a frame of shape {}, got {}".format(self.frame_shape, frame.shape))
+        flat = np.ascontiguousarray(frame, dtype=np.float64).ravel()
+        out = np.take(flat, self.index[0], mode='clip')
+        if self.weights is not None:
+            out *= self.weights[0]
+            gathered = np.empty_like(out)
+            for index, weights in zip(self.index[1:], self.weights[1:]):
+                np.take(flat, index, out=gathered, mode='clip')
+                gathered *= weights
+                out += gathered
+        return out.reshape(self.shape)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+catalogue.py
+SQLite catalogue of result stores
+
+One row per run (result store and its parameters) and one row per pair with the frame
+names, image hashes, acquisition time, summary statistics of the displacement profile
+and the chunk of the store that holds the full profile. Searching many campaigns then
+takes one indexed query instead of reading every result file.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import numpy as np
+from .stats import fit_profiles
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    store_path TEXT UNIQUE NOT NULL,
+    division_pixel INTEGER,
+    precision TEXT,
+    mode TEXT,
+    prefilter TEXT,
+    background TEXT,
+    calibration TEXT,
+    n_stripes INTEGER,
+    n_pairs INTEGER,
+    catalogued REAL
+);
+CREATE TABLE IF NOT EXISTS pairs (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    pair INTEGER NOT NULL,
+    frame_a TEXT,
+    frame_b TEXT,
+    hash_a TEXT,
+    hash_b TEXT,
+    frame_time REAL,
+    mean_displacement REAL,
+    min_displacement REAL,
+    max_displacement REAL,
+    wall_displacement REAL,
+    shear_rate REAL,
+    chunk INTEGER,
+    chunk_row INTEGER,
+    PRIMARY KEY (run_id, pair)
+);
+CREATE INDEX IF NOT EXISTS runs_parameters ON runs (division_pixel, precision, mode);
+CREATE INDEX IF NOT EXISTS pairs_frame_time ON pairs (frame_time);
+CREATE INDEX IF NOT EXISTS pairs_shear_rate ON pairs (shear_rate);
+CREATE INDEX IF NOT EXISTS pairs_wall_displacement ON pairs (wall_displacement);
+"""
+# run parameters added after the first catalogues were written; prefilter, background and
+# calibration hold the JSON of their params(), or NULL when not used
+RUN_PARAMETERS = ('mode', 'prefilter', 'background', 'calibration')
+
+
+def connect(db_path):
+    """
+    Open (and if needed create) a catalogue
+    """
+    conn = sqlite3.connect(db_path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(runs)")]
+    if columns:
+        with conn:
+            for column in RUN_PARAMETERS:
+                if column not in columns:
+                    conn.execute("ALTER TABLE runs ADD COLUMN {} TEXT".format(column))
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """
+    SHA-1 hex digest of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def profile_summary(y_position, displacements):
+    """
+    Summary statistics of a block of displacement profiles, computed for all rows at once
+
+    :param y_position: stripe centres
+    :param displacements: (n_pairs, n_stripes) array
+    :return: dict of arrays: mean, min, max, wall (displacement of the stripe nearest the
+             lower, moving wall) and shear_rate (least-squares slope versus y)
+    """
+    displacements = np.asarray(displacements, dtype=float)
+    return {'mean': displacements.mean(axis=1),
+            'min': displacements.min(axis=1),
+            'max': displacements.max(axis=1),
+            'wall': displacements[:, -1],
+            'shear_rate': fit_profiles(y_position, displacements)[0]}
+
+
+def match_frames(frames, image_paths):
+    """
+    Paths of the frames of every pair of a store, which records file names only
+
+    Pairs follow the sequence order, so each frame is looked for after frame_a of the
+    previous pair first, and only then among all image_paths.
+
+    :param frames: list of (frame_a, frame_b) file names of a ResultStore
+    :param image_paths: paths of the frames in sequence order
+    :return: list of (path_a, path_b), with None for a frame that is not in image_paths
+    """
+    names = [os.path.basename(image_path) for image_path in image_paths]
+    first_index = {}
+    for index, name in enumerate(names):
+        first_index.setdefault(name, index)
+
+    def find(name, start):
+        if name not in first_index:
+            return None
+        try:
+            return names.index(name, start)
+        except ValueError:
+            return first_index[name]
+
+    frame_paths = []
+    start = 0
+    for frame_a, frame_b in frames:
+        index_a = find(frame_a, start)
+        index_b = find(frame_b, start if index_a is None else index_a + 1)
+        if index_a is not None:
+            start = index_a + 1
+        frame_paths.append(tuple(None if index is None else image_paths[index] for index in (index_a, index_b)))
+    return frame_paths
+
+
+def add_store(db_path, store, image_paths=None):
+    """
+    Catalogue every pair of a result store; a store that is already catalogued is replaced
+
+    Parameters
+    ----------
+    db_path : path of the SQLite catalogue
+    store : ResultStore to add
+    image_paths : optional paths of the frames in sequence order, used for image hashes and
+                  acquisition times (file modification times); frames are matched to pairs by
+                  file name in that order, so frames of different directories may share a name
+
+    Returns
+    -------
+    run_id : id of the run in the catalogue
+    """
+    store_path = os.path.abspath(store.path)
+    frame_paths = match_frames(store.frames, image_paths or [])
+    parameters = [store.attrs.get(column) for column in RUN_PARAMETERS]
+    parameters = parameters[:1] + [None if value is None else json.dumps(value, sort_keys=True)
+                                   for value in parameters[1:]]
+    frame_hashes = {}
+    conn = connect(db_path)
+    try:
+        with conn:
+            row = conn.execute("SELECT run_id FROM runs WHERE store_path = ?", (store_path,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM pairs WHERE run_id = ?", row)
+                conn.execute("DELETE FROM runs WHERE run_id = ?", row)
+            cursor = conn.execute(
+                "INSERT INTO runs (store_path, division_pixel, precision, mode, prefilter, background, calibration, "
+                "n_stripes, n_pairs, catalogued) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [store_path, store.attrs.get('division_pixel'), store.attrs.get('precision')] + parameters +
+                [store.n_stripes, len(store), time.time()])
+            run_id = cursor.lastrowid
+            pair = 0
+            for chunk_id, chunk in enumerate(store.iter_chunks()):
+                summary = profile_summary(store.y_position, chunk)
+                rows = []
+                for chunk_row in range(len(chunk)):
+                    frame_a, frame_b = store.frames[pair]
+                    path_a, path_b = frame_paths[pair]
+                    hash_a = hash_b = frame_time = None
+                    if path_a is not None and path_b is not None:
+                        # keyed on the full path, as frames of different directories can share a name
+                        for frame_path in (path_a, path_b):
+                            if frame_path not in frame_hashes:
+                                frame_hashes[frame_path] = file_hash(frame_path)
+                        hash_a, hash_b = frame_hashes[path_a], frame_hashes[path_b]
+                        frame_time = os.path.getmtime(path_a)
+                    rows.append((run_id, pair, frame_a, frame_b, hash_a, hash_b, frame_time,
+                                 summary['mean'][chunk_row], summary['min'][chunk_row], summary['max'][chunk_row],
+                                 summary['wall'][chunk_row], summary['shear_rate'][chunk_row], chunk_id, chunk_row))
+                    pair += 1
+                conn.executemany("INSERT INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+    return run_id
+
+
+def find_pairs(db_path, division_pixel=None, min_wall_displacement=None, min_shear_rate=None,
+               max_shear_rate=None, start_time=None, end_time=None):
+    """
+    Pairs of all catalogued runs that match every given condition
+
+    :return: list of (store_path, pair, frame_a, frame_b, frame_time, wall_displacement, shear_rate, chunk, chunk_row)
+    """
+    conditions = []
+    params = []
+    for clause, value in (("runs.division_pixel = ?", division_pixel),
+                          ("pairs.wall_displacement > ?", min_wall_displacement),
+                          ("pairs.shear_rate >= ?", min_shear_rate),
+                          ("pairs.shear_rate <= ?", max_shear_rate),
+                          ("pairs.frame_time >= ?", start_time),
+                          ("pairs.frame_time <= ?", end_time)):
+        if value is not None:
+            conditions.append(clause)
+            params.append(value)
+    query = ("SELECT runs.store_path, pairs.pair, pairs.frame_a, pairs.frame_b, pairs.frame_time, "
+             "pairs.wall_displacement, pairs.shear_rate, pairs.chunk, pairs.chunk_row "
+             "FROM pairs JOIN runs USING (run_id)")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY runs.store_path, pairs.pair"
+    conn = connect(db_path)
+    try:
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
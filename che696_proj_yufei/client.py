@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+client.py
+Thin client of the PIV analysis server
+
+``image_proc_client -m image_a image_b`` takes the options of ``image_proc`` for a pair that
+the server supports (-d, -p, --mode, --highpass, --lowpass and --taper) and writes the same
+output files. When a server (``image_proc --serve``) is listening, the pair is sent to it;
+otherwise the pair is analysed in this process with the same options.
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import numpy as np
+from .image_proc import warning, SUCCESS, INVALID_DATA, DEF_IMAGE_NAME_A, DEF_IMAGE_NAME_B, PRECISIONS, \
+    DEF_PRECISION
+from .correlation import MODES, DEF_MODE, TAPERS, DEF_TAPER, PreFilter, check_prefilter
+from .server import default_socket_path, encode_frame
+
+
+def send_request(request, socket_path=None, timeout=None):
+    """
+    Send one request to the server and wait for its response
+
+    :return: response dict; raises OSError if no server is listening on socket_path
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        connection.connect(socket_path or default_socket_path())
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with connection.makefile('rb') as rfile:
+            line = rfile.readline()
+    finally:
+        connection.close()
+    if not line:
+        raise OSError('The server closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+
+def _piv_results(response):
+    if response['status'] != SUCCESS:
+        raise ValueError(response['error'])
+    return np.column_stack((response['y_position'], response['displacement']))
+
+
+def analyse_pair(image_a_path, image_b_path, division_pixel=5, precision=DEF_PRECISION, socket_path=None,
+                 mode=DEF_MODE, prefilter=None):
+    """
+    piv_results of a pair of image files, analysed by the server
+
+    Raises OSError if no server is running and ValueError if the server cannot analyse the pair.
+    """
+    request = {'image_a': os.path.abspath(image_a_path), 'image_b': os.path.abspath(image_b_path),
+               'division_pixel': division_pixel, 'precision': precision, 'mode': mode,
+               'prefilter': None if prefilter is None else prefilter.params()}
+    return _piv_results(send_request(request, socket_path))
+
+
+def analyse_frames(frame_a, frame_b, division_pixel=5, precision=DEF_PRECISION, socket_path=None, mode=DEF_MODE,
+                   prefilter=None):
+    """
+    piv_results of a pair of frames already in memory, analysed by the server
+    """
+    request = {'frame_a': encode_frame(frame_a), 'frame_b': encode_frame(frame_b),
+               'division_pixel': division_pixel, 'precision': precision, 'mode': mode,
+               'prefilter': None if prefilter is None else prefilter.params()}
+    return _piv_results(send_request(request, socket_path))
+
+
+def parse_cmdline(argv):
+    """
+    Returns the parsed argument list and return code.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Analyse a pair of images with the PIV server if it is running")
+    parser.add_argument("-m", "--image_file", help="The location of the image files",
+                        default=[DEF_IMAGE_NAME_A, DEF_IMAGE_NAME_B], nargs=2)
+    parser.add_argument("-d", "--division_pixel", type=int, help="Thickness (number of pixels) of horizontal stripes",
+                        default=5)
+    parser.add_argument("-p", "--precision", help="Floating point precision of the stripes and correlation",
+                        choices=sorted(PRECISIONS), default=DEF_PRECISION)
+    parser.add_argument("--mode", help="Correlation mode: plain cross-correlation, phase correlation or "
+                                       "zero-normalised cross-correlation", choices=MODES, default=DEF_MODE)
+    parser.add_argument("--highpass", type=float, metavar="SIGMA",
+                        help="Gaussian high-pass filter of the stripes within the correlation")
+    parser.add_argument("--lowpass", type=float, metavar="SIGMA",
+                        help="Gaussian low-pass filter of the stripes within the correlation")
+    parser.add_argument("--taper", help="Window function the stripes are multiplied by before they are correlated",
+                        choices=TAPERS, default=DEF_TAPER)
+    parser.add_argument("--socket", help="Unix domain socket of the server (default: $PIV_SERVER_SOCKET or "
+                                         "image_proc-<uid>.sock in the temporary directory)")
+    args = parser.parse_args(argv)
+    args.prefilter = None
+    if args.highpass is not None or args.lowpass is not None or args.taper != DEF_TAPER:
+        try:
+            args.prefilter = PreFilter(args.highpass, args.lowpass, args.taper)
+            check_prefilter(args.mode, args.prefilter)
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+    return args, SUCCESS
+
+
+def main(argv=None):
+    args, ret = parse_cmdline(argv)
+    if ret != SUCCESS:
+        return ret
+    request = {'image_a': os.path.abspath(args.image_file[0]), 'image_b': os.path.abspath(args.image_file[1]),
+               'division_pixel': args.division_pixel, 'precision': args.precision, 'mode': args.mode,
+               'prefilter': None if args.prefilter is None else args.prefilter.params(),
+               'out_dir': os.path.abspath('.'), 'plot': True}
+    try:
+        response = send_request(request, args.socket)
+    except OSError:
+        from .image_proc import main as local_main
+        local_args = ["-m"] + args.image_file + ["-d", str(args.division_pixel), "-p", args.precision,
+                                                 "--mode", args.mode, "--taper", args.taper]
+        for option, sigma in (("--highpass", args.highpass), ("--lowpass", args.lowpass)):
+            if sigma is not None:
+                local_args += [option, repr(sigma)]
+        return local_main(local_args)
+    except ValueError as e:
+        warning("Invalid response from the server:", e)
+        return INVALID_DATA
+    if response['status'] != SUCCESS:
+        warning(response['error'])
+        return response['status']
+    for out_name in response['files']:
+        print("Wrote file: {}".format(os.path.relpath(out_name)))
+    return SUCCESS
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
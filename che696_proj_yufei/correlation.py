@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+correlation.py
+Cross-correlation backends for the stripe displacement search
+
+Every backend takes two 2D arrays of stripes (one stripe per row) and the largest lag
+of interest, and returns the full cross-correlation of each pair of rows with lags
+ordered from 1-n to n-1, i.e. the layout of scipy.signal.correlate(y1, y2).
+"""
+
+import os
+import json
+import time
+import importlib.util
+import numpy as np
+from scipy import fft as sp_fft
+
+DEF_BACKEND = 'auto'
+# plain cross-correlation, phase correlation (whitened cross-spectrum) and zero-normalised
+# cross-correlation over the overlap of the stripes at each lag
+MODES = ('cross', 'phase', 'zncc')
+DEF_MODE = 'cross'
+# smallest magnitude of a whitened cross-spectrum, relative to the largest one of its stripe
+PHASE_FLOOR = 1e-2
+# window functions the stripes can be tapered with before they are transformed
+TAPERS = ('none', 'hann', 'tukey')
+DEF_TAPER = 'none'
+# fraction of a Tukey window that is tapered, half at each end
+TUKEY_FRACTION = 0.25
+# smallest number of unmasked points two stripes must share at a lag of the masked
+# correlation, relative to the unmasked points of the sparser stripe
+MASK_MIN_OVERLAP = 0.5
+CACHE_DIR_ENV = 'PIV_CACHE_DIR'
+CACHE_FILE_NAME = 'xcorr_backends.json'
+
+# name -> function(stripes_a, stripes_b, max_lag) returning the full cross-correlation
+BACKENDS = {}
+
+# backends chosen by the auto-tuner during this session, keyed like the disk cache
+_tuned_backends = {}
+
+
+def register_backend(name, func=None):
+    """
+    Make a correlation function selectable by name; without func this works as a decorator
+
+    :param name: str used on the command line and in the tuning cache
+    :param func: function(stripes_a, stripes_b, max_lag) -> 2D array of shape (n_stripes, 2n-1)
+    :return: func
+    """
+    if func is None:
+        return lambda f: register_backend(name, f)
+    BACKENDS[name] = func
+    return func
+
+
+def fft_length(nsamples):
+    """
+    Smallest fast transform length that holds a full linear correlation of two
+    stripes of nsamples points without wrap-around.
+    """
+    return sp_fft.next_fast_len(2 * nsamples - 1, real=True)
+
+
+def circular_to_full(xcorr_circ, nsamples):
+    """
+    Reorder a circular correlation (lag 0 first, negative lags wrapped to the end)
+    into the full layout with lags running from 1-n to n-1.
+    """
+    nfft = xcorr_circ.shape[-1]
+    return np.concatenate((xcorr_circ[..., nfft - (nsamples - 1):], xcorr_circ[..., :nsamples]), axis=-1)
+
+
+@register_backend('direct')
+def direct_correlate(stripes_a, stripes_b, max_lag):
+    """
+    Reference backend: numpy's direct-sum correlation, one stripe at a time
+    """
+    n_stripes, nsamples = stripes_a.shape
+    xcorr = np.empty((n_stripes, 2 * nsamples - 1), dtype=np.result_type(stripes_a, stripes_b))
+    for i in range(n_stripes):
+        xcorr[i] = np.correlate(stripes_a[i], stripes_b[i], mode='full')
+    return xcorr
+
+
+@register_backend('numpy_fft')
+def numpy_fft_correlate(stripes_a, stripes_b, max_lag):
+    """
+    All stripes in one batched real FFT with numpy.fft
+    """
+    nsamples = stripes_a.shape[1]
+    nfft = fft_length(nsamples)
+    spectrum = np.fft.rfft(stripes_a, nfft, axis=1)
+    spectrum *= np.conj(np.fft.rfft(stripes_b, nfft, axis=1))
+    return circular_to_full(np.fft.irfft(spectrum, nfft, axis=1), nsamples)
+
+
+def stripe_spectra(stripes, nfft):
+    """
+    Real FFT of every stripe (last axis), zero padded to nfft points
+    """
+    return sp_fft.rfft(stripes, nfft, axis=-1, workers=-1)
+
+
+def whiten(spectrum, magnitude=None, row_max=None, floor=None):
+    """
+    Divide a cross-spectrum by its magnitude in place, for phase correlation
+
+    The peak of the phase correlation is as sharp as the shift allows, whatever the
+    spectrum of the particle images. Magnitudes are raised to at least PHASE_FLOOR times
+    the largest one of their stripe first, so frequencies the particle images hardly
+    contain, where the spectrum is mostly noise, do not get full weight. Stripes without
+    a finite nonzero magnitude, such as the NaN spectrum of a uniform stripe, become zero.
+
+    :param spectrum: complex array of cross-spectra, one stripe per row (last axis)
+    :param magnitude: optional real work array of the same shape
+    :param row_max: optional real work array of the same shape, but of length 1 along the last axis
+    :param floor: optional real work array of the same shape as spectrum
+    :return: spectrum
+    """
+    if magnitude is None:
+        magnitude = np.empty(spectrum.shape, dtype=spectrum.real.dtype)
+    if row_max is None:
+        row_max = np.empty(spectrum.shape[:-1] + (1,), dtype=magnitude.dtype)
+    if floor is None:
+        floor = np.empty_like(magnitude)
+    np.abs(spectrum, out=magnitude)
+    np.amax(magnitude, axis=-1, keepdims=True, out=row_max)
+    # a uniform stripe normalizes to NaN; zero it, so it cannot spread to the others
+    empty = ~(np.isfinite(row_max) & (row_max > 0))[..., 0]
+    if empty.any():
+        spectrum[empty] = 0
+        magnitude[empty] = 1
+        row_max[empty] = 1
+    row_max *= PHASE_FLOOR
+    # spread over a full-size array, as a broadcasting maximum allocates iteration buffers
+    np.copyto(floor, row_max)
+    np.maximum(magnitude, floor, out=magnitude)
+    # real and imaginary parts separately, as dividing complex by real values makes a complex copy
+    np.divide(spectrum.real, magnitude, out=spectrum.real)
+    np.divide(spectrum.imag, magnitude, out=spectrum.imag)
+    return spectrum
+
+
+class PreFilter(object):
+    """
+    Band-pass filter and taper of the stripes, applied inside the FFT correlation
+
+    Instead of a separate filtering pass over every image, a Gaussian high-pass (which
+    removes background gradients and blobs much larger than highpass pixels) and a Gaussian
+    low-pass (which smooths noise finer than lowpass pixels) multiply the cross-spectrum by
+    the square of their gain, which filters both stripes at the cost of one multiply per
+    frequency. A taper (window function) multiplies the normalized stripes, so that their
+    ends, where the zero padding starts, do not dominate the spectrum; an illumination ramp
+    along the stripes otherwise leaves a step there.
+
+    :param highpass: optional standard deviation (pixels) of the Gaussian high-pass
+    :param lowpass: optional standard deviation (pixels) of the Gaussian low-pass
+    :param taper: window function, one of TAPERS
+    """
+
+    def __init__(self, highpass=None, lowpass=None, taper=DEF_TAPER):
+        if taper not in TAPERS:
+            raise ValueError("Unknown taper '{}', choose from {}".format(taper, ', '.join(TAPERS)))
+        for name, sigma in (('High-pass', highpass), ('Low-pass', lowpass)):
+            if sigma is not None and not sigma > 0:
+                raise ValueError("{} filter width must be positive, got {}".format(name, sigma))
+        self.highpass = highpass
+        self.lowpass = lowpass
+        self.taper = taper
+
+    @property
+    def spectral(self):
+        """
+        True if the filter multiplies the cross-spectrum, which needs an FFT backend
+        """
+        return self.highpass is not None or self.lowpass is not None
+
+    def params(self):
+        """
+        Parameters as a dict for JSON, from which PreFilter(**params) makes the same filter
+        """
+        return {'highpass': self.highpass, 'lowpass': self.lowpass, 'taper': self.taper}
+
+    def reduced(self, reduce):
+        """
+        The same filter for images at 1/reduce of the resolution
+        """
+        highpass, lowpass = [None if sigma is None else sigma / float(reduce)
+                             for sigma in (self.highpass, self.lowpass)]
+        return PreFilter(highpass, lowpass, self.taper)
+
+    def window(self, nsamples, dtype=np.float64):
+        """
+        Taper of stripes of nsamples points, or None without one
+        """
+        if self.taper == 'none':
+            return None
+        if self.taper == 'hann':
+            window = np.hanning(nsamples)
+        else:
+            from scipy.signal import windows
+            window = windows.tukey(nsamples, TUKEY_FRACTION)
+        return window.astype(dtype)
+
+    def gain(self, nfft, dtype=np.float64):
+        """
+        Gain of the cross-spectrum at each frequency of a real FFT of nfft points, or None
+        without spectral filtering
+        """
+        if not self.spectral:
+            return None
+        # Gaussian of standard deviation sigma pixels: exp(-2 pi^2 sigma^2 f^2)
+        exponent = -2 * (np.pi * sp_fft.rfftfreq(nfft)) ** 2
+        gain = np.ones(nfft // 2 + 1)
+        if self.highpass is not None:
+            gain -= np.exp(exponent * self.highpass ** 2)
+        if self.lowpass is not None:
+            gain *= np.exp(exponent * self.lowpass ** 2)
+        # both stripes are filtered
+        return (gain * gain).astype(dtype)
+
+
+def correlate_spectra(spectrum_a, spectrum_b, nsamples, nfft, mode=DEF_MODE, gain=None):
+    """
+    Full cross-correlation of stripes of nsamples points from their stripe_spectra
+
+    :param mode: 'cross', or 'phase' for phase correlation
+    :param gain: optional PreFilter.gain multiplying the cross-spectrum
+    """
+    product = spectrum_a * np.conj(spectrum_b)
+    if mode == 'phase':
+        whiten(product)
+    if gain is not None:
+        product *= gain
+    return circular_to_full(sp_fft.irfft(product, nfft, axis=-1, workers=-1), nsamples)
+
+
+def zncc_max_lag(nsamples):
+    """
+    Largest lag of the zero-normalised cross-correlation, at which the stripes still overlap
+    by half their length; over fewer points the normalised values are too noisy to compare
+    """
+    return nsamples // 2
+
+
+class ZnccNormaliser(object):
+    """
+    Turns full cross-correlations of stripes into zero-normalised cross-correlations
+
+    At every lag the correlation is normalised by the mean and standard deviation of the
+    two stripes over just the points where they overlap, so a brightness trend along a
+    stripe no longer pulls the peak towards zero lag. The overlap sums come from running
+    (cumulative) sums of the stripes and their squares, read at both ends of every overlap,
+    so the cost does not grow with the number of lags. Work arrays are allocated once.
+
+    :param n_stripes: number of stripes correlated at a time
+    :param nsamples: points per stripe
+    :param dtype: floating point type of the stripes and correlation
+    """
+
+    def __init__(self, n_stripes, nsamples, dtype=np.float64):
+        self.nsamples = nsamples
+        lag = np.arange(1 - nsamples, nsamples)
+        count = nsamples - np.abs(lag)
+        # the points of stripe a (b) at lag L are a[L:] and b[:n-L] for L >= 0, a[:n+L] and b[-L:] otherwise,
+        # so their sums are cumulative[hi] - cumulative[lo]
+        self._hi = (np.where(lag >= 0, nsamples, nsamples + lag), np.where(lag >= 0, nsamples - lag, nsamples))
+        self._lo = (np.where(lag >= 0, lag, 0), np.where(lag >= 0, 0, -lag))
+        # one row per stripe, as multiplying by a broadcast row allocates iteration buffers
+        self._inverse_count = np.tile(1.0 / count, (n_stripes, 1)).astype(dtype)
+        self._cumulative = np.zeros((n_stripes, nsamples + 1), dtype=dtype)
+        self._values = np.empty((n_stripes, nsamples), dtype=dtype)
+        self._sums = np.empty((2, n_stripes, 2 * nsamples - 1), dtype=dtype)
+        self._variances = np.empty((2, n_stripes, 2 * nsamples - 1), dtype=dtype)
+        self._scratch = np.empty((n_stripes, 2 * nsamples - 1), dtype=dtype)
+
+    def _overlap_sum(self, k, out):
+        np.cumsum(self._values, axis=1, out=self._cumulative[:, 1:])
+        # the indices are in range; mode='raise' would buffer the output
+        np.take(self._cumulative, self._hi[k], axis=1, out=out, mode='clip')
+        np.take(self._cumulative, self._lo[k], axis=1, out=self._scratch, mode='clip')
+        out -= self._scratch
+
+    def __call__(self, xcorr, stripes_a, stripes_b):
+        """
+        Normalise the full cross-correlation xcorr of stripes_a and stripes_b in place
+
+        :return: xcorr, with values between -1 and 1 and -inf where it was -inf
+        """
+        for k, stripes in enumerate((stripes_a, stripes_b)):
+            # a contiguous copy, as ufuncs on strided views allocate iteration buffers
+            np.copyto(self._values, stripes)
+            self._overlap_sum(k, self._sums[k])
+            np.multiply(self._values, self._values, out=self._values)
+            self._overlap_sum(k, self._variances[k])
+            # overlap sum of squared deviations from the overlap mean
+            np.multiply(self._sums[k], self._sums[k], out=self._scratch)
+            self._scratch *= self._inverse_count
+            self._variances[k] -= self._scratch
+        np.multiply(self._sums[0], self._sums[1], out=self._scratch)
+        self._scratch *= self._inverse_count
+        xcorr -= self._scratch
+        variances = self._variances[0]
+        variances *= self._variances[1]
+        np.maximum(variances, np.finfo(variances.dtype).tiny, out=variances)
+        np.sqrt(variances, out=variances)
+        xcorr /= variances
+        return xcorr
+
+
+def masked_correlate(stripes_a, stripes_b, valid_a, valid_b):
+    """
+    Normalised cross-correlation of stripes over just the points that neither mask leaves out
+
+    At every lag the stripes are normalised by their mean and standard deviation over the
+    unmasked points where they overlap, as ZnccNormaliser does for unmasked stripes, whose
+    result this gives for masks without excluded points. The overlap count and sums are
+    correlations of the masks with the masked stripes and their squares, so all six of
+    them come from one batched forward and one batched inverse real FFT. Lags at which the
+    stripes share fewer than MASK_MIN_OVERLAP of the unmasked points of the sparser stripe
+    are set to -inf, as are all lags of stripes with fewer than two unmasked points.
+
+    :param stripes_a: 2D array, one stripe per row; values at masked points are ignored
+    :param stripes_b: 2D array with the same shape as stripes_a
+    :param valid_a: boolean array of the same shape, True at the points of stripes_a to use
+    :param valid_b: boolean array for stripes_b
+    :return: xcorr : 2D array with lags 1-n .. n-1 along the rows
+    """
+    n_stripes, nsamples = stripes_a.shape
+    nfft = fft_length(nsamples)
+    dtype = stripes_a.dtype
+    # masked values, their squares and the mask of each stripe array; where() also drops
+    # NaN left at masked points by the normalization of stripes without unmasked points
+    terms = np.empty((6, n_stripes, nsamples), dtype=dtype)
+    for k, (stripes, valid) in enumerate(((stripes_a, valid_a), (stripes_b, valid_b))):
+        np.copyto(terms[3 * k], np.where(valid, stripes, 0))
+        np.multiply(terms[3 * k], terms[3 * k], out=terms[3 * k + 1])
+        np.copyto(terms[3 * k + 2], valid)
+    spectra = stripe_spectra(terms, nfft)
+    np.conjugate(spectra[3:], out=spectra[3:])
+    # products: a.b, a^2.mask_b, mask_a.b^2, a.mask_b, mask_a.b, mask_a.mask_b
+    products = np.empty_like(spectra)
+    for k, (i, j) in enumerate(((0, 3), (1, 5), (2, 4), (0, 5), (2, 3), (2, 5))):
+        np.multiply(spectra[i], spectra[j], out=products[k])
+    correlation, square_a, square_b, sum_a, sum_b, count = circular_to_full(
+        sp_fft.irfft(products, nfft, axis=-1, workers=-1), nsamples)
+    # the counts are whole numbers up to rounding errors of the transforms
+    np.rint(count, out=count)
+    overlap = np.maximum(count, 1)
+    correlation -= sum_a * sum_b / overlap
+    square_a -= sum_a * sum_a / overlap
+    square_b -= sum_b * sum_b / overlap
+    variances = square_a * square_b
+    np.maximum(variances, np.finfo(dtype).tiny, out=variances)
+    correlation /= np.sqrt(variances)
+    n_valid = np.minimum(np.count_nonzero(valid_a, axis=1), np.count_nonzero(valid_b, axis=1))
+    min_count = np.maximum(MASK_MIN_OVERLAP * n_valid, 2)[:, np.newaxis]
+    correlation[count < min_count] = -np.inf
+    return correlation
+
+
+def peak_shift(xcorr, nsamples):
+    """
+    Displacement at the correlation peak of each row of a full cross-correlation
+    """
+    # lags run from 1-nsamples to nsamples-1 along each row
+    return (nsamples - 1 - xcorr.argmax(axis=-1)).astype(float)
+
+
+@register_backend('scipy_fft')
+def scipy_fft_correlate(stripes_a, stripes_b, max_lag):
+    """
+    All stripes in one batched real FFT with scipy.fft, which keeps the input precision
+    and can spread the batch over several threads
+    """
+    nsamples = stripes_a.shape[1]
+    nfft = fft_length(nsamples)
+    return correlate_spectra(stripe_spectra(stripes_a, nfft), stripe_spectra(stripes_b, nfft), nsamples, nfft)
+
+
+# kernel compiled by _numba_kernel on first use
+_numba_windowed_kernel = None
+
+
+def _numba_kernel():
+    """
+    Compile the windowed direct kernel; it only evaluates the lags within max_lag, which
+    beats the FFT when the expected displacement is small. numba is only imported here,
+    as importing it takes longer than the rest of the package.
+    """
+    global _numba_windowed_kernel
+    if _numba_windowed_kernel is not None:
+        return _numba_windowed_kernel
+    import numba
+
+    # serial: numba's TBB thread pool hangs the interpreter at exit once it has been started
+    # from a worker thread or before a fork, e.g. of a ProcessPoolExecutor of aio, and pairs
+    # are already analysed in parallel there
+    @numba.njit(cache=True)
+    def windowed_kernel(stripes_a, stripes_b, max_lag, xcorr):
+        n_stripes, nsamples = stripes_a.shape
+        for i in range(n_stripes):
+            for k in range(nsamples - 1 - max_lag, nsamples + max_lag):
+                lag = k - (nsamples - 1)
+                total = 0.0
+                for m in range(max(0, -lag), min(nsamples, nsamples - lag)):
+                    total += stripes_a[i, m + lag] * stripes_b[i, m]
+                xcorr[i, k] = total
+
+    _numba_windowed_kernel = windowed_kernel
+    return windowed_kernel
+
+
+def numba_correlate(stripes_a, stripes_b, max_lag):
+    """
+    Direct sums over the lags within max_lag only, compiled with numba on the first call
+    """
+    nsamples = stripes_a.shape[1]
+    xcorr = np.full((stripes_a.shape[0], 2 * nsamples - 1), -np.inf,
+                    dtype=np.result_type(stripes_a, stripes_b))
+    _numba_kernel()(np.ascontiguousarray(stripes_a), np.ascontiguousarray(stripes_b), max_lag, xcorr)
+    return xcorr
+
+
+# registered if numba is installed, without importing it
+if importlib.util.find_spec('numba') is not None:
+    register_backend('numba', numba_correlate)
+
+
+def cache_path():
+    """
+    Location of the on-disk auto-tuning cache; set PIV_CACHE_DIR to move it.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV,
+                               os.path.join(os.path.expanduser('~'), '.cache', 'che696_proj_yufei'))
+    return os.path.join(cache_dir, CACHE_FILE_NAME)
+
+
+def _tuning_key(width, n_stripes, dtype):
+    return '{},{},{}'.format(width, n_stripes, np.dtype(dtype).name)
+
+
+def _read_cache():
+    try:
+        with open(cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache):
+    # the cache only saves time, so a read-only or full disk is not an error
+    path = cache_path()
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def autotune(width, n_stripes, dtype=np.float64, repeat=3):
+    """
+    Time every registered backend on random stripes of the given batch shape
+
+    :param width: number of points in each stripe
+    :param n_stripes: number of stripes correlated per image pair
+    :param dtype: floating point type of the stripes
+    :param repeat: timed runs per backend; the best run counts
+    :return: name of the fastest backend, dict of best times in seconds
+    """
+    rng = np.random.RandomState(0)
+    stripes_a = rng.standard_normal((n_stripes, width)).astype(dtype)
+    stripes_b = rng.standard_normal((n_stripes, width)).astype(dtype)
+    max_lag = width - 1
+    timings = {}
+    for name, func in BACKENDS.items():
+        # the first call pays for JIT compilation and FFT plan setup
+        func(stripes_a, stripes_b, max_lag)
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(stripes_a, stripes_b, max_lag)
+            best = min(best, time.perf_counter() - start)
+            # no point in repeating a backend that is already far behind
+            if timings and best > 10 * min(timings.values()):
+                break
+        timings[name] = best
+    return min(timings, key=timings.get), timings
+
+
+def select_backend(width, n_stripes, dtype=np.float64):
+    """
+    Fastest backend for this batch shape, tuning and caching it on disk on first use
+    """
+    key = _tuning_key(width, n_stripes, dtype)
+    if key in _tuned_backends:
+        return _tuned_backends[key]
+    cache = _read_cache()
+    name = cache.get(key)
+    if name not in BACKENDS:
+        name = autotune(width, n_stripes, dtype)[0]
+        cache[key] = name
+        _write_cache(cache)
+    _tuned_backends[key] = name
+    return name
+
+
+def check_prefilter(mode, prefilter):
+    """
+    Raise ValueError for an unknown mode, or a spectral filter with zncc, whose overlap
+    statistics come from the unfiltered stripes
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown correlation mode '{}', choose from {}".format(mode, ', '.join(MODES)))
+    if mode == 'zncc' and prefilter is not None and prefilter.spectral:
+        raise ValueError("High-pass and low-pass filters do not apply to zncc correlation; use a taper")
+
+
+def check_mask(mode, prefilter):
+    """
+    Raise ValueError for a mode or filter the masked correlation does not support: phase
+    correlation, whose whitening mixes masked and unmasked points, and spectral filters
+    """
+    check_prefilter(mode, prefilter)
+    if mode == 'phase':
+        raise ValueError("Phase correlation cannot be masked; use 'cross' or 'zncc'")
+    if prefilter is not None and prefilter.spectral:
+        raise ValueError("High-pass and low-pass filters do not apply to masked correlation; use a taper")
+
+
+def correlate_stripes(stripes_a, stripes_b, backend=DEF_BACKEND, max_lag=None, mode=DEF_MODE, prefilter=None,
+                      mask=None):
+    """
+    Full cross-correlation of matching rows of two stripe arrays
+
+    :param stripes_a: 2D array, one stripe per row
+    :param stripes_b: 2D array with the same shape as stripes_a
+    :param backend: name of a registered backend, or 'auto' to use the tuned choice; phase
+                    correlation and spectral filters always use scipy.fft
+    :param max_lag: largest |lag| of interest; correlation values beyond it are set to -inf
+    :param mode: 'cross', 'phase' or 'zncc' (see MODES); zncc searches lags up to zncc_max_lag
+    :param prefilter: optional PreFilter; spectral filters cannot be combined with zncc
+    :param mask: optional boolean array of the shape of the stripes, True at points left out of
+                 both stripes; 'cross' and 'zncc' then both give masked_correlate, and the
+                 backend is not used
+    :return: xcorr : 2D array with lags 1-n .. n-1 along the rows
+    """
+    n_stripes, nsamples = stripes_a.shape
+    if mask is None:
+        check_prefilter(mode, prefilter)
+    else:
+        check_mask(mode, prefilter)
+    if max_lag is None or max_lag > nsamples - 1:
+        max_lag = nsamples - 1
+    if mode == 'zncc':
+        max_lag = min(max_lag, zncc_max_lag(nsamples))
+    gain = None
+    if prefilter is not None:
+        window = prefilter.window(nsamples, stripes_a.dtype)
+        if window is not None:
+            stripes_a = stripes_a * window
+            stripes_b = stripes_b * window
+        gain = prefilter.gain(fft_length(nsamples), stripes_a.dtype)
+    if mask is not None:
+        valid = np.logical_not(mask)
+        xcorr = masked_correlate(stripes_a, stripes_b, valid, valid)
+    elif mode == 'phase' or gain is not None:
+        nfft = fft_length(nsamples)
+        xcorr = correlate_spectra(stripe_spectra(stripes_a, nfft), stripe_spectra(stripes_b, nfft), nsamples, nfft,
+                                  mode=mode, gain=gain)
+    else:
+        if backend == 'auto':
+            backend = select_backend(nsamples, n_stripes, stripes_a.dtype)
+        try:
+            func = BACKENDS[backend]
+        except KeyError:
+            raise ValueError("Unknown correlation backend '{}', choose from {}".format(
+                backend, ', '.join(sorted(BACKENDS))))
+        xcorr = func(stripes_a, stripes_b, max_lag)
+    if mode == 'zncc' and mask is None:
+        ZnccNormaliser(n_stripes, nsamples, xcorr.dtype)(xcorr, stripes_a, stripes_b)
+    if max_lag < nsamples - 1:
+        xcorr[:, :nsamples - 1 - max_lag] = -np.inf
+        xcorr[:, nsamples + max_lag:] = -np.inf
+    return xcorr
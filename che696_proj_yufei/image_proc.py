@@ -13,7 +13,11 @@ import argparse
 import numpy as np
 from PIL import Image
 import os
-import matplotlib.pyplot as plt
+from .calibration import Calibration
+from .background import (Background, BACKGROUND_METHODS, BACKGROUND_LEVELS, DEF_BACKGROUND_WINDOW,
+                         DEF_BACKGROUND_LEVEL)
+from .correlation import (BACKENDS, DEF_BACKEND, MODES, DEF_MODE, TAPERS, DEF_TAPER, PreFilter, check_prefilter,
+                          check_mask, correlate_stripes, peak_shift)
 
 SUCCESS = 0
 INVALID_DATA = 1
@@ -24,6 +28,15 @@ DEF_IMAGE_NAME_A = 'sample_im1.bmp'
 
 DEF_IMAGE_NAME_B = 'sample_im2.bmp'
 
+# floating point type of the stripes, spectra and correlation buffers
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+DEF_PRECISION = 'double'
+
+# PIL modes whose pixel values are used without conversion; other images are decoded to luminance
+GRAY_MODES = ('L', 'I', 'I;16', 'I;16B', 'F')
+# quick-look resolution reductions; a JPEG decoder scales by these while decoding
+QUICK_LOOK_FACTORS = (2, 4, 8)
+
 def warning(*objs):
     """Writes a message to stderr."""
     print("WARNING: ", *objs, file=sys.stderr)
@@ -36,31 +49,127 @@ def plot_piv(base_f_name, piv_results):
     :param piv_results: piv results, numpy array, with shape (y_position, displacement)
     :return: save a png file
     """
-    plt.plot(piv_results[:,0], piv_results[:,1], 'bs')
-    plt.title('PIV results')
-    plt.xlabel('Y position (pixel)')
-    plt.ylabel('Displacement (pixel)')
     out_name = base_f_name + '.png'
-    plt.savefig(out_name)
+    save_plot(out_name, piv_results)
     print("Wrote file: {}".format(out_name))
 
-def load_image( infilename ) :
+def save_plot(out_name, piv_results):
+    """
+    Plot the PIV results into a new figure and save it as out_name
+
+    Matplotlib is only imported here, and pyplot's global figure is not used, so plots can
+    be made from several threads of a long-running process.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    if piv_results.shape[1] == 2:
+        axes.plot(piv_results[:,0], piv_results[:,1], 'bs')
+    else:
+        # one profile per column window
+        axes.plot(piv_results[:,0], piv_results[:,1:], 's-')
+    axes.set_title('PIV results')
+    axes.set_xlabel('Y position (pixel)')
+    axes.set_ylabel('Displacement (pixel)')
+    figure.savefig(out_name)
+
+def image_array(img, reduce=1):
+    """
+    Pixels of an opened PIL image as a 2D int32 Numpy array
+
+    Colour images are converted to luminance ('L'). A JPEG is decoded straight to luminance
+    and, with reduce > 1, scaled down by its decoder (draft mode), which skips most of the
+    decoding work; the decoder scales by 1/2, 1/4 or 1/8, so it is asked for the largest of
+    these that divides reduce. Other images, and what the decoder leaves, are reduced by
+    averaging blocks of pixels.
+
+    :param img: PIL image, not yet loaded so that draft mode can apply
+    :param reduce: integer factor by which both dimensions are reduced
+    :return: image_data : image in the form of Numpy array
+    """
+    width = img.size[0]
+    if img.format == 'JPEG' and (reduce > 1 or img.mode not in GRAY_MODES):
+        # largest power of two dividing reduce, at most 8
+        scale = min(reduce & -reduce, 8)
+        img.draft('L', (-(-img.size[0] // scale), -(-img.size[1] // scale)))
+    if img.mode not in GRAY_MODES:
+        img = img.convert('L')
+    # what the JPEG decoder did not reduce
+    reduce //= int(round(float(width) / img.size[0]))
+    if reduce > 1:
+        if img.mode.startswith('I;16'):
+            img = img.convert('I')
+        img = img.reduce(reduce)
+    return np.asarray(img, dtype="int32")
+
+def load_image( infilename, reduce=1, calibration=None ) :
     """
     Load image into Numpy array
 
     :param infilename: input file name
+    :param reduce: optional factor by which to reduce the resolution (see image_array)
+    :param calibration: optional Calibration (for the reduced resolution) by which the image
+                        is rotated and dewarped as soon as it is decoded
     :return: image_data : image in the form of Numpy array
     """
     try:
-        img = Image.open( infilename )
-        img.load()
-        image_data = np.asarray( img, dtype="int32" )
+        with Image.open( infilename ) as img:
+            image_data = image_array(img, reduce)
+        if calibration is not None:
+            image_data = calibration.apply(image_data)
     except OSError as e:
         warning("Read invalid image:", e)
         return None, e
+    except ValueError as e:
+        warning("Cannot correct image:", e)
+        return None, e
     return image_data, SUCCESS
 
-def divid_image(image, division_pixel):
+def load_mask(infilename):
+    """
+    Load a mask image, whose nonzero (e.g. white) pixels mark what to leave out of the analysis
+
+    :return: mask : boolean 2D Numpy array, True at masked pixels; or None and the error
+    """
+    mask, ret = load_image(infilename)
+    if ret != SUCCESS:
+        return None, ret
+    return mask != 0, SUCCESS
+
+def reduce_mask(mask, reduce):
+    """
+    Mask of images reduced by image_array: a reduced pixel is masked if any of its block is
+    """
+    height, width = -(-mask.shape[0] // reduce), -(-mask.shape[1] // reduce)
+    padded = np.zeros((height * reduce, width * reduce), dtype=bool)
+    padded[:mask.shape[0], :mask.shape[1]] = mask
+    return padded.reshape(height, reduce, width, reduce).any(axis=(1, 3))
+
+def stripe_bounds(height, division_pixel):
+    """
+    First row of every stripe of divid_image, followed by the row after the last stripe
+    """
+    index_divid = np.arange(0, height-1, division_pixel)
+    if index_divid[-1] != height - 1:
+        index_divid = np.append(index_divid, height - 1)
+    return index_divid
+
+def stripe_mask(mask, division_pixel):
+    """
+    Points of the stripe profiles of divid_image that a pixel mask leaves out entirely
+
+    :param mask: boolean 2D Numpy array with the image shape, True at pixels to leave out
+    :param division_pixel: height of individual stripes (unit, pixels)
+    :return: boolean array (stripe, x), True where every pixel of the stripe in that column
+             is masked
+    """
+    index_divid = stripe_bounds(mask.shape[0], division_pixel)
+    valid_rows = np.add.reduceat(np.logical_not(mask[:index_divid[-1]]), index_divid[:-1], axis=0, dtype=np.intp)
+    return valid_rows == 0
+
+def divid_image(image, division_pixel, precision=DEF_PRECISION, mask=None):
     """
     Cut a image into horizontal stripes and compress them into 1D brighness fluctuation profile
     
@@ -68,52 +177,125 @@ def divid_image(image, division_pixel):
     ------------
     image : image as a 2D Numpy array
     division_pixel : height of individual stripes (unit, pixels)
+    precision : 'double' or 'single', floating point type of the stripes
+    mask : optional boolean 2D Numpy array with the image shape, True at pixels (a static
+           obstacle, dead pixels) to leave out; every profile point is then the mean of the
+           unmasked pixels of its column, and points without any are 0 (see stripe_mask)
 
     Returns
     ------------
     image_segments : a list a image segments
     y_position : position of image stripes
     """
+    dtype = PRECISIONS[precision]
     height = image.shape[0]
-    index_divid = np.arange(0, height-1, division_pixel)
+    index_divid = stripe_bounds(height, division_pixel)
+    if mask is not None:
+        return _divid_masked(image, index_divid, dtype, mask)
     image_segments = []
     y_position = []
-    if index_divid[-1] != height - 1:
-        index_divid = np.append(index_divid, height - 1)
 
     num_stripes = index_divid.size - 1
     for i in range(num_stripes):
         index_a = index_divid[i]
         index_b = index_divid[i + 1]
         y_position.append((index_a + index_b)/2.0)
-        stripe = np.mean(image[index_a:index_b, :], axis=0)
+        stripe = np.mean(image[index_a:index_b, :], axis=0, dtype=dtype)
         stripe -= stripe.mean(); stripe /= stripe.std()
         image_segments.append(stripe)
     return image_segments, y_position
 
-def x_corr(image_a_segments, image_b_segments):
+def _divid_masked(image, index_divid, dtype, mask):
+    # masked sums of all stripes at once, then the normalization of divid_image over the
+    # points that have unmasked pixels
+    valid = np.logical_not(mask[:index_divid[-1]])
+    starts = index_divid[:-1]
+    sums = np.add.reduceat(np.where(valid, image[:index_divid[-1]], 0), starts, axis=0, dtype=dtype)
+    counts = np.add.reduceat(valid, starts, axis=0, dtype=dtype)
+    used = counts > 0
+    stripes = np.divide(sums, counts, out=np.zeros_like(sums), where=used)
+    n_used = np.maximum(np.count_nonzero(used, axis=1), 1)[:, np.newaxis]
+    stripes -= stripes.sum(axis=1, keepdims=True) / n_used
+    stripes[~used] = 0
+    # stripes without unmasked pixels become NaN, which x_corr reports as such
+    with np.errstate(invalid='ignore'):
+        stripes /= np.sqrt((stripes * stripes).sum(axis=1, keepdims=True) / n_used)
+    y_position = (index_divid[:-1] + index_divid[1:]) / 2.0
+    return list(stripes), list(y_position)
+
+def column_positions(width, n_columns):
+    """
+    Width of each of n_columns column windows across an image, and their centres
+
+    The width//n_columns pixels of every window start at the left edge; the remaining
+    columns at the right edge are not used.
+    """
+    column_width = width // n_columns
+    return column_width, np.arange(n_columns) * column_width + (column_width - 1) / 2.0
+
+def divid_columns(image, division_pixel, n_columns, precision=DEF_PRECISION, mask=None):
+    """
+    Cut a image into horizontal stripes as divid_image, and each stripe into n_columns column
+    windows with their own brightness fluctuation profile
+
+    Parameters
+    ------------
+    image : image as a 2D Numpy array
+    division_pixel : height of individual stripes (unit, pixels)
+    n_columns : number of column windows per stripe
+    precision : 'double' or 'single', floating point type of the stripes
+    mask : optional boolean pixel mask, as for divid_image
+
+    Returns
+    ------------
+    image_segments : 3D array (stripe, column window, x) of normalized profiles
+    y_position : position of image stripes
+    """
+    image_segments, y_position = divid_image(image, division_pixel, precision=precision, mask=mask)
+    column_width = column_positions(image.shape[1], n_columns)[0]
+    image_segments = np.asarray(image_segments)[:, :n_columns * column_width]
+    image_segments = image_segments.reshape(len(y_position), n_columns, column_width)
+    # normalizing the stripe first does not change the normalized windows
+    image_segments -= image_segments.mean(axis=2, keepdims=True)
+    image_segments /= image_segments.std(axis=2, keepdims=True)
+    return image_segments, y_position
+
+def x_corr(image_a_segments, image_b_segments, backend=DEF_BACKEND, max_lag=None, precision=DEF_PRECISION,
+           mode=DEF_MODE, prefilter=None, mask=None):
     """
     Calculate the displacement profile.
 
     :param image_a_segments: Horizontal stripes from image 1
     :param image_b_segments: Horizontal stripes from image 2
+    :param backend: name of the correlation backend, or 'auto' to pick the fastest one
+    :param max_lag: optional largest displacement (pixels) to search for
+    :param precision: 'double' or 'single', floating point type of the correlation
+    :param mode: 'cross' correlation, 'phase' correlation or zero-normalised cross-correlation
+                 'zncc', which is not misled by uneven illumination along the stripes
+    :param prefilter: optional PreFilter (band-pass and taper) applied within the correlation
+    :param mask: optional stripe_mask of the stripes, True at points left out of both stripes;
+                 the stripes are then correlated with masked normalised correlation (in
+                 'cross' or 'zncc' mode), and the shift is NaN for stripes with too few
+                 unmasked points
     :return: shift : displacement profile
     """
     import warnings
     warnings.filterwarnings("ignore")
-    from scipy.signal import correlate
-    shift = np.zeros(len(image_a_segments))
-    for i in range(len(image_a_segments)):
-        y1 = image_a_segments[i]
-        y2 = image_b_segments[i]
-        nsamples = y1.shape[0]
-        xcorr = correlate(y1, y2)
-        d_shift = np.arange(1-nsamples, nsamples)
-        shift[i] = -d_shift[xcorr.argmax()]
+    if len(image_a_segments) == 0:
+        return np.zeros(0)
+    dtype = PRECISIONS[precision]
+    stripes_a = np.asarray(image_a_segments, dtype=dtype)
+    stripes_b = np.asarray(image_b_segments, dtype=dtype)
+    xcorr = correlate_stripes(stripes_a, stripes_b, backend=backend, max_lag=max_lag, mode=mode, prefilter=prefilter,
+                              mask=mask)
+    shift = peak_shift(xcorr, stripes_a.shape[1])
+    if mask is not None:
+        shift[np.isneginf(xcorr.max(axis=1))] = np.nan
     return shift
 
 
-def piv_analysis(image_a_path, image_b_path, division_pixel):
+def piv_analysis(image_a_path, image_b_path, division_pixel, backend=DEF_BACKEND, precision=DEF_PRECISION,
+                 reduce=1, n_columns=1, mode=DEF_MODE, prefilter=None, mask=None, calibration=None):
     """
     Calculate the 1D velocity profile based on a pair of images.
     Horizontal direction: flow direction.
@@ -126,22 +308,87 @@ def piv_analysis(image_a_path, image_b_path, division_pixel):
     image_a_path : path of image 1
     image_b_path : path of image 2
     division_pixel : Thickness (number of pixels) of horizontal stripes
+    backend : correlation backend passed on to x_corr
+    precision : 'double' or 'single'; single halves the memory traffic and FFT cost,
+                which does not change the location of the correlation peak
+    reduce : quick-look factor; analyse the images at 1/reduce of their resolution, in
+             stripes of division_pixel // reduce reduced pixels, for a coarse profile
+    n_columns : number of column windows every stripe is split into (see divid_columns)
+    mode : 'cross', 'phase' or 'zncc' correlation, see x_corr
+    prefilter : optional PreFilter, see x_corr; its filter widths are in full resolution pixels
+    mask : optional boolean array of the full resolution image shape, True at pixels to leave
+           out, e.g. from load_mask
+    calibration : optional Calibration by which the images (and the mask) are rotated and
+                  dewarped as they are loaded, so that the flow runs along x
 
     Returns
     -------
-    piv_result : displacement profile (column 2) versus y position (column 1)
+    piv_result : displacement profile (column 2) versus y position (column 1), both in
+                 pixels of the full resolution images (of the corrected images with a
+                 calibration); with n_columns > 1, the profile of each column window from
+                 left to right in columns 2 to n_columns + 1
     """
-    image_a, ret_a = load_image(image_a_path)
-    image_b, ret_b = load_image(image_b_path)
+    if reduce > 1 and calibration is not None:
+        calibration = calibration.reduced(reduce)
+    image_a, ret_a = load_image(image_a_path, reduce, calibration)
+    image_b, ret_b = load_image(image_b_path, reduce, calibration)
     if (ret_a!=SUCCESS) or (ret_b!=SUCCESS):
         return IO_ERROR
+    if mask is not None and reduce > 1:
+        mask = reduce_mask(mask, reduce)
+    if mask is not None and calibration is not None:
+        # every corrected pixel that draws on a masked pixel is masked
+        mask = calibration.apply(mask) > 0
+    if reduce == 1:
+        return analyse_images(image_a, image_b, division_pixel, backend=backend, precision=precision,
+                              n_columns=n_columns, mode=mode, prefilter=prefilter, mask=mask)
+    if prefilter is not None:
+        prefilter = prefilter.reduced(reduce)
+    piv_results = analyse_images(image_a, image_b, max(1, division_pixel // reduce), backend=backend,
+                                 precision=precision, n_columns=n_columns, mode=mode, prefilter=prefilter, mask=mask)
+    if isinstance(piv_results, int):
+        return piv_results
+    return piv_results * reduce
+
+def analyse_images(image_a, image_b, division_pixel, backend=DEF_BACKEND, precision=DEF_PRECISION, n_columns=1,
+                   mode=DEF_MODE, prefilter=None, mask=None):
+    """
+    The analysis of piv_analysis for a pair of images already loaded as 2D Numpy arrays
+
+    Returns
+    -------
+    piv_result : displacement profile (column 2) versus y position (column 1), or
+                 INVALID_DATA if the images have different sizes, or a mask another size
+    """
     if not image_a.shape == image_b.shape:
         warning('Image 1 and image 2 have different sizes')
         return INVALID_DATA
-    image_a_segments, y_position = divid_image(image_a, division_pixel)
+    profile_mask = None
+    if mask is not None:
+        if mask.shape != image_a.shape:
+            warning('The mask and the images have different sizes')
+            return INVALID_DATA
+        profile_mask = stripe_mask(mask, division_pixel)
+    if n_columns > 1:
+        if column_positions(image_a.shape[1], n_columns)[0] < 2:
+            warning('Images of width {} cannot be split into {} column windows'.format(image_a.shape[1], n_columns))
+            return INVALID_DATA
+        image_a_segments, y_position = divid_columns(image_a, division_pixel, n_columns, precision=precision,
+                                                     mask=mask)
+        image_b_segments = divid_columns(image_b, division_pixel, n_columns, precision=precision, mask=mask)[0]
+        # all (stripe, column window) profiles in one batch
+        column_width = image_a_segments.shape[2]
+        if profile_mask is not None:
+            profile_mask = profile_mask[:, :n_columns * column_width].reshape(-1, column_width)
+        disp_profile = x_corr(image_a_segments.reshape(-1, column_width),
+                              image_b_segments.reshape(-1, column_width), backend=backend, precision=precision,
+                              mode=mode, prefilter=prefilter, mask=profile_mask)
+        return np.column_stack((y_position, disp_profile.reshape(len(y_position), n_columns)))
+    image_a_segments, y_position = divid_image(image_a, division_pixel, precision=precision, mask=mask)
     y_position = np.asarray(y_position)
-    image_b_segments = divid_image(image_b, division_pixel)[0]
-    disp_profile = x_corr(image_a_segments, image_b_segments)
+    image_b_segments = divid_image(image_b, division_pixel, precision=precision, mask=mask)[0]
+    disp_profile = x_corr(image_a_segments, image_b_segments, backend=backend, precision=precision, mode=mode,
+                          prefilter=prefilter, mask=profile_mask)
     # print(disp_profile)
     piv_results = np.vstack((y_position, disp_profile))
     return piv_results.T
@@ -166,10 +413,301 @@ def parse_cmdline(argv):
     parser.add_argument("-d", "--division_pixel", type=int,help="Thickness (number of pixels) of horizontal stripes",
                         default=5)
 
+    parser.add_argument("-b", "--backend", help="Cross-correlation backend; 'auto' benchmarks the available "
+                                                "backends once per stripe size and caches the fastest",
+                        choices=[DEF_BACKEND] + sorted(BACKENDS), default=DEF_BACKEND)
+
+    parser.add_argument("-p", "--precision", help="Floating point precision of the stripes and correlation",
+                        choices=sorted(PRECISIONS), default=DEF_PRECISION)
+
+    parser.add_argument("--quick_look", type=int, help="For a pair, analyse the images at 1/QUICK_LOOK of their "
+                                                       "resolution for a coarse profile; JPEG images are reduced "
+                                                       "while they are decoded", choices=QUICK_LOOK_FACTORS)
+
+    parser.add_argument("--columns", type=int, help="For a pair, split every stripe into this many column windows "
+                                                    "and write the profile of each of them", default=1)
+
+    parser.add_argument("--windows", type=int, metavar="SIZE",
+                        help="For a pair, instead find both displacement components on a grid of SIZE x SIZE "
+                             "pixel interrogation windows")
+
+    parser.add_argument("--overlap", type=float, help="With --windows, fraction by which neighbouring windows "
+                                                      "overlap", default=0.5)
+
+    parser.add_argument("--mode", help="Correlation of the stripes: plain 'cross' correlation, 'phase' correlation "
+                                       "or zero-normalised 'zncc', which copes with uneven illumination (not with "
+                                       "--lag_sweep or --windows, which use 'cross' without filters)",
+                        choices=MODES, default=DEF_MODE)
+
+    parser.add_argument("--highpass", type=float, metavar="SIGMA",
+                        help="Gaussian high-pass filter of the stripes within the correlation, which removes "
+                             "background gradients and blobs much larger than SIGMA pixels (not with --lag_sweep "
+                             "or --windows)")
+
+    parser.add_argument("--lowpass", type=float, metavar="SIGMA",
+                        help="Gaussian low-pass filter of the stripes within the correlation, which smooths noise "
+                             "finer than SIGMA pixels; with --highpass, a band-pass filter (not with --lag_sweep "
+                             "or --windows)")
+
+    parser.add_argument("--taper", help="Window function the stripes are multiplied by before they are "
+                                        "correlated, against steps where the zero padding starts (not with "
+                                        "--lag_sweep or --windows)",
+                        choices=TAPERS, default=DEF_TAPER)
+
+    parser.add_argument("--roi", nargs=5, action='append', metavar=("NAME", "TOP", "BOTTOM", "LEFT", "RIGHT"),
+                        help="For a pair, analyse the region of rows TOP to BOTTOM - 1 and columns LEFT to RIGHT - 1 "
+                             "and write its profile to piv_results_<a>_<b>_NAME.csv; repeat for several regions, "
+                             "which share one decode of each image and one batched correlation")
+
+    parser.add_argument("--mask", help="For a pair, image of the same size whose nonzero pixels (a static obstacle, "
+                                       "dead pixels) are left out of the stripes, which are then correlated with "
+                                       "masked normalised correlation ('cross' or 'zncc' mode, no spectral filters)")
+
+    parser.add_argument("--calibration", dest="calibration_file", metavar="FILE",
+                        help="JSON file of the camera tilt and lens distortion, e.g. {\"angle\": 2.5, \"k1\": -0.04}, "
+                             "by which every frame is rotated and dewarped as it is loaded, so that the flow runs "
+                             "along x (not with --windows, --queue or the server)")
+
+    parser.add_argument("--background", dest="background_method", choices=BACKGROUND_METHODS,
+                        help="In sequence, watch and raw stream mode, subtract the running mean or minimum of the "
+                             "most recent frames, against static scratches and reflections")
+
+    parser.add_argument("--background_window", type=int, help="With --background, number of frames the "
+                                                              "background is estimated from",
+                        default=DEF_BACKGROUND_WINDOW)
+
+    parser.add_argument("--background_level", help="With --background, keep the background of whole frames, or "
+                                                   "of the stripe profiles, which needs far less memory",
+                        choices=BACKGROUND_LEVELS, default=DEF_BACKGROUND_LEVEL)
+
+    parser.add_argument("-s", "--sequence", help="Image files of a sequence in time order, where multi-page TIFF "
+                                                 "and GIF files give all their pages; all consecutive pairs are "
+                                                 "analysed into a binary result store", nargs='+')
+
+    parser.add_argument("-o", "--store", help="In sequence mode, directory of the result store (default: "
+                                              "piv_results_<first>_<last>.pivstore)")
+
+    parser.add_argument("--csv", help="In sequence mode, also export every pair as a .csv file",
+                        action='store_true')
+
+    parser.add_argument("-c", "--catalogue", help="In sequence mode, add the run to this SQLite catalogue of "
+                                                  "result stores")
+
+    parser.add_argument("--stats", help="In sequence and watch mode, keep running per-stripe statistics of the "
+                                        "displacement and write them to <output>_stats.csv and "
+                                        "<output>_stats_hist.csv", action='store_true')
+
+    parser.add_argument("--stats_every", type=int, help="With --stats, also write the statistics after every "
+                                                        "this many pairs", default=100)
+
+    parser.add_argument("--fit", help="In sequence and watch mode, fit a straight line to every profile and "
+                                      "write the shear rate, intercept (slip at the static wall) and fit residual "
+                                      "of each pair to <output>_fit.csv", action='store_true')
+
+    parser.add_argument("--fit_range", type=float, nargs=2, metavar=("Y_MIN", "Y_MAX"),
+                        help="With --fit, only fit the stripes between these y positions")
+
+    parser.add_argument("--tolerance", type=float, help="In sequence mode, stop reading frames once the standard "
+                                                        "error of the mean displacement of every stripe is at most "
+                                                        "this many pixels")
+
+    parser.add_argument("--tolerance_range", type=float, nargs=2, metavar=("Y_MIN", "Y_MAX"),
+                        help="With --tolerance, only require the stripes between these y positions to converge")
+
+    parser.add_argument("--min_pairs", type=int, help="With --tolerance, smallest number of pairs to analyse",
+                        default=10)
+
+    parser.add_argument("--export_csv", help="Export every pair of an existing result store as a .csv file",
+                        metavar="STORE")
+
+    parser.add_argument("-l", "--lag_sweep", type=int, help="In sequence mode, instead correlate every frame with "
+                                                            "each of the next LAG_SWEEP frames and write the mean "
+                                                            "profile per lag")
+
+    parser.add_argument("-w", "--watch", help="Watch this directory and analyse every new frame together with "
+                                              "the previous one as soon as it is completely written")
+
+    parser.add_argument("--pattern", help="In watch mode, file name pattern of the frames", default="*.bmp")
+
+    parser.add_argument("--poll_interval", type=float, help="In watch mode, seconds between directory scans when "
+                                                            "inotify is not available", default=0.05)
+
+    parser.add_argument("--latency_budget", type=float, help="In watch mode, warn when a pair takes longer than "
+                                                             "this many seconds", default=0.5)
+
+    parser.add_argument("--max_pairs", type=int, help="In watch and raw stream mode, stop after this many pairs")
+
+    parser.add_argument("--idle_timeout", type=float, help="In watch mode, stop when no new frame arrives for "
+                                                           "this many seconds")
+
+    parser.add_argument("-r", "--raw", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"),
+                        help="Analyse consecutive frames of a stream of raw frames of this size, read from "
+                             "--raw_input, into a result store")
+
+    parser.add_argument("--raw_dtype", help="In raw stream mode, pixel type of the frames, e.g. uint8 or <u2 "
+                                            "for little-endian 16-bit pixels", default='uint8')
+
+    parser.add_argument("--raw_input", help="In raw stream mode, file or named pipe to read the frames from "
+                                            "('-' for stdin)", default='-')
+
+    parser.add_argument("-q", "--queue", help="In sequence mode, instead split the pairs into tasks in this "
+                                              "shared work queue directory, to be analysed by --work processes")
+
+    parser.add_argument("--task_size", type=int, help="With --queue, pairs per task", default=256)
+
+    parser.add_argument("--work", help="Claim and analyse tasks of this work queue until none is left",
+                        metavar="QUEUE")
+
+    parser.add_argument("--claim_timeout", type=float, help="With --work, seconds after which the claim of a "
+                                                            "worker that stopped responding is taken over",
+                        default=300.0)
+
+    parser.add_argument("--merge", help="Assemble the results of a finished work queue into a result store",
+                        metavar="QUEUE")
+
+    parser.add_argument("--serve", nargs='?', const='', metavar="SOCKET",
+                        help="Run as a server answering JSON-line requests on a Unix domain socket (default: "
+                             "$PIV_SERVER_SOCKET or image_proc-<uid>.sock in the temporary directory)")
+
+    parser.add_argument("--stdio", help="Run as a server answering JSON-line requests from stdin on stdout",
+                        action='store_true')
+
     # parser.add_argument("-n", "--no_attribution", help="Whether to include attribution",
     #                    action='store_false')
     args = None
     args = parser.parse_args(argv)
+    args.prefilter = None
+    if args.highpass is not None or args.lowpass is not None or args.taper != DEF_TAPER:
+        try:
+            args.prefilter = PreFilter(args.highpass, args.lowpass, args.taper)
+            check_prefilter(args.mode, args.prefilter)
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+    if (args.mode != DEF_MODE or args.prefilter is not None) and \
+            (args.lag_sweep is not None or args.windows is not None):
+        warning("--mode, --highpass, --lowpass and --taper do not apply to --lag_sweep or --windows, which use "
+                "'cross' correlation without filters")
+        parser.print_help()
+        return args, INVALID_DATA
+    args.rois = None
+    if args.roi is not None:
+        if args.sequence is not None or args.watch is not None or args.raw is not None or \
+                args.windows is not None or args.serve is not None or args.stdio or args.work is not None or \
+                args.quick_look is not None or args.columns > 1:
+            warning("--roi applies to a single pair (-m), without --quick_look, --columns or --windows")
+            parser.print_help()
+            return args, INVALID_DATA
+        from .rois import Roi, check_rois
+        try:
+            args.rois = [Roi(name, *[int(bound) for bound in bounds]) for name, *bounds in args.roi]
+            check_rois(args.rois)
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+    args.calibration = None
+    if args.calibration_file is not None:
+        if args.windows is not None or args.queue is not None or args.serve is not None or args.stdio or \
+                args.work is not None:
+            warning("--calibration applies to pairs, sequences, lag sweeps, watch and raw stream runs, but not to "
+                    "--windows, work queues or the server")
+            parser.print_help()
+            return args, INVALID_DATA
+        try:
+            args.calibration = Calibration.from_file(args.calibration_file)
+        except OSError as e:
+            warning("Cannot read calibration:", e)
+            parser.print_help()
+            return args, IO_ERROR
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+    if args.mask is not None:
+        if args.sequence is not None or args.watch is not None or args.raw is not None or \
+                args.windows is not None or args.serve is not None or args.stdio or args.work is not None:
+            warning("--mask applies to the stripes of a single pair (-m), with or without --quick_look and "
+                    "--columns")
+            parser.print_help()
+            return args, INVALID_DATA
+        try:
+            check_mask(args.mode, args.prefilter)
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+        if not os.path.isfile(args.mask):
+            warning("Mask {} does not exist".format(args.mask))
+            parser.print_help()
+            return args, IO_ERROR
+    args.background = None
+    if args.background_method is not None:
+        if (args.sequence is None and args.watch is None and args.raw is None) or args.queue is not None or \
+                args.lag_sweep is not None:
+            warning("--background applies to sequence, watch and raw stream runs, but not to work queues or "
+                    "lag sweeps")
+            parser.print_help()
+            return args, INVALID_DATA
+        try:
+            args.background = Background(args.background_method, args.background_window, args.background_level)
+        except ValueError as e:
+            warning(e)
+            parser.print_help()
+            return args, INVALID_DATA
+    if args.serve is not None or args.stdio:
+        return args, SUCCESS
+    if args.export_csv is not None:
+        if not os.path.isdir(args.export_csv):
+            warning("Result store {} does not exist".format(args.export_csv))
+            parser.print_help()
+            return args, IO_ERROR
+        return args, SUCCESS
+    for queue_dir in (args.work, args.merge):
+        if queue_dir is not None:
+            if not os.path.isfile(os.path.join(queue_dir, 'job.json')):
+                warning("Work queue {} does not exist".format(queue_dir))
+                parser.print_help()
+                return args, IO_ERROR
+            return args, SUCCESS
+    if args.raw is not None:
+        try:
+            np.dtype(args.raw_dtype)
+        except TypeError:
+            warning("Unknown pixel type: {}".format(args.raw_dtype))
+            parser.print_help()
+            return args, INVALID_DATA
+        if min(args.raw) < 1:
+            warning("Frames need a width and height of at least 1 pixel")
+            parser.print_help()
+            return args, INVALID_DATA
+        if args.raw_input != '-' and not os.path.exists(args.raw_input):
+            warning("Input {} does not exist".format(args.raw_input))
+            parser.print_help()
+            return args, IO_ERROR
+        return args, SUCCESS
+    if args.watch is not None:
+        if not os.path.isdir(args.watch):
+            warning("Directory {} does not exist".format(args.watch))
+            parser.print_help()
+            return args, IO_ERROR
+        return args, SUCCESS
+    if args.sequence is not None:
+        missing = [image_path for image_path in args.sequence if not os.path.isfile(image_path)]
+        if missing:
+            warning("Image files do not exist: {}".format(', '.join(missing)))
+            parser.print_help()
+            return args, IO_ERROR
+        from .sequence import CONTAINER_EXTENSIONS
+        single_file = len(args.sequence) < 2 and \
+            os.path.splitext(args.sequence[0])[1].lower() not in CONTAINER_EXTENSIONS
+        if single_file or (args.lag_sweep is not None and args.lag_sweep < 1) or args.task_size < 1:
+            warning("A sequence needs at least two images or a multi-page file, a frame lag of at least 1 and tasks "
+                    "of at least 1 pair")
+            parser.print_help()
+            return args, INVALID_DATA
+        return args, SUCCESS
     image1_none = not os.path.isfile(args.image_file[0])
     image2_none = not os.path.isfile(args.image_file[1])
     if image1_none or image2_none:
@@ -178,23 +716,376 @@ def parse_cmdline(argv):
         return args, IO_ERROR
     return args, SUCCESS
 
+def sequence_base_name(image_paths, prefix='piv_results_'):
+    """
+    Base output name <prefix><first>_<last> of a sequence of image files
+    """
+    name_p1 = os.path.splitext(os.path.basename(image_paths[0]))[0]
+    name_p2 = os.path.splitext(os.path.basename(image_paths[-1]))[0]
+    return prefix + name_p1 + '_' + name_p2
+
+def make_statistics(args, base_f_name):
+    """
+    Running statistics requested with --stats or needed for --tolerance, or None
+    """
+    from .stats import ProfileStatistics
+    if args.stats:
+        return ProfileStatistics(snapshot_name=base_f_name + '_stats', snapshot_every=args.stats_every)
+    if getattr(args, 'tolerance', None) is not None:
+        return ProfileStatistics()
+    return None
+
+def make_fit_series(args, base_f_name, block_size):
+    """
+    Shear fit time series requested with --fit, or None
+    """
+    if not args.fit:
+        return None
+    from .stats import ShearFitSeries
+    out_name = base_f_name + '_fit.csv'
+    print("Writing shear fits to: {}".format(out_name))
+    return ShearFitSeries(out_name, y_range=args.fit_range, block_size=block_size)
+
+def write_statistics(statistics):
+    """
+    Write the final snapshot of running statistics, if any were kept
+    """
+    if statistics is not None and statistics.count and statistics.snapshot_name:
+        for out_name in statistics.write(statistics.snapshot_name):
+            print("Wrote file: {}".format(out_name))
+
+def export_main(store_path, out_dir='.'):
+    """
+    Write every pair of a result store as a .csv file
+    """
+    from .store import ResultStore
+    try:
+        out_names = ResultStore(store_path).export_csv(out_dir)
+    except (OSError, ValueError) as e:
+        warning("Result store cannot be exported:", e)
+        return IO_ERROR
+    print("Wrote {} files to {}".format(len(out_names), os.path.abspath(out_dir)))
+    return SUCCESS
+
+def store_outputs(args, store, image_paths):
+    """
+    Catalogue (-c) and export (--csv) a finished result store
+    """
+    if args.catalogue is not None:
+        from .catalogue import add_store
+        add_store(args.catalogue, store, image_paths)
+        print("Catalogued run in: {}".format(args.catalogue))
+    if args.csv:
+        return export_main(store.path)
+    return SUCCESS
+
+def batch_main(args):
+    """
+    Analyse all consecutive pairs of the sequence given on the command line into a result store
+    """
+    from .sequence import run_batch, read_checkpoint, CHECKPOINT_FILE_NAME
+    store_path = args.store or sequence_base_name(args.sequence) + '.pivstore'
+    statistics = make_statistics(args, os.path.splitext(store_path)[0])
+    fit_series = make_fit_series(args, os.path.splitext(store_path)[0], block_size=256)
+    try:
+        store = run_batch(args.sequence, args.division_pixel, store_path, precision=args.precision,
+                          statistics=statistics, fit_series=fit_series, tolerance=args.tolerance,
+                          tolerance_range=args.tolerance_range, min_pairs=args.min_pairs, mode=args.mode,
+                          prefilter=args.prefilter, background=args.background, calibration=args.calibration)
+    except OSError as e:
+        warning("Sequence cannot be analysed:", e)
+        return IO_ERROR
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    if store is None:
+        warning("Sequence has fewer than two readable frames")
+        return IO_ERROR
+    print("Wrote {} pairs to result store: {}".format(len(store), store_path))
+    skipped = read_checkpoint(store_path)['skipped']
+    if skipped:
+        warning("Skipped {} unreadable frames, listed in {}".format(len(skipped),
+                                                                     os.path.join(store_path, CHECKPOINT_FILE_NAME)))
+    if args.tolerance is not None:
+        if statistics.converged(args.tolerance, args.tolerance_range, args.min_pairs):
+            print("Mean profile converged after {} pairs ({} frames)".format(len(store),
+                                                                           len(store) + 1 + len(skipped)))
+        elif np.all(np.isnan(statistics.std_error)):
+            warning("Mean profile did not converge to {} pixels within {} frames; not enough pairs for a standard "
+                    "error".format(args.tolerance, len(args.sequence)))
+        else:
+            warning("Mean profile did not converge to {} pixels within {} frames; largest standard error {:.3g} "
+                    "pixels".format(args.tolerance, len(args.sequence), np.nanmax(statistics.std_error)))
+    write_statistics(statistics)
+    return store_outputs(args, store, args.sequence)
+
+
+def queue_main(args):
+    """
+    Split the sequence given on the command line into tasks of a shared work queue
+    """
+    from .workqueue import create_queue
+    try:
+        job = create_queue(args.queue, args.sequence, args.division_pixel, precision=args.precision,
+                           task_size=args.task_size, mode=args.mode, prefilter=args.prefilter)
+    except OSError as e:
+        warning("Work queue cannot be created:", e)
+        return IO_ERROR
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    print("Queued {} tasks in: {}".format(job['n_tasks'], args.queue))
+    return SUCCESS
+
+def work_main(args):
+    """
+    Work on a shared work queue until every task is claimed
+    """
+    from .workqueue import run_worker
+    try:
+        done = run_worker(args.work, claim_timeout=args.claim_timeout)
+    except OSError as e:
+        warning("Work queue cannot be processed:", e)
+        return IO_ERROR
+    print("Finished {} tasks of queue: {}".format(len(done), args.work))
+    return SUCCESS
+
+def merge_main(args):
+    """
+    Assemble the shards of a finished work queue into a result store
+    """
+    from .workqueue import merge_queue, read_job
+    image_paths = read_job(args.merge)['image_paths']
+    store_path = args.store or sequence_base_name(image_paths) + '.pivstore'
+    try:
+        store = merge_queue(args.merge, store_path)
+    except OSError as e:
+        warning("Work queue cannot be merged:", e)
+        return IO_ERROR
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    if store is None:
+        warning("Sequence has fewer than two readable frames")
+        return IO_ERROR
+    print("Wrote {} pairs to result store: {}".format(len(store), store_path))
+    return store_outputs(args, store, image_paths)
+
+def serve_main(args):
+    """
+    Serve analysis requests until a shutdown request arrives (or stdin ends)
+    """
+    from .server import serve, serve_stdio, default_socket_path
+    if args.stdio:
+        serve_stdio()
+        return SUCCESS
+    socket_path = args.serve or default_socket_path()
+    print("Serving on: {}".format(socket_path))
+    sys.stdout.flush()
+    try:
+        serve(socket_path)
+    except OSError as e:
+        warning("Server cannot be started:", e)
+        return IO_ERROR
+    return SUCCESS
+
+def lag_sweep_main(args):
+    """
+    Mean displacement profile for each frame lag over the sequence given on the command line
+    """
+    from .sequence import iter_frames, lag_sweep
+    try:
+        y_position, mean_shift, n_pairs = lag_sweep(iter_frames(args.sequence, args.calibration),
+                                                    args.division_pixel, args.lag_sweep, precision=args.precision)
+    except OSError:
+        return IO_ERROR
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    out_name = sequence_base_name(args.sequence, prefix='piv_lag_sweep_') + '.csv'
+    header = ','.join(['y_position'] + ['lag_{}'.format(lag) for lag in range(1, args.lag_sweep + 1)])
+    np.savetxt(out_name, np.column_stack((y_position, mean_shift.T)), delimiter=',', header=header)
+    print("Wrote file: {}".format(out_name))
+    return SUCCESS
+
+def watch_main(args):
+    """
+    Analyse the frames arriving in the watched directory until stopped
+    """
+    from .sequence import FolderWatcher, watch
+    watcher = FolderWatcher(args.watch, pattern=args.pattern, poll_interval=args.poll_interval)
+    dir_name = os.path.basename(os.path.normpath(os.path.abspath(args.watch)))
+    out_name = 'piv_watch_' + dir_name + '.csv'
+    statistics = make_statistics(args, os.path.splitext(out_name)[0])
+    fit_series = make_fit_series(args, os.path.splitext(out_name)[0], block_size=1)
+    print("Watching {} ({}), appending results to {}".format(
+        args.watch, 'inotify' if watcher.uses_inotify else 'polling', out_name))
+    try:
+        n_pairs, latency = watch(watcher, args.division_pixel, out_name, precision=args.precision,
+                                 latency_budget=args.latency_budget, max_pairs=args.max_pairs,
+                                 idle_timeout=args.idle_timeout, statistics=statistics, fit_series=fit_series,
+                                 mode=args.mode, prefilter=args.prefilter, background=args.background,
+                                 calibration=args.calibration)
+    except KeyboardInterrupt:
+        write_statistics(statistics)
+        return SUCCESS
+    finally:
+        watcher.close()
+    write_statistics(statistics)
+    if n_pairs:
+        print("Analysed {} pairs, median latency {:.1f} ms, maximum {:.1f} ms".format(
+            n_pairs, 1000 * np.median(latency), 1000 * latency.max()))
+    return SUCCESS
+
+def raw_main(args):
+    """
+    Analyse consecutive frames of the raw frame stream given on the command line into a result store
+    """
+    from .sequence import run_stream
+    width, height = args.raw
+    if args.raw_input == '-':
+        input_name = 'stdin'
+    else:
+        input_name = os.path.splitext(os.path.basename(args.raw_input))[0]
+    store_path = args.store or 'piv_results_raw_' + input_name + '.pivstore'
+    statistics = make_statistics(args, os.path.splitext(store_path)[0])
+    fit_series = make_fit_series(args, os.path.splitext(store_path)[0], block_size=256)
+    try:
+        if args.raw_input == '-':
+            stream = sys.stdin.buffer
+        else:
+            stream = open(args.raw_input, 'rb')
+        try:
+            store = run_stream(stream, (height, width), args.division_pixel, store_path, dtype=args.raw_dtype,
+                               precision=args.precision, max_pairs=args.max_pairs, statistics=statistics,
+                               fit_series=fit_series, mode=args.mode, prefilter=args.prefilter,
+                               background=args.background, calibration=args.calibration)
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+    except OSError as e:
+        warning("Raw frame stream cannot be analysed:", e)
+        return IO_ERROR
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    if store is None:
+        warning("Stream has fewer than two complete frames")
+        return IO_ERROR
+    print("Wrote {} pairs to result store: {}".format(len(store), store_path))
+    write_statistics(statistics)
+    return store_outputs(args, store, None)
+
+def columns_header(image_path, n_columns, reduce=1, calibration=None):
+    """
+    csv header naming the column windows of a pair by the x position of their centres
+    """
+    with Image.open(image_path) as img:
+        # reduced images keep the partial blocks at the edge (see image_array)
+        width, height = -(-img.size[0] // reduce), -(-img.size[1] // reduce)
+    if calibration is not None:
+        width = calibration.reduced(reduce).remap_table((height, width)).shape[1]
+    x_position = reduce * column_positions(width, n_columns)[1]
+    return ','.join(['y_position'] + ['x_{:g}'.format(x) for x in x_position])
+
+def windows_main(args):
+    """
+    Displacement field of the pair given on the command line on a grid of interrogation windows
+    """
+    from .windows import piv_analysis_2d, save_quiver
+    field_results = piv_analysis_2d(args.image_file[0], args.image_file[1], args.windows, args.overlap,
+                                    precision=args.precision)
+    if isinstance(field_results, int):
+        return field_results
+    base_f_name = sequence_base_name(args.image_file) + '_windows'
+    out_name = base_f_name + '.csv'
+    np.savetxt(out_name, field_results, delimiter=',', header='y_position,x_position,u,v')
+    print("Wrote file: {}".format(out_name))
+    save_quiver(base_f_name + '.png', field_results)
+    print("Wrote file: {}".format(base_f_name + '.png'))
+    return SUCCESS
+
+def rois_main(args):
+    """
+    Displacement profiles of the ROIs of the pair given on the command line, one file per ROI
+    """
+    from .rois import piv_analysis_rois
+    mask = None
+    if args.mask is not None:
+        mask, ret = load_mask(args.mask)
+        if ret != SUCCESS:
+            return IO_ERROR
+    roi_results = piv_analysis_rois(args.image_file[0], args.image_file[1], args.rois, args.division_pixel,
+                                    backend=args.backend, precision=args.precision, mode=args.mode,
+                                    prefilter=args.prefilter, mask=mask, calibration=args.calibration)
+    if isinstance(roi_results, int):
+        return roi_results
+    base_f_name = sequence_base_name(args.image_file)
+    if args.mask is not None:
+        base_f_name += '_masked'
+    for roi in args.rois:
+        out_name = base_f_name + '_' + roi.name + '.csv'
+        np.savetxt(out_name, roi_results[roi.name], delimiter=',')
+        print("Wrote file: {}".format(out_name))
+        plot_piv(base_f_name + '_' + roi.name, roi_results[roi.name])
+    return SUCCESS
+
 def main(argv=None):
     args, ret = parse_cmdline(argv)
     if ret != SUCCESS:
         return ret
+    if args.serve is not None or args.stdio:
+        return serve_main(args)
+    if args.export_csv is not None:
+        return export_main(args.export_csv)
+    if args.work is not None:
+        return work_main(args)
+    if args.merge is not None:
+        return merge_main(args)
+    if args.raw is not None:
+        return raw_main(args)
+    if args.watch is not None:
+        return watch_main(args)
+    if args.sequence is not None:
+        if args.queue is not None:
+            return queue_main(args)
+        if args.lag_sweep is not None:
+            return lag_sweep_main(args)
+        return batch_main(args)
+    if args.windows is not None:
+        return windows_main(args)
+    if args.rois is not None:
+        return rois_main(args)
 
     image_a_path = args.image_file[0]
     image_b_path = args.image_file[1]
     division_pixel = args.division_pixel
-    piv_results = piv_analysis(image_a_path, image_b_path, division_pixel)
+    mask = None
+    if args.mask is not None:
+        mask, ret = load_mask(args.mask)
+        if ret != SUCCESS:
+            return IO_ERROR
+    piv_results = piv_analysis(image_a_path, image_b_path, division_pixel, backend=args.backend,
+                               precision=args.precision, reduce=args.quick_look or 1, n_columns=args.columns,
+                               mode=args.mode, prefilter=args.prefilter, mask=mask, calibration=args.calibration)
+    if isinstance(piv_results, int):
+        return piv_results
     image_a_name = os.path.basename(image_a_path)
     image_b_name = os.path.basename(image_b_path)
     name_p1 = os.path.splitext(image_a_name)[0]
     name_p2 = os.path.splitext(image_b_name)[0]
     base_f_name = 'piv_results_' + name_p1 + '_' + name_p2
+    if args.quick_look is not None:
+        base_f_name += '_quick{}'.format(args.quick_look)
+    if args.mask is not None:
+        base_f_name += '_masked'
+    header = ''
+    if args.columns > 1:
+        base_f_name += '_columns{}'.format(args.columns)
+        header = columns_header(image_a_path, args.columns, args.quick_look or 1, args.calibration)
     out_name = base_f_name + '.csv'
     try:
-        np.savetxt(out_name, piv_results, delimiter=',')
+        np.savetxt(out_name, piv_results, delimiter=',', header=header)
         print("Wrote file: {}".format(out_name))
     except ValueError as e:
         warning("Data cannot be written to file:", e)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+rois.py
+Several regions of interest of one pair of frames in a single pass
+
+Setups that image two or three independent shear gaps in one camera frame give each gap
+its own named, rectangular region of interest (ROI). Each frame is decoded once, every ROI
+is cut into stripes as a crop of it would be, and the stripes of all ROIs go into one
+batched correlation. Narrower ROIs are zero padded to the widest one, and lags beyond
+their own width are left out, so every ROI gets the profile a separate run on its crop
+would give; only phase correlation of a narrower ROI runs over the padded length.
+"""
+
+import os
+import numpy as np
+from .correlation import PreFilter, correlate_stripes, peak_shift, DEF_BACKEND, DEF_MODE
+from .image_proc import (load_image, divid_image, stripe_mask, warning, PRECISIONS, DEF_PRECISION, SUCCESS,
+                         IO_ERROR, INVALID_DATA)
+
+
+class Roi(object):
+    """
+    A named rectangle of the frames, rows top to bottom - 1 and columns left to right - 1
+
+    :param name: name of the ROI, used in the names of its output files
+    :param top: first row
+    :param bottom: row after the last one
+    :param left: first column
+    :param right: column after the last one
+    """
+
+    def __init__(self, name, top, bottom, left, right):
+        if not name or os.sep in name or name != name.strip():
+            raise ValueError("ROI name '{}' cannot be used in file names".format(name))
+        top, bottom, left, right = int(top), int(bottom), int(left), int(right)
+        if top < 0 or left < 0 or bottom - top < 2 or right - left < 2:
+            raise ValueError("ROI {} needs at least 2 rows and 2 columns from row and column 0 on, got rows "
+                             "{}:{} and columns {}:{}".format(name, top, bottom, left, right))
+        self.name = name
+        self.top = top
+        self.bottom = bottom
+        self.left = left
+        self.right = right
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    def crop(self, image):
+        """
+        The ROI of a 2D array, as a view
+        """
+        return image[self.top:self.bottom, self.left:self.right]
+
+
+def check_rois(rois, frame_shape=None):
+    """
+    Raise ValueError for an empty list of ROIs, repeated names, or ROIs outside frames of frame_shape
+    """
+    if not rois:
+        raise ValueError("No ROIs given")
+    names = [roi.name for roi in rois]
+    if len(set(names)) < len(names):
+        raise ValueError("ROI names must be unique, got {}".format(', '.join(names)))
+    if frame_shape is not None:
+        for roi in rois:
+            if roi.bottom > frame_shape[0] or roi.right > frame_shape[1]:
+                raise ValueError("ROI {} (rows {}:{}, columns {}:{}) does not fit in frames of shape {}".format(
+                    roi.name, roi.top, roi.bottom, roi.left, roi.right, frame_shape))
+
+
+def analyse_rois(image_a, image_b, rois, division_pixel, backend=DEF_BACKEND, precision=DEF_PRECISION,
+                 mode=DEF_MODE, prefilter=None, mask=None):
+    """
+    Displacement profile of every ROI of a pair of images already loaded as 2D Numpy arrays
+
+    Parameters
+    ----------
+    image_a : image 1
+    image_b : image 2, with the same shape
+    rois : list of Roi with unique names
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    backend : correlation backend, see x_corr
+    precision : 'double' or 'single'
+    mode : 'cross', 'phase' or 'zncc' correlation, see x_corr; phase correlation of ROIs
+           narrower than the widest one is computed over its padded length
+    prefilter : optional PreFilter, see x_corr; tapers fit the width of each ROI
+    mask : optional boolean pixel mask of the whole images, see divid_image
+
+    Returns
+    -------
+    piv_results : dict of ROI name -> displacement profile (column 2) versus y position in
+                  the images (column 1), as analyse_images gives for a crop of the ROI
+    """
+    if image_a.shape != image_b.shape:
+        raise ValueError("Image 1 and image 2 have different sizes")
+    if mask is not None and mask.shape != image_a.shape:
+        raise ValueError("The mask and the images have different sizes")
+    check_rois(rois, image_a.shape)
+    dtype = PRECISIONS[precision]
+    width = max(roi.width for roi in rois)
+    padded = any(roi.width < width for roi in rois)
+    # zncc of padded stripes is the masked correlation of their padding
+    use_mask = mask is not None or (padded and mode == 'zncc')
+    blocks, left_out, y_positions = [], [], []
+    for roi in rois:
+        roi_mask = None if mask is None else roi.crop(mask)
+        segments_a, y_position = divid_image(roi.crop(image_a), division_pixel, precision=precision, mask=roi_mask)
+        segments_b = divid_image(roi.crop(image_b), division_pixel, precision=precision, mask=roi_mask)[0]
+        block = np.zeros((2, len(y_position), width), dtype=dtype)
+        block[0, :, :roi.width] = segments_a
+        block[1, :, :roi.width] = segments_b
+        window = None if prefilter is None else prefilter.window(roi.width, dtype)
+        if window is not None:
+            block[:, :, :roi.width] *= window
+        blocks.append(block)
+        if use_mask:
+            block_mask = np.ones((len(y_position), width), dtype=bool)
+            block_mask[:, :roi.width] = False if roi_mask is None else stripe_mask(roi_mask, division_pixel)
+            left_out.append(block_mask)
+        y_positions.append(roi.top + np.asarray(y_position))
+    stripes = np.concatenate(blocks, axis=1)
+    if prefilter is not None:
+        # the tapers are applied above
+        prefilter = PreFilter(prefilter.highpass, prefilter.lowpass)
+    xcorr = correlate_stripes(stripes[0], stripes[1], backend=backend, mode=mode, prefilter=prefilter,
+                              mask=np.concatenate(left_out) if use_mask else None)
+    start = 0
+    for roi, y_position in zip(rois, y_positions):
+        # lags 1-n .. n-1 of the padded stripes; beyond the ROI's width they only meet padding
+        rows = slice(start, start + y_position.size)
+        xcorr[rows, :width - roi.width] = -np.inf
+        xcorr[rows, width - 1 + roi.width:] = -np.inf
+        start += y_position.size
+    shift = peak_shift(xcorr, width)
+    shift[np.isneginf(xcorr.max(axis=1))] = np.nan
+    piv_results = {}
+    start = 0
+    for roi, y_position in zip(rois, y_positions):
+        piv_results[roi.name] = np.column_stack((y_position, shift[start:start + y_position.size]))
+        start += y_position.size
+    return piv_results
+
+
+def piv_analysis_rois(image_a_path, image_b_path, rois, division_pixel, backend=DEF_BACKEND,
+                      precision=DEF_PRECISION, mode=DEF_MODE, prefilter=None, mask=None, calibration=None):
+    """
+    Displacement profile of every ROI of a pair of image files, each decoded once
+
+    The ROIs are given in the frames as analysed, i.e. after a calibration, and the mask in
+    the camera frames, as for piv_analysis.
+
+    :return: dict of ROI name -> piv_results as analyse_rois; or IO_ERROR or INVALID_DATA
+             as piv_analysis
+    """
+    image_a, ret_a = load_image(image_a_path, calibration=calibration)
+    image_b, ret_b = load_image(image_b_path, calibration=calibration)
+    if (ret_a != SUCCESS) or (ret_b != SUCCESS):
+        return IO_ERROR
+    if mask is not None and calibration is not None:
+        mask = calibration.apply(mask) > 0
+    try:
+        return analyse_rois(image_a, image_b, rois, division_pixel, backend=backend, precision=precision, mode=mode,
+                            prefilter=prefilter, mask=mask)
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
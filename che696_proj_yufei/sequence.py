@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+sequence.py
+PIV analysis of image sequences
+
+Handles time-ordered series of frames rather than a single pair.
+"""
+
+import os
+import sys
+import json
+import time
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import select
+import struct
+from collections import deque
+import numpy as np
+from PIL import Image
+from .analyser import PivAnalyser
+from .correlation import fft_length, stripe_spectra, correlate_spectra, peak_shift, DEF_MODE
+from .image_proc import load_image, image_array, divid_image, warning, SUCCESS, PRECISIONS, DEF_PRECISION
+from .store import ResultStore, DEF_CHUNK_SIZE
+from .stats import ProfileStatistics
+
+DEF_MIN_PAIRS = 10
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+RAW_FRAME_NAME = 'frame_{:06d}'
+# multi-frame image files
+CONTAINER_EXTENSIONS = ('.tif', '.tiff', '.gif')
+PAGE_NAME = '{}_p{:06d}'
+
+
+class FrameSequence(object):
+    """
+    The frames of a list of image files in time order, where each page of a multi-page
+    TIFF or GIF file is a frame of its own
+
+    Pages are decoded one at a time, when they are loaded, from a container that is kept
+    open, so memory does not grow with the size of the stack. Frames are named by their
+    file, and pages of a multi-page file by <file name without extension>_p<page>, e.g.
+    stack_p000012.
+
+    :param image_paths: paths of the image files in time order
+    :param calibration: optional Calibration by which every frame is corrected as it is loaded
+    """
+
+    def __init__(self, image_paths, calibration=None):
+        self.image_paths = list(image_paths)
+        self.calibration = calibration
+        self._frames = []
+        for file_index, image_path in enumerate(self.image_paths):
+            n_pages = 1
+            if os.path.splitext(image_path)[1].lower() in CONTAINER_EXTENSIONS:
+                n_pages = count_pages(image_path)
+            self._frames.extend((file_index, page, n_pages) for page in range(n_pages))
+        self._container = (None, None)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def name(self, index):
+        """
+        Path of frame index, or <directory>/<stem>_p<page> for a page of a multi-page file
+        """
+        file_index, page, n_pages = self._frames[index]
+        image_path = self.image_paths[file_index]
+        if n_pages == 1:
+            return image_path
+        return PAGE_NAME.format(os.path.splitext(image_path)[0], page)
+
+    def load(self, index):
+        """
+        Load frame index like load_image: (image as 2D Numpy array, SUCCESS) or (None, error)
+        """
+        file_index, page, n_pages = self._frames[index]
+        if n_pages == 1:
+            return load_image(self.image_paths[file_index], calibration=self.calibration)
+        try:
+            if self._container[0] != file_index:
+                self.close()
+                self._container = (file_index, Image.open(self.image_paths[file_index]))
+            container = self._container[1]
+            container.seek(page)
+            image = image_array(container)
+        except (OSError, EOFError) as e:
+            warning("Read invalid image:", e)
+            return None, e
+        if self.calibration is not None:
+            try:
+                image = self.calibration.apply(image)
+            except ValueError as e:
+                warning("Cannot correct image:", e)
+                return None, e
+        return image, SUCCESS
+
+    def close(self):
+        if self._container[1] is not None:
+            self._container[1].close()
+        self._container = (None, None)
+
+
+def count_pages(image_path):
+    """
+    Number of frames of a (possibly multi-frame) image file; 1 if it cannot be read
+    """
+    try:
+        with Image.open(image_path) as image:
+            return getattr(image, 'n_frames', 1)
+    except OSError:
+        return 1
+
+
+def iter_frames(image_paths, calibration=None):
+    """
+    Load the frames of a sequence one at a time
+
+    :param image_paths: paths of the frames in time order; multi-page TIFF and GIF files give all their pages
+    :param calibration: optional Calibration by which every frame is corrected
+    :return: generator of images as 2D Numpy arrays; raises the OSError of the first unreadable frame
+    """
+    frames = FrameSequence(image_paths, calibration)
+    try:
+        for index in range(len(frames)):
+            image, ret = frames.load(index)
+            if ret != SUCCESS:
+                raise ret
+            yield image
+    finally:
+        frames.close()
+
+
+def read_checkpoint(store_path):
+    """
+    Progress checkpoint of the batch run writing store_path, or None if there is none
+    """
+    try:
+        with open(os.path.join(store_path, CHECKPOINT_FILE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(store_path, checkpoint):
+    """
+    Replace the progress checkpoint of a batch run atomically
+    """
+    checkpoint_path = os.path.join(store_path, CHECKPOINT_FILE_NAME)
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def sequence_digest(image_paths):
+    """
+    SHA-1 of the absolute frame paths, identifying the sequence a checkpoint belongs to
+    """
+    return hashlib.sha1('\n'.join(os.path.abspath(image_path) for image_path in image_paths)
+                        .encode('utf-8')).hexdigest()
+
+
+def prime_background(analyser, frames, index, skipped):
+    """
+    Push the frames before frame index that the run used into the background of the analyser,
+    so that a resumed run subtracts the same background as an uninterrupted one
+
+    :param analyser: PivAnalyser with a background
+    :param frames: FrameSequence of the run
+    :param index: first frame analysed by this run
+    :param skipped: names of the frames the run skipped
+    """
+    earlier = []
+    for i in range(index - 1, -1, -1):
+        if len(earlier) == analyser.background.window - 1:
+            break
+        if frames.name(i) not in skipped:
+            earlier.append(i)
+    for i in reversed(earlier):
+        analyser.push_background(frames.load(i)[0])
+
+
+def check_resume(store, attrs):
+    """
+    Raise ValueError unless a result store was written with the run parameters attrs, so
+    that a resumed run only appends profiles analysed like the stored ones
+    """
+    # as the store keeps them, e.g. tuples as lists
+    attrs = json.loads(json.dumps(attrs))
+    changed = [key for key in sorted(attrs) if store.attrs.get(key) != attrs[key]]
+    if changed:
+        raise ValueError('Result store {} was written with other parameters; cannot resume with {}'.format(
+            store.path, ', '.join('{}={} (stored {})'.format(key, attrs[key], store.attrs.get(key))
+                                  for key in changed)))
+
+
+def run_batch(image_paths, division_pixel, store_path, precision=DEF_PRECISION, chunk_size=DEF_CHUNK_SIZE,
+              statistics=None, fit_series=None, tolerance=None, tolerance_range=None, min_pairs=DEF_MIN_PAIRS,
+              mode=DEF_MODE, prefilter=None, background=None, calibration=None):
+    """
+    Analyse all consecutive pairs of a sequence into a binary result store
+
+    Unreadable frames, and frames whose size differs from the first one, are reported and
+    skipped; the frames on either side of them make a pair. Progress is written to a
+    checkpoint in the store after every completed chunk. Running again on the same store
+    and sequence resumes from the last checkpoint: pairs after it are dropped, the stored
+    pairs are replayed into statistics and fit_series, and analysis continues with the
+    next frame. A finished run is not repeated. Resuming with other analysis parameters
+    than the store was written with raises ValueError and leaves the store as it is.
+
+    With a tolerance, frames are only read until the mean profile has converged: the run
+    stops once the standard error of the mean displacement of every stripe (or of every
+    stripe in tolerance_range) is at most tolerance, after at least min_pairs pairs.
+
+    Parameters
+    ----------
+    image_paths : paths of the frames in time order; each frame is read once, and multi-page
+                  TIFF and GIF files give all their pages (see FrameSequence)
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    store_path : directory of the ResultStore; created unless it holds a checkpoint of this sequence
+    precision : 'double' or 'single'
+    chunk_size : pairs per chunk of the store
+    statistics : optional ProfileStatistics updated with every pair
+    fit_series : optional ShearFitSeries updated with every pair
+    tolerance : optional standard error (pixels) at which the mean profile counts as converged
+    tolerance_range : optional (y_min, y_max) of the stripes that have to converge
+    min_pairs : smallest number of pairs before the run can stop early
+    mode : correlation mode, one of MODES
+    prefilter : optional PreFilter of the stripes
+    background : optional Background subtracted from the frames
+    calibration : optional Calibration by which the frames are corrected as they are loaded
+
+    Returns
+    -------
+    store : the closed ResultStore, or None if the sequence has fewer than two readable frames;
+            the skipped frames are listed in read_checkpoint(store_path)['skipped']
+    """
+    if tolerance is not None and statistics is None:
+        statistics = ProfileStatistics()
+    frames = FrameSequence(image_paths, calibration)
+    checkpoint = {'sequence': sequence_digest(image_paths), 'n_frames': len(frames), 'n_pairs': 0,
+                  'next_frame': 0, 'skipped': [], 'complete': False}
+    attrs = {'division_pixel': division_pixel, 'precision': precision, 'mode': mode,
+             'prefilter': None if prefilter is None else prefilter.params(),
+             'background': None if background is None else background.params(),
+             'calibration': None if calibration is None else calibration.params()}
+    store = None
+    # a resumed store drops its pairs after the checkpoint once its stripes are known to match
+    resumed = False
+    if os.path.exists(store_path):
+        previous_checkpoint = read_checkpoint(store_path)
+        if previous_checkpoint is None or previous_checkpoint['sequence'] != checkpoint['sequence']:
+            raise ValueError('Result store {} exists and holds no checkpoint of this sequence'.format(store_path))
+        checkpoint = previous_checkpoint
+        store = ResultStore(store_path)
+        check_resume(store, attrs)
+        resumed = True
+        for pair in range(min(checkpoint['n_pairs'], len(store))):
+            piv_results = np.column_stack((store.y_position, store.displacement(pair)))
+            if statistics is not None:
+                statistics.update(piv_results)
+            if fit_series is not None:
+                fit_series.update(piv_results, label=store.frames[pair][1])
+    done = checkpoint['complete'] or (tolerance is not None and
+                                      statistics.converged(tolerance, tolerance_range, min_pairs))
+    analyser = None
+    previous = None
+    try:
+        for index in range(len(frames) if done else checkpoint['next_frame'], len(frames)):
+            image, ret = frames.load(index)
+            if ret == SUCCESS and analyser is not None and image.shape != analyser.frame_shape:
+                ret = 'size {} differs from {}'.format(image.shape, analyser.frame_shape)
+            if ret != SUCCESS:
+                warning("Skipping frame {}:".format(frames.name(index)), ret)
+                checkpoint['skipped'].append(frames.name(index))
+                continue
+            if analyser is None:
+                analyser = PivAnalyser(image.shape, division_pixel, precision=precision, mode=mode,
+                                       prefilter=prefilter, background=background)
+                if resumed:
+                    if analyser.n_stripes != store.n_stripes:
+                        raise ValueError('Frame {} gives {} stripes, but result store {} holds {}'.format(
+                            frames.name(index), analyser.n_stripes, store_path, store.n_stripes))
+                    store.truncate(checkpoint['n_pairs'])
+                    resumed = False
+                if background is not None:
+                    prime_background(analyser, frames, index, checkpoint['skipped'])
+            if background is not None:
+                analyser.push_background(image)
+            if previous is not None:
+                piv_results = analyser.analyse(previous_image, image)
+                if store is None:
+                    store = ResultStore.create(store_path, piv_results[:, 0], chunk_size=chunk_size, attrs=attrs)
+                    checkpoint['next_frame'] = previous
+                    write_checkpoint(store_path, checkpoint)
+                store.append(frames.name(previous), frames.name(index), piv_results[:, 1])
+                if statistics is not None:
+                    statistics.update(piv_results)
+                if fit_series is not None:
+                    fit_series.update(piv_results, label=os.path.basename(frames.name(index)))
+                if len(store) % store.chunk_size == 0:
+                    checkpoint.update(n_pairs=len(store), next_frame=index)
+                    write_checkpoint(store_path, checkpoint)
+                if tolerance is not None and statistics.converged(tolerance, tolerance_range, min_pairs):
+                    break
+            previous, previous_image = index, image
+    finally:
+        frames.close()
+    if resumed:
+        store.truncate(checkpoint['n_pairs'])
+    if store is not None:
+        store.close()
+        checkpoint.update(n_pairs=len(store), complete=True)
+        write_checkpoint(store_path, checkpoint)
+    if fit_series is not None:
+        fit_series.flush()
+    return store
+
+
+def read_full(stream, buffer):
+    """
+    Fill buffer (a writable bytes-like object) from a binary stream
+
+    Pipes may return fewer bytes per read, so readinto is repeated until the buffer is full.
+
+    :return: number of bytes read; less than len(buffer) only at the end of the stream
+    """
+    view = memoryview(buffer).cast('B')
+    n_read = 0
+    while n_read < len(view):
+        n = stream.readinto(view[n_read:])
+        if not n:
+            break
+        n_read += n
+    return n_read
+
+
+def iter_raw_frames(stream, frame_shape, dtype=np.uint8):
+    """
+    Frames of a stream of fixed-size raw frames without headers, e.g. from a camera SDK or
+    ``ffmpeg -f rawvideo``
+
+    The frames are read with readinto into two buffers that take turns, so there is no
+    allocation per frame; a frame is only valid until the next but one is read. An
+    incomplete last frame is reported and dropped.
+
+    :param stream: binary stream, e.g. sys.stdin.buffer or an open named pipe
+    :param frame_shape: (height, width) of the frames
+    :param dtype: pixel type, e.g. 'uint8' or '<u2' for little-endian 16-bit pixels
+    :return: generator of 2D Numpy arrays
+    """
+    buffers = [np.empty(frame_shape, dtype=dtype) for _ in range(2)]
+    n_frames = 0
+    while True:
+        frame = buffers[n_frames % 2]
+        # bytes of the frame, also for byte orders memoryview cannot cast
+        n_read = read_full(stream, frame.reshape(-1).view(np.uint8))
+        if n_read < frame.nbytes:
+            if n_read:
+                warning("Dropping incomplete last frame: {} of {} bytes".format(n_read, frame.nbytes))
+            return
+        n_frames += 1
+        yield frame
+
+
+def run_stream(stream, frame_shape, division_pixel, store_path, dtype=np.uint8, precision=DEF_PRECISION,
+               chunk_size=DEF_CHUNK_SIZE, max_pairs=None, statistics=None, fit_series=None, mode=DEF_MODE,
+               prefilter=None, background=None, calibration=None):
+    """
+    Analyse consecutive frames of a raw frame stream into a binary result store
+
+    Frames are named frame_000000, frame_000001, ... in the order they arrive.
+
+    Parameters
+    ----------
+    stream : binary stream of raw frames, see iter_raw_frames
+    frame_shape : (height, width) of the frames
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    store_path : directory of the new ResultStore
+    dtype : pixel type of the stream
+    precision : 'double' or 'single'
+    chunk_size : pairs per chunk of the store
+    max_pairs : optional largest number of pairs to analyse
+    statistics : optional ProfileStatistics updated with every pair
+    fit_series : optional ShearFitSeries updated with every pair
+    mode : correlation mode, one of MODES
+    prefilter : optional PreFilter of the stripes
+    background : optional Background subtracted from the frames
+    calibration : optional Calibration by which every frame is corrected; the corrected frames
+                  are new arrays, of the shape of its remap table
+
+    Returns
+    -------
+    store : the closed ResultStore, or None if the stream has fewer than two frames
+    """
+    table = None
+    analysed_shape = frame_shape
+    if calibration is not None:
+        table = calibration.remap_table(frame_shape)
+        analysed_shape = table.shape
+    analyser = PivAnalyser(analysed_shape, division_pixel, precision=precision, mode=mode, prefilter=prefilter,
+                           background=background)
+    attrs = {'division_pixel': division_pixel, 'precision': precision, 'mode': mode,
+             'prefilter': None if prefilter is None else prefilter.params(),
+             'background': None if background is None else background.params(),
+             'calibration': None if calibration is None else calibration.params(), 'dtype': np.dtype(dtype).str}
+    store = None
+    previous = None
+    for index, frame in enumerate(iter_raw_frames(stream, frame_shape, dtype)):
+        if table is not None:
+            frame = table.apply(frame)
+        if background is not None:
+            analyser.push_background(frame)
+        if previous is not None:
+            piv_results = analyser.analyse(previous, frame)
+            if store is None:
+                store = ResultStore.create(store_path, piv_results[:, 0], chunk_size=chunk_size, attrs=attrs)
+            store.append(RAW_FRAME_NAME.format(index - 1), RAW_FRAME_NAME.format(index), piv_results[:, 1])
+            if statistics is not None:
+                statistics.update(piv_results)
+            if fit_series is not None:
+                fit_series.update(piv_results, label=RAW_FRAME_NAME.format(index))
+            if max_pairs is not None and len(store) >= max_pairs:
+                break
+        previous = frame
+    if store is not None:
+        store.close()
+    if fit_series is not None:
+        fit_series.flush()
+    return store
+
+
+def iter_lag_sweep(frames, division_pixel, max_frame_lag, precision=DEF_PRECISION):
+    """
+    Correlate every frame with each of the next max_frame_lag frames
+
+    The stripe spectra of each frame are computed once and kept for max_frame_lag frames,
+    so every extra lag costs one spectrum multiply and inverse FFT instead of a full
+    correlation.
+
+    Parameters
+    ----------
+    frames : iterable of 2D Numpy arrays of the same shape, in time order
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    max_frame_lag : largest frame lag k to correlate
+    precision : 'double' or 'single'
+
+    Returns
+    -------
+    generator of (y_position, shifts) for each frame i that has at least one later frame;
+    shifts has shape (max_frame_lag, n_stripes) and row k-1 is the displacement profile
+    between frames i and i+k, or NaN where the sequence ends before frame i+k
+    """
+    dtype = PRECISIONS[precision]
+    window = deque()
+    frame_shape = y_position = None
+    nsamples = nfft = None
+
+    def sweep():
+        shifts = np.full((max_frame_lag, len(y_position)), np.nan)
+        for lag in range(1, len(window)):
+            shifts[lag - 1] = peak_shift(correlate_spectra(window[0], window[lag], nsamples, nfft), nsamples)
+        return y_position, shifts
+
+    for image in frames:
+        if frame_shape is None:
+            frame_shape = image.shape
+            nsamples = image.shape[1]
+            nfft = fft_length(nsamples)
+        elif image.shape != frame_shape:
+            raise ValueError('Frames of a sequence have different sizes')
+        segments, y_position = divid_image(image, division_pixel, precision=precision)
+        y_position = np.asarray(y_position)
+        window.append(stripe_spectra(np.asarray(segments, dtype=dtype), nfft))
+        if len(window) > max_frame_lag:
+            yield sweep()
+            window.popleft()
+    while len(window) > 1:
+        yield sweep()
+        window.popleft()
+
+
+def lag_sweep(frames, division_pixel, max_frame_lag, precision=DEF_PRECISION):
+    """
+    Mean displacement profile for each frame lag 1..max_frame_lag over a sequence
+
+    Only the sums over the sequence are kept, so memory does not grow with its length.
+
+    :return: y_position, mean_shift with shape (max_frame_lag, n_stripes), number of pairs per lag
+    """
+    y_position = shift_sum = None
+    n_pairs = np.zeros(max_frame_lag, dtype=int)
+    for y_position, shifts in iter_lag_sweep(frames, division_pixel, max_frame_lag, precision):
+        valid = ~np.isnan(shifts[:, 0])
+        if shift_sum is None:
+            shift_sum = np.zeros_like(shifts)
+        shift_sum[valid] += shifts[valid]
+        n_pairs += valid
+    if shift_sum is None:
+        raise ValueError('A lag sweep needs at least two frames')
+    with np.errstate(invalid='ignore'):
+        mean_shift = shift_sum / n_pairs[:, np.newaxis]
+    return y_position, mean_shift, n_pairs
+
+
+# inotify events that mark a file as completely written into the watched directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class _Inotify(object):
+    """
+    Minimal ctypes wrapper of Linux inotify for one directory
+    """
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError('inotify is not available')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {}'.format(directory))
+
+    def read(self, timeout):
+        """
+        Names of files closed after writing or moved into the directory, waiting up to timeout seconds
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        names = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            names.append(os.fsdecode(data[offset:offset + name_len].rstrip(b'\0')))
+            offset += name_len
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(object):
+    """
+    Reports frames that appear in a directory once they are completely written
+
+    On Linux, inotify reports a frame when the writer closes it. Elsewhere, or with
+    use_inotify=False, the directory is polled and a frame counts as complete once its
+    size and modification time have not changed for settle_time seconds.
+
+    Parameters
+    ----------
+    directory : directory the camera writes to
+    pattern : glob pattern of the frame file names
+    poll_interval : seconds between directory scans when polling
+    settle_time : seconds a polled file must stay unchanged; defaults to 2 * poll_interval
+    use_inotify : use inotify when it is available
+    """
+
+    def __init__(self, directory, pattern='*.bmp', poll_interval=0.05, settle_time=None, use_inotify=True):
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle_time = 2 * poll_interval if settle_time is None else settle_time
+        # frames present at start-up were written before watching began and are not reported
+        self._seen = set(fnmatch.filter(os.listdir(directory), pattern))
+        self._pending = {}
+        self._failed = {}
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify(directory)
+            except (OSError, AttributeError):
+                self._inotify = None
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def poll(self, timeout=None):
+        """
+        Paths of newly completed frames, in name order, waiting up to timeout seconds for the first
+
+        :param timeout: seconds to wait; None waits one poll interval
+        :return: list of paths, empty if nothing completed in time
+        """
+        timeout = self.poll_interval if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._inotify is not None:
+                names = [name for name in self._inotify.read(max(0.0, deadline - time.monotonic()))
+                         if fnmatch.fnmatch(name, self.pattern) and name not in self._seen]
+            else:
+                names = self._scan()
+            if names:
+                self._seen.update(names)
+                return [os.path.join(self.directory, name) for name in sorted(names)]
+            if time.monotonic() >= deadline:
+                return []
+            if self._inotify is None:
+                time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def _scan(self):
+        # a file is complete once its size and mtime have been stable for settle_time
+        now = time.monotonic()
+        complete = []
+        for entry in os.scandir(self.directory):
+            if entry.name in self._seen or not fnmatch.fnmatch(entry.name, self.pattern):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._failed.get(entry.name) == signature:
+                continue
+            self._failed.pop(entry.name, None)
+            last_signature, since = self._pending.get(entry.name, (None, now))
+            if signature != last_signature:
+                self._pending[entry.name] = (signature, now)
+            elif stat.st_size > 0 and now - since >= self.settle_time:
+                del self._pending[entry.name]
+                complete.append(entry.name)
+        return complete
+
+    def retry(self, frame_path):
+        """
+        Report a frame again once it changes, e.g. when it could not be read because
+        its writer paused for longer than the settle time
+        """
+        name = os.path.basename(frame_path)
+        self._seen.discard(name)
+        try:
+            stat = os.stat(frame_path)
+            self._failed[name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+def watch(watcher, division_pixel, out_name, precision=DEF_PRECISION, latency_budget=None, max_pairs=None,
+          idle_timeout=None, statistics=None, fit_series=None, mode=DEF_MODE, prefilter=None, background=None,
+          calibration=None):
+    """
+    Analyse each new frame in a watched directory together with the previous one
+
+    Every displacement profile is appended to out_name as soon as it is computed, as a row
+    of the two frame names followed by the displacement of each stripe; the header line
+    holds the y positions.
+
+    Parameters
+    ----------
+    watcher : FolderWatcher of the acquisition directory
+    division_pixel : Thickness (number of pixels) of horizontal stripes
+    out_name : path of the rolling results file
+    precision : 'double' or 'single'
+    latency_budget : seconds from a frame being found complete to its profile being written;
+                     a warning is given for every pair that takes longer
+    max_pairs : stop after this many pairs
+    idle_timeout : stop when no frame completes for this many seconds
+    statistics : optional ProfileStatistics updated with every pair; restarted when the
+                 frames change size, see ProfileStatistics.restart
+    fit_series : optional ShearFitSeries updated with every pair
+    mode : correlation mode, one of MODES
+    prefilter : optional PreFilter of the stripes
+    background : optional Background subtracted from the frames
+    calibration : optional Calibration by which the frames are corrected as they are loaded
+
+    Returns
+    -------
+    n_pairs : number of pairs analysed
+    latency : array of the end-to-end latency of every pair, in seconds
+    """
+    analyser = None
+    previous = None
+    latency = []
+    idle_since = time.monotonic()
+    with open(out_name, 'a') as out_file:
+        while max_pairs is None or len(latency) < max_pairs:
+            new_frames = watcher.poll()
+            if not new_frames:
+                if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                    break
+                continue
+            idle_since = time.monotonic()
+            for frame_path in new_frames:
+                detected = time.monotonic()
+                image, ret = load_image(frame_path, calibration=calibration)
+                if ret != SUCCESS:
+                    watcher.retry(frame_path)
+                    continue
+                if previous is not None and image.shape != previous[1].shape:
+                    warning('Frame {} has a different size than the previous frame'.format(frame_path))
+                    previous = None
+                if analyser is not None and image.shape != analyser.frame_shape and statistics is not None:
+                    # the statistics so far are of another stripe layout
+                    statistics.restart()
+                if analyser is None or image.shape != analyser.frame_shape:
+                    analyser = PivAnalyser(image.shape, division_pixel, precision=precision, mode=mode,
+                                           prefilter=prefilter, background=background)
+                    out_file.write('# frame_a,frame_b,' + ','.join('{:g}'.format(y) for y in analyser.y_position)
+                                   + '\n')
+                if background is not None:
+                    analyser.push_background(image)
+                if previous is not None:
+                    piv_results = analyser.analyse(previous[1], image)
+                    out_file.write('{},{},{}\n'.format(os.path.basename(previous[0]), os.path.basename(frame_path),
+                                                       ','.join('{:g}'.format(d) for d in piv_results[:, 1])))
+                    out_file.flush()
+                    if statistics is not None:
+                        statistics.update(piv_results)
+                    if fit_series is not None:
+                        fit_series.update(piv_results, label=os.path.basename(frame_path))
+                    latency.append(time.monotonic() - detected)
+                    if latency_budget is not None and latency[-1] > latency_budget:
+                        warning('Pair {} took {:.3f} s, over the latency budget of {} s'.format(
+                            os.path.basename(frame_path), latency[-1], latency_budget))
+                    if max_pairs is not None and len(latency) >= max_pairs:
+                        break
+                previous = (frame_path, image)
+    return len(latency), np.asarray(latency)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+server.py
+Long-running PIV analysis server
+
+Requests and responses are JSON objects, one per line, exchanged over a Unix domain
+socket or stdin/stdout. The server keeps warm PivAnalyser instances (buffers, FFT plans)
+for the frame sizes it has seen, so a pair costs only its analysis instead of interpreter
+start-up, imports and set-up. Every socket connection is served by its own thread with
+its own analysers.
+
+A request is
+  {"id": any, "image_a": path, "image_b": path, "division_pixel": 5, "precision": "double",
+   "mode": "cross", "prefilter": null, "max_lag": null, "out_dir": null, "plot": false}
+where raw frames {"data": base64, "shape": [height, width], "dtype": "uint8"} (see
+encode_frame) may be given as "frame_a" and "frame_b" instead of the paths, and "prefilter"
+as {"highpass": sigma, "lowpass": sigma, "taper": "hann"} (see PreFilter). With out_dir,
+the results are also written there as piv_results_<a>_<b>.csv (and .png with plot), as
+image_proc does for a pair. The response is
+  {"id": any, "status": 0, "y_position": [...], "displacement": [...], "files": [...]}
+or {"id": any, "status": 1 or 2, "error": message}. {"op": "ping"} is answered with
+{"status": 0} and {"op": "shutdown"} stops the server.
+"""
+
+import io
+import os
+import sys
+import json
+import base64
+import socket
+import tempfile
+import threading
+import socketserver
+from collections import OrderedDict
+import numpy as np
+from .analyser import PivAnalyser
+from .correlation import PreFilter, check_prefilter, DEF_MODE
+from .image_proc import (load_image, save_plot, sequence_base_name, SUCCESS, INVALID_DATA, IO_ERROR,
+                         PRECISIONS, DEF_PRECISION)
+
+DEF_MAX_ANALYSERS = 8
+
+
+def default_socket_path():
+    """
+    Socket of the server: $PIV_SERVER_SOCKET, or image_proc-<uid>.sock in the temporary directory
+    """
+    socket_path = os.environ.get('PIV_SERVER_SOCKET')
+    if socket_path:
+        return socket_path
+    return os.path.join(tempfile.gettempdir(), 'image_proc-{}.sock'.format(os.getuid()))
+
+
+def encode_frame(frame):
+    """
+    JSON-serialisable form of a 2D Numpy array, for the frame_a and frame_b of a request
+    """
+    frame = np.ascontiguousarray(frame)
+    return {'data': base64.b64encode(frame.tobytes()).decode('ascii'), 'shape': list(frame.shape),
+            'dtype': frame.dtype.str}
+
+
+def decode_frame(encoded):
+    """
+    2D Numpy array from the output of encode_frame
+    """
+    frame = np.frombuffer(base64.b64decode(encoded['data']), dtype=np.dtype(encoded['dtype']))
+    return frame.reshape(encoded['shape'])
+
+
+class PivService(object):
+    """
+    Request handling with per-thread caches of warm analysers
+
+    Parameters
+    ----------
+    max_analysers : analysers kept per thread; the least recently used one is dropped
+    """
+
+    def __init__(self, max_analysers=DEF_MAX_ANALYSERS):
+        self.max_analysers = max_analysers
+        self._local = threading.local()
+
+    def analyser(self, frame_shape, division_pixel, precision, max_lag, mode=DEF_MODE, prefilter=None):
+        """
+        Warm analyser of this thread for the given frame size and parameters
+        """
+        analysers = getattr(self._local, 'analysers', None)
+        if analysers is None:
+            analysers = self._local.analysers = OrderedDict()
+        key = (tuple(frame_shape), division_pixel, precision, max_lag, mode,
+               None if prefilter is None else tuple(sorted(prefilter.params().items())))
+        if key in analysers:
+            analysers.move_to_end(key)
+        else:
+            analysers[key] = PivAnalyser(frame_shape, division_pixel, precision=precision, max_lag=max_lag,
+                                         mode=mode, prefilter=prefilter)
+            if len(analysers) > self.max_analysers:
+                analysers.popitem(last=False)
+        return analysers[key]
+
+    def _frames(self, request):
+        frames = []
+        for name in ('a', 'b'):
+            if 'frame_' + name in request:
+                frames.append(decode_frame(request['frame_' + name]))
+                continue
+            image, ret = load_image(request['image_' + name])
+            if ret != SUCCESS:
+                raise OSError('Image {} cannot be read: {}'.format(request['image_' + name], ret))
+            frames.append(image)
+        return frames
+
+    def analyse(self, request):
+        """
+        Displacement profile of the pair of one request, written to out_dir if given
+
+        :return: piv_results and the names of the written files
+        """
+        division_pixel = int(request.get('division_pixel', 5))
+        precision = request.get('precision', DEF_PRECISION)
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision: {}'.format(precision))
+        mode = request.get('mode', DEF_MODE)
+        prefilter = request.get('prefilter')
+        if prefilter is not None:
+            prefilter = PreFilter(**prefilter)
+        check_prefilter(mode, prefilter)
+        frame_a, frame_b = self._frames(request)
+        if frame_a.shape != frame_b.shape or frame_a.ndim != 2:
+            raise ValueError('Image 1 and image 2 have different sizes')
+        analyser = self.analyser(frame_a.shape, division_pixel, precision, request.get('max_lag'), mode, prefilter)
+        piv_results = analyser.analyse(frame_a, frame_b)
+        out_names = []
+        if request.get('out_dir') is not None:
+            names = [request.get('image_a', 'frame_a'), request.get('image_b', 'frame_b')]
+            base_f_name = os.path.join(request['out_dir'], sequence_base_name(names))
+            out_names.append(base_f_name + '.csv')
+            np.savetxt(out_names[-1], piv_results, delimiter=',')
+            if request.get('plot'):
+                out_names.append(base_f_name + '.png')
+                save_plot(out_names[-1], piv_results)
+        return piv_results, out_names
+
+    def handle(self, request):
+        """
+        Response to one request; errors are reported in the response, never raised
+        """
+        response = {'id': request.get('id')}
+        op = request.get('op', 'analyse')
+        try:
+            if op in ('ping', 'shutdown'):
+                response['status'] = SUCCESS
+            elif op == 'analyse':
+                piv_results, out_names = self.analyse(request)
+                response.update(status=SUCCESS, y_position=piv_results[:, 0].tolist(),
+                                displacement=piv_results[:, 1].tolist(), files=out_names)
+            else:
+                raise ValueError('Unknown op: {}'.format(op))
+        except OSError as e:
+            response.update(status=IO_ERROR, error=str(e))
+        except (ValueError, KeyError, TypeError) as e:
+            response.update(status=INVALID_DATA, error='{}: {}'.format(type(e).__name__, e))
+        return response
+
+    def serve_lines(self, rfile, wfile):
+        """
+        Answer the JSON-line requests read from rfile on wfile until EOF or a shutdown request
+
+        :return: True if a shutdown was requested
+        """
+        for line in rfile:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a request must be a JSON object')
+            except ValueError as e:
+                request = {}
+                response = {'id': None, 'status': INVALID_DATA, 'error': 'Invalid request: {}'.format(e)}
+            else:
+                response = self.handle(request)
+            out = json.dumps(response) + '\n'
+            wfile.write(out if isinstance(wfile, io.TextIOBase) else out.encode('utf-8'))
+            wfile.flush()
+            if request.get('op') == 'shutdown':
+                return True
+        return False
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if self.server.service.serve_lines(self.rfile, self.wfile):
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(socket_path=None, service=None):
+    """
+    Unix domain socket server, bound but not yet serving; call serve_forever() on it
+
+    A socket file left behind by a server that is no longer running is replaced.
+    """
+    socket_path = socket_path or default_socket_path()
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise OSError('A server is already listening on {}'.format(socket_path))
+        finally:
+            probe.close()
+    server = _UnixServer(socket_path, _ConnectionHandler)
+    server.service = service or PivService()
+    return server
+
+
+def serve(socket_path=None):
+    """
+    Serve requests on a Unix domain socket until a shutdown request arrives
+    """
+    server = make_server(socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(server.server_address)
+        except OSError:
+            pass
+
+
+def serve_stdio():
+    """
+    Serve JSON-line requests from stdin on stdout until EOF or a shutdown request
+    """
+    PivService().serve_lines(sys.stdin, sys.stdout)
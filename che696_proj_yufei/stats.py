@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+stats.py
+Streaming statistics of displacement profiles over a sequence
+
+Results are folded in one pair at a time, so memory is O(n_stripes) however long the
+sequence is, and a snapshot can be written whenever one is wanted.
+"""
+
+import os
+import numpy as np
+
+DEF_HIST_MAX = 64
+
+
+class ProfileStatistics(object):
+    """
+    Per-stripe count, mean, variance (Welford's method), minimum, maximum and histogram
+
+    The arrays are sized by the first profile. Histogram bins are one pixel wide and
+    centred on the integer displacements -hist_max..hist_max; displacements outside that
+    range are counted in the first or last bin.
+
+    Parameters
+    ----------
+    hist_max : largest displacement magnitude with its own histogram bin
+    snapshot_name : optional base name of snapshots written by update()
+    snapshot_every : write a snapshot to snapshot_name after every this many profiles
+    """
+
+    def __init__(self, hist_max=DEF_HIST_MAX, snapshot_name=None, snapshot_every=None):
+        self.hist_max = hist_max
+        self.snapshot_name = snapshot_name
+        self.snapshot_every = snapshot_every
+        self.bin_centres = np.arange(-hist_max, hist_max + 1)
+        self.y_position = None
+        self.count = 0
+        # statistics written by restart()
+        self.n_parts = 0
+
+    def _start(self, y_position):
+        n_stripes = len(y_position)
+        self.y_position = np.array(y_position, dtype=float)
+        self.mean = np.zeros(n_stripes)
+        self.m2 = np.zeros(n_stripes)
+        self.min = np.full(n_stripes, np.inf)
+        self.max = np.full(n_stripes, -np.inf)
+        self.histogram = np.zeros((n_stripes, self.bin_centres.size), dtype=np.int64)
+        self._stripe_index = np.arange(n_stripes)
+        self._delta = np.empty(n_stripes)
+        self._bins = np.empty(n_stripes, dtype=np.intp)
+
+    def update(self, piv_results):
+        """
+        Fold in one displacement profile
+
+        :param piv_results: displacement profile (column 2) versus y position (column 1)
+        """
+        if self.y_position is None:
+            self._start(piv_results[:, 0])
+        displacement = piv_results[:, 1]
+        self.count += 1
+        delta = self._delta
+        np.subtract(displacement, self.mean, out=delta)
+        self.mean += delta / self.count
+        # m2 += delta * (x - new mean)
+        self.m2 += delta * (displacement - self.mean)
+        np.minimum(self.min, displacement, out=self.min)
+        np.maximum(self.max, displacement, out=self.max)
+        np.clip(np.rint(displacement), -self.hist_max, self.hist_max, out=delta)
+        np.add(delta, self.hist_max, out=self._bins, casting='unsafe')
+        self.histogram[self._stripe_index, self._bins] += 1
+        if self.snapshot_every and self.snapshot_name and self.count % self.snapshot_every == 0:
+            self.write(self.snapshot_name)
+
+    def restart(self):
+        """
+        Forget all profiles so far, e.g. when the frames of a live run change size and so
+        give another stripe layout; with a snapshot_name, the statistics so far are first
+        written to snapshot_name_part<n>, n = 1, 2, ...
+
+        :return: names of the written files
+        """
+        out_names = []
+        if self.count and self.snapshot_name:
+            self.n_parts += 1
+            out_names = self.write('{}_part{}'.format(self.snapshot_name, self.n_parts))
+        self.y_position = None
+        self.count = 0
+        return out_names
+
+    def merge(self, other):
+        """
+        Combine with the statistics of another part of the sequence (Chan et al. update)
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self._start(other.y_position)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.histogram += other.histogram
+        self.count = count
+
+    @property
+    def variance(self):
+        """
+        Sample variance of the displacement of each stripe (NaN before two profiles)
+        """
+        if self.count < 2:
+            return np.full(len(self.mean), np.nan)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std_error(self):
+        """
+        Standard error of the mean displacement of each stripe
+        """
+        return np.sqrt(self.variance / self.count)
+
+    def converged(self, tolerance, y_range=None, min_count=2):
+        """
+        Whether the standard error of the mean displacement is at most tolerance (pixels)
+        for every stripe, or for every stripe inside y_range = (y_min, y_max)
+        """
+        if self.count < max(min_count, 2):
+            return False
+        std_error = self.std_error
+        if y_range is not None:
+            std_error = std_error[(self.y_position >= y_range[0]) & (self.y_position <= y_range[1])]
+        return bool(np.all(std_error <= tolerance))
+
+    def snapshot(self):
+        """
+        Copy of the current statistics as a dict of arrays
+        """
+        return {'count': self.count, 'y_position': self.y_position.copy(), 'mean': self.mean.copy(),
+                'variance': self.variance, 'min': self.min.copy(), 'max': self.max.copy(),
+                'histogram': self.histogram.copy(), 'bin_centres': self.bin_centres.copy()}
+
+    def write(self, base_f_name):
+        """
+        Write a snapshot as base_f_name.csv (y position, count, mean, variance, min, max per
+        stripe) and base_f_name_hist.csv (counts per stripe and displacement bin). Files are
+        replaced atomically, so a reader never sees a partial snapshot.
+
+        :return: names of the written files
+        """
+        summary = np.column_stack((self.y_position, np.full(len(self.mean), self.count), self.mean,
+                                   self.variance, self.min, self.max))
+        histogram = np.column_stack((self.y_position, self.histogram))
+        out_names = []
+        for out_name, data, header in (
+                (base_f_name + '.csv', summary, 'y_position,count,mean,variance,min,max'),
+                (base_f_name + '_hist.csv', histogram,
+                 'y_position,' + ','.join(str(centre) for centre in self.bin_centres))):
+            tmp_name = out_name + '.tmp'
+            np.savetxt(tmp_name, data, delimiter=',', header=header)
+            os.replace(tmp_name, out_name)
+            out_names.append(out_name)
+        return out_names
+
+
+def fit_profiles(y_position, displacements, y_range=None):
+    """
+    Least-squares fit of displacement = intercept + shear_rate * y to a block of profiles at once
+
+    Parameters
+    ----------
+    y_position : stripe centres
+    displacements : (n_pairs, n_stripes) array, or a single profile
+    y_range : optional (y_min, y_max); only stripes inside it are fitted
+
+    Returns
+    -------
+    shear_rate : slope of each profile (displacement per pixel of y)
+    intercept : displacement at y = 0, i.e. the slip at the upper, static wall
+    residual : root mean square deviation of each profile from its fit
+    """
+    y_position = np.asarray(y_position, dtype=float)
+    displacements = np.atleast_2d(np.asarray(displacements, dtype=float))
+    if y_range is not None:
+        inside = (y_position >= y_range[0]) & (y_position <= y_range[1])
+        y_position = y_position[inside]
+        displacements = displacements[:, inside]
+    y_mean = y_position.mean()
+    y_centred = y_position - y_mean
+    y_norm = np.dot(y_centred, y_centred)
+    if y_norm > 0:
+        shear_rate = displacements.dot(y_centred) / y_norm
+    else:
+        shear_rate = np.zeros(len(displacements))
+    intercept = displacements.mean(axis=1) - shear_rate * y_mean
+    deviation = displacements - intercept[:, np.newaxis] - shear_rate[:, np.newaxis] * y_position
+    residual = np.sqrt(np.mean(deviation ** 2, axis=1))
+    return shear_rate, intercept, residual
+
+
+class ShearFitSeries(object):
+    """
+    Running time series of the linear fit of every displacement profile
+
+    Profiles are buffered and fitted block_size at a time with fit_profiles; each fitted
+    block is appended to out_name, so a live view can follow the shear rate and slip
+    without storing or reloading full profiles. Only the current block is kept in memory.
+
+    Parameters
+    ----------
+    out_name : optional CSV file the series is appended to
+    y_range : optional (y_min, y_max) of the stripes to fit
+    block_size : profiles per vectorised fit; 1 writes every pair immediately
+    """
+
+    def __init__(self, out_name=None, y_range=None, block_size=1):
+        self.out_name = out_name
+        self.y_range = y_range
+        self.block_size = block_size
+        # profiles fitted so far
+        self.n_fitted = 0
+        self._y_position = None
+        self._block = []
+        self._labels = []
+        if out_name is not None:
+            with open(out_name, 'w') as f:
+                f.write('# pair,label,shear_rate,intercept,residual\n')
+
+    def __len__(self):
+        return self.n_fitted + len(self._block)
+
+    def update(self, piv_results, label=''):
+        """
+        Add the profile of the next pair
+
+        :param piv_results: displacement profile (column 2) versus y position (column 1)
+        :param label: name of the pair in the series, e.g. its second frame
+        """
+        if self._y_position is None or not np.array_equal(piv_results[:, 0], self._y_position):
+            # profiles of another stripe layout are fitted in a block of their own
+            self.flush()
+            self._y_position = piv_results[:, 0].copy()
+        self._block.append(piv_results[:, 1].copy())
+        self._labels.append(label)
+        if len(self._block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Fit the buffered profiles and append them to the series
+        """
+        if not self._block:
+            return
+        shear_rate, intercept, residual = fit_profiles(self._y_position, np.array(self._block), self.y_range)
+        if self.out_name is not None:
+            with open(self.out_name, 'a') as f:
+                for i, label in enumerate(self._labels):
+                    f.write('{},{},{!r},{!r},{!r}\n'.format(self.n_fitted + i, label, float(shear_rate[i]),
+                                                             float(intercept[i]), float(residual[i])))
+        self.n_fitted += len(self._block)
+        self._block = []
+        self._labels = []
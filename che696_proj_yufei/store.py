@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+store.py
+Binary result store for long image sequences
+
+A store is a directory holding
+  meta.json          stripe layout (y positions as start/step) and run parameters
+  index.txt          one CSV line "frame_a,frame_b" per pair, in pair order
+  chunk_000000.npy   float32 displacements, one row per pair and chunk_size rows per chunk
+
+Chunks are written whole with an atomic rename, the index is only extended after its
+chunk is on disk, and readers memory-map the chunks, so random access to pair i reads
+only that row.
+"""
+
+import os
+import csv
+import json
+import numpy as np
+
+STORE_FORMAT = 1
+DEF_CHUNK_SIZE = 1024
+META_FILE_NAME = 'meta.json'
+INDEX_FILE_NAME = 'index.txt'
+CHUNK_FILE_NAME = 'chunk_{:06d}.npy'
+
+
+def encode_y_position(y_position):
+    """
+    Stripe centres as start, step and last value; only the last stripe of divid_image
+    can be shorter than the others
+    """
+    y_position = np.asarray(y_position, dtype=float)
+    step = y_position[1] - y_position[0] if y_position.size > 1 else 0.0
+    encoded = {'y_start': float(y_position[0]), 'y_step': float(step), 'y_last': float(y_position[-1]),
+               'n_stripes': int(y_position.size)}
+    if not np.allclose(decode_y_position(encoded), y_position):
+        raise ValueError('Stripe positions are not evenly spaced')
+    return encoded
+
+
+def decode_y_position(meta):
+    """
+    Stripe centres from the start, step and last value written by encode_y_position
+    """
+    y_position = meta['y_start'] + meta['y_step'] * np.arange(meta['n_stripes'])
+    y_position[-1] = meta['y_last']
+    return y_position
+
+
+class ResultStore(object):
+    """
+    Appendable, memory-mapped store of displacement profiles
+
+    Open an existing store with ResultStore(path) and make a new one with
+    ResultStore.create(path, y_position). Appended pairs are buffered and written one
+    chunk at a time; flush() or close() writes the partial last chunk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE_NAME)) as f:
+            self.meta = json.load(f)
+        self.chunk_size = self.meta['chunk_size']
+        self.y_position = decode_y_position(self.meta)
+        self.n_stripes = self.meta['n_stripes']
+        self.frames = []
+        index_path = os.path.join(path, INDEX_FILE_NAME)
+        if os.path.isfile(index_path):
+            # csv quotes frame names that contain commas
+            with open(index_path, newline='') as f:
+                self.frames = [tuple(row) for row in csv.reader(f) if row]
+        self._n_flushed = self._n_indexed = len(self.frames)
+        self._chunk_cache = (None, None)
+        # rows of the current, possibly partial, chunk
+        self._buffer = np.empty((self.chunk_size, self.n_stripes), dtype=np.float32)
+        self._n_buffered = self._n_flushed % self.chunk_size
+        if self._n_buffered:
+            chunk = self._load_chunk(self._n_flushed // self.chunk_size)
+            self._buffer[:self._n_buffered] = chunk[:self._n_buffered]
+            self._n_flushed -= self._n_buffered
+            self._chunk_cache = (None, None)
+
+    @classmethod
+    def create(cls, path, y_position, chunk_size=DEF_CHUNK_SIZE, attrs=None):
+        """
+        Make an empty store
+
+        :param path: directory of the store; must not exist yet
+        :param y_position: stripe centres shared by all pairs
+        :param chunk_size: pairs per chunk file
+        :param attrs: dict of run parameters to keep with the results
+        :return: the open ResultStore
+        """
+        meta = encode_y_position(y_position)
+        meta.update({'format': STORE_FORMAT, 'chunk_size': int(chunk_size), 'dtype': 'float32',
+                     'attrs': attrs or {}})
+        os.makedirs(path)
+        with open(os.path.join(path, META_FILE_NAME), 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        return cls(path)
+
+    @property
+    def attrs(self):
+        return self.meta['attrs']
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, frame_a, frame_b, displacement):
+        """
+        Add the displacement profile of the pair (frame_a, frame_b)
+        """
+        self._buffer[self._n_buffered] = displacement
+        self._n_buffered += 1
+        self.frames.append((os.path.basename(frame_a), os.path.basename(frame_b)))
+        if self._n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered pairs; a partial chunk is rewritten until it is full
+        """
+        if not self._n_buffered:
+            return
+        chunk_id = self._n_flushed // self.chunk_size
+        chunk_path = os.path.join(self.path, CHUNK_FILE_NAME.format(chunk_id))
+        tmp_path = chunk_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self._buffer[:self._n_buffered])
+        os.replace(tmp_path, chunk_path)
+        with open(os.path.join(self.path, INDEX_FILE_NAME), 'a', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerows(self.frames[self._n_indexed:self._n_flushed + self._n_buffered])
+        self._n_indexed = self._n_flushed + self._n_buffered
+        if self._chunk_cache[0] == chunk_id:
+            self._chunk_cache = (None, None)
+        if self._n_buffered == self.chunk_size:
+            self._n_flushed += self._n_buffered
+            self._n_buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def truncate(self, n_pairs):
+        """
+        Drop every pair after the first n_pairs, e.g. those written after the last checkpoint of a run
+        """
+        if n_pairs >= len(self):
+            return
+        del self.frames[n_pairs:]
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        with open(index_path + '.tmp', 'w', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerows(self.frames)
+        os.replace(index_path + '.tmp', index_path)
+        self._n_indexed = n_pairs
+        self._chunk_cache = (None, None)
+        if n_pairs < self._n_flushed:
+            self._n_flushed = n_pairs - n_pairs % self.chunk_size
+            self._n_buffered = n_pairs % self.chunk_size
+            if self._n_buffered:
+                chunk = self._load_chunk(self._n_flushed // self.chunk_size)
+                self._buffer[:self._n_buffered] = chunk[:self._n_buffered]
+                self._chunk_cache = (None, None)
+        else:
+            self._n_buffered = n_pairs - self._n_flushed
+        # the partial last chunk keeps its extra rows until its next flush; later chunks go
+        chunk_id = -(-n_pairs // self.chunk_size)
+        while os.path.isfile(os.path.join(self.path, CHUNK_FILE_NAME.format(chunk_id))):
+            os.remove(os.path.join(self.path, CHUNK_FILE_NAME.format(chunk_id)))
+            chunk_id += 1
+
+    def _load_chunk(self, chunk_id):
+        if self._chunk_cache[0] != chunk_id:
+            chunk = np.load(os.path.join(self.path, CHUNK_FILE_NAME.format(chunk_id)), mmap_mode='r')
+            self._chunk_cache = (chunk_id, chunk)
+        return self._chunk_cache[1]
+
+    def displacement(self, pair):
+        """
+        Displacement profile of one pair, read from its memory-mapped chunk
+        """
+        if pair < 0:
+            pair += len(self)
+        if not 0 <= pair < len(self):
+            raise IndexError('Pair {} is not in a store of {} pairs'.format(pair, len(self)))
+        if pair >= self._n_flushed:
+            return self._buffer[pair - self._n_flushed]
+        return self._load_chunk(pair // self.chunk_size)[pair % self.chunk_size]
+
+    def iter_chunks(self):
+        """
+        Memory-mapped (n_pairs, n_stripes) blocks of displacements in pair order
+        """
+        for chunk_id in range(self._n_flushed // self.chunk_size):
+            yield self._load_chunk(chunk_id)
+        if self._n_buffered:
+            yield self._buffer[:self._n_buffered]
+
+    def displacements(self):
+        """
+        All displacement profiles as one (n_pairs, n_stripes) array
+        """
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return np.empty((0, self.n_stripes), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    def export_csv(self, out_dir='.'):
+        """
+        Write every pair as piv_results_<frame_a>_<frame_b>.csv, the format of a single pair analysis
+
+        :return: list of the written file names
+        """
+        out_names = []
+        for pair, (frame_a, frame_b) in enumerate(self.frames):
+            base_f_name = 'piv_results_' + os.path.splitext(frame_a)[0] + '_' + os.path.splitext(frame_b)[0]
+            out_name = os.path.join(out_dir, base_f_name + '.csv')
+            np.savetxt(out_name, np.column_stack((self.y_position, self.displacement(pair))), delimiter=',')
+            out_names.append(out_name)
+        return out_names
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+windows.py
+2D PIV on a grid of interrogation windows
+
+Where the stripe profiles of image_proc give the displacement along x versus y, this
+gives both displacement components u(x, y) and v(x, y) on a grid of square (or
+rectangular) windows, for entrance regions and flows with secondary structure. Windows
+are strided views of the images, and blocks of them are correlated with one batched 2D
+real FFT, zero padded so that the correlation does not wrap around.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import fft as sp_fft
+from .correlation import fft_length
+from .image_proc import load_image, SUCCESS, IO_ERROR, INVALID_DATA, PRECISIONS, DEF_PRECISION, warning
+
+DEF_WINDOW_SIZE = 32
+DEF_OVERLAP = 0.5
+# windows correlated per batched FFT; bounds the work arrays to a few tens of MB
+DEF_BLOCK_WINDOWS = 1024
+
+
+def window_shape(window_size):
+    """
+    (height, width) of windows given as one size or a (height, width) pair
+    """
+    if np.ndim(window_size) == 0:
+        return int(window_size), int(window_size)
+    height, width = window_size
+    return int(height), int(width)
+
+
+def window_step(window_size, overlap=DEF_OVERLAP):
+    """
+    (step along y, step along x) between windows overlapping by the fraction overlap
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("Window overlap must be at least 0 and less than 1, got {}".format(overlap))
+    return tuple(max(1, size - int(round(size * overlap))) for size in window_shape(window_size))
+
+
+def window_grid(image_shape, window_size, step):
+    """
+    Centres of the windows that fit in an image
+
+    :param image_shape: (height, width) of the images
+    :param window_size: window size, or (height, width) of the windows
+    :param step: (step along y, step along x) between windows
+    :return: y_position, x_position : 1D arrays of the window centres along each axis
+    """
+    positions = []
+    for length, size, stride in zip(image_shape, window_shape(window_size), step):
+        if size > length:
+            raise ValueError("Windows of {} pixels do not fit in an image of {} pixels".format(size, length))
+        starts = np.arange(0, length - size + 1, stride)
+        positions.append(starts + (size - 1) / 2.0)
+    return positions[0], positions[1]
+
+
+def extract_windows(image, window_size, step):
+    """
+    All windows of an image as a read-only strided view, without copying pixels
+
+    :param image: 2D Numpy array
+    :param window_size: window size, or (height, width) of the windows
+    :param step: (step along y, step along x) between windows
+    :return: 4D array view of shape (n_y, n_x, window height, window width)
+    """
+    height, width = window_shape(window_size)
+    y_position, x_position = window_grid(image.shape, (height, width), step)
+    row_stride, col_stride = image.strides
+    return as_strided(image, shape=(y_position.size, x_position.size, height, width),
+                      strides=(step[0] * row_stride, step[1] * col_stride, row_stride, col_stride),
+                      writeable=False)
+
+
+def searched_lags(size, nfft, max_lag=None):
+    """
+    Lags searched along one axis of the correlation of zero padded windows
+
+    :param size: window size along the axis
+    :param nfft: padded length of the axis
+    :param max_lag: largest displacement searched; default half the window
+    :return: index : positions of the lags in the circular correlation
+             lag : the lags, from -max_lag to max_lag
+    """
+    limit = size // 2 if max_lag is None else min(max_lag, size - 1)
+    lag = np.arange(-limit, limit + 1)
+    return lag % nfft, lag
+
+
+def _normalised_spectra(windows, nfft, dtype):
+    # zero mean and unit standard deviation per window, as divid_image does for stripes;
+    # windows without texture are left at zero and flagged by the caller
+    normalised = np.array(windows, dtype=dtype)
+    normalised -= normalised.mean(axis=(-2, -1), keepdims=True)
+    std = np.sqrt(np.mean(normalised * normalised, axis=(-2, -1), keepdims=True))
+    flat = std[..., 0, 0] == 0
+    std[std == 0] = 1
+    normalised /= std
+    # rows, then columns: the padding rows are all zero and need no transform
+    spectrum = sp_fft.rfft(normalised, nfft[1], axis=-1, workers=-1)
+    return sp_fft.fft(spectrum, nfft[0], axis=-2, overwrite_x=True, workers=-1), flat
+
+
+def correlate_windows(windows_a, windows_b, precision=DEF_PRECISION, max_lag=None):
+    """
+    Displacement at the correlation peak of each pair of windows
+
+    :param windows_a: array of windows of image 1, windows along the last two axes
+    :param windows_b: matching windows of image 2
+    :param precision: 'double' or 'single', floating point type of the correlation
+    :param max_lag: largest displacement (pixels) searched along each axis; default half the window
+    :return: u, v : displacements along x and y from image 1 to image 2, NaN where either
+             window is uniform; same shape as the leading axes of the windows
+    """
+    dtype = PRECISIONS[precision]
+    height, width = windows_a.shape[-2:]
+    nfft = (fft_length(height), fft_length(width))
+    row_index, row_lag = searched_lags(height, nfft[0], max_lag)
+    column_index, column_lag = searched_lags(width, nfft[1], max_lag)
+    spectrum_a, flat_a = _normalised_spectra(windows_a, nfft, dtype)
+    spectrum_b, flat_b = _normalised_spectra(windows_b, nfft, dtype)
+    spectrum_a *= np.conj(spectrum_b)
+    # inverse along y, then along x for the searched rows only
+    spectrum_a = sp_fft.ifft(spectrum_a, axis=-2, overwrite_x=True, workers=-1)[..., row_index, :]
+    xcorr = sp_fft.irfft(spectrum_a, nfft[1], axis=-1, workers=-1)[..., column_index]
+    peak = xcorr.reshape(xcorr.shape[:-2] + (-1,)).argmax(axis=-1)
+    peak_row, peak_column = np.unravel_index(peak, (row_lag.size, column_lag.size))
+    # the correlation peaks at minus the displacement
+    u = -column_lag[peak_column].astype(float)
+    v = -row_lag[peak_row].astype(float)
+    flat = flat_a | flat_b
+    u[flat] = np.nan
+    v[flat] = np.nan
+    return u, v
+
+
+def analyse_windows(image_a, image_b, window_size=DEF_WINDOW_SIZE, overlap=DEF_OVERLAP, precision=DEF_PRECISION,
+                    max_lag=None, block_windows=DEF_BLOCK_WINDOWS):
+    """
+    Displacement field of a pair of images already loaded as 2D Numpy arrays
+
+    Parameters
+    ----------
+    image_a : image 1
+    image_b : image 2, with the same shape
+    window_size : interrogation window size, or (height, width), in pixels
+    overlap : fraction by which neighbouring windows overlap, 0 <= overlap < 1
+    precision : 'double' or 'single'
+    max_lag : largest displacement (pixels) searched along each axis; default half the window
+    block_windows : windows correlated per batched FFT
+
+    Returns
+    -------
+    y_position, x_position : 1D arrays of the window centres
+    u, v : 2D arrays (len(y_position), len(x_position)) of the displacements along x
+           (flow direction) and y, NaN for windows without texture
+    """
+    if image_a.shape != image_b.shape:
+        raise ValueError("Image 1 and image 2 have different sizes")
+    step = window_step(window_size, overlap)
+    y_position, x_position = window_grid(image_a.shape, window_size, step)
+    windows_a = extract_windows(image_a, window_size, step)
+    windows_b = extract_windows(image_b, window_size, step)
+    u = np.empty((y_position.size, x_position.size))
+    v = np.empty_like(u)
+    rows_per_block = max(1, block_windows // x_position.size)
+    for start in range(0, y_position.size, rows_per_block):
+        block = slice(start, start + rows_per_block)
+        u[block], v[block] = correlate_windows(windows_a[block], windows_b[block], precision=precision,
+                                                 max_lag=max_lag)
+    return y_position, x_position, u, v
+
+
+def piv_analysis_2d(image_a_path, image_b_path, window_size=DEF_WINDOW_SIZE, overlap=DEF_OVERLAP,
+                    precision=DEF_PRECISION):
+    """
+    Displacement field of a pair of image files on a grid of interrogation windows
+
+    :return: (n_windows, 4) array with columns y position, x position, u, v, one row per
+             window in row-major order; or IO_ERROR or INVALID_DATA as piv_analysis
+    """
+    image_a, ret_a = load_image(image_a_path)
+    image_b, ret_b = load_image(image_b_path)
+    if (ret_a != SUCCESS) or (ret_b != SUCCESS):
+        return IO_ERROR
+    try:
+        y_position, x_position, u, v = analyse_windows(image_a, image_b, window_size, overlap, precision=precision)
+    except ValueError as e:
+        warning(e)
+        return INVALID_DATA
+    y_grid, x_grid = np.meshgrid(y_position, x_position, indexing='ij')
+    return np.column_stack((y_grid.ravel(), x_grid.ravel(), u.ravel(), v.ravel()))
+
+
+def save_quiver(out_name, field_results):
+    """
+    Plot the displacement vectors of piv_analysis_2d results and save the figure as out_name
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.quiver(field_results[:, 1], field_results[:, 0], field_results[:, 2], field_results[:, 3],
+                angles='xy', scale_units='xy', scale=1)
+    axes.invert_yaxis()
+    axes.set_aspect('equal')
+    axes.set_title('PIV displacement field')
+    axes.set_xlabel('X position (pixel)')
+    axes.set_ylabel('Y position (pixel)')
+    figure.savefig(out_name)
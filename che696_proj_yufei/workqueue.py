@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+workqueue.py
+Work queue on a shared filesystem for analysing one sequence with many worker processes
+
+A queue is a directory holding
+  job.json                 frame paths, analysis parameters and the split into tasks
+  claims/task_000000       created exclusively by the worker that takes the task
+  shards/task_000000.npz   the results of the task, written under a temporary name and renamed
+
+Any number of workers, on one machine or on several machines that mount the directory at
+the same path, claim tasks until none is left. Only exclusive file creation, renames and
+modification times are used, which NFS supports, so no scheduler or database server is
+needed. A claim that has not been refreshed for claim_timeout seconds belongs to a worker
+that died and is taken over. Once every task has a shard, merge_queue assembles them in
+pair order into a ResultStore.
+"""
+
+import os
+import json
+import time
+import socket
+import numpy as np
+from .analyser import PivAnalyser
+from .correlation import PreFilter, DEF_MODE
+from .image_proc import warning, SUCCESS, DEF_PRECISION
+from .store import ResultStore, DEF_CHUNK_SIZE
+from .sequence import FrameSequence, write_checkpoint, sequence_digest
+
+DEF_TASK_SIZE = 256
+DEF_CLAIM_TIMEOUT = 300.0
+JOB_FILE_NAME = 'job.json'
+CLAIM_DIR_NAME = 'claims'
+SHARD_DIR_NAME = 'shards'
+TASK_NAME = 'task_{:06d}'
+
+
+def worker_name():
+    """
+    host:pid of this process, written into its claims
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def create_queue(queue_dir, image_paths, division_pixel, precision=DEF_PRECISION, task_size=DEF_TASK_SIZE,
+                 mode=DEF_MODE, prefilter=None):
+    """
+    Split the pairs of a sequence into tasks of task_size pairs
+
+    Task t covers the pairs whose first frame is one of frames t * task_size ... (t + 1) * task_size - 1.
+    Frames of another size than the first readable one are skipped by the workers.
+
+    :param queue_dir: directory of the new queue; must not exist yet
+    :param image_paths: paths of the frames in time order, as seen by every worker; multi-page TIFF
+                        and GIF files give all their pages (see FrameSequence)
+    :param division_pixel: Thickness (number of pixels) of horizontal stripes
+    :param precision: 'double' or 'single'
+    :param task_size: pairs per task
+    :param mode: correlation mode, one of MODES
+    :param prefilter: optional PreFilter of the stripes
+    :return: the job description; raises ValueError if no frame can be read
+    """
+    frames = FrameSequence(image_paths)
+    n_pairs = len(frames) - 1
+    frame_shape = None
+    for index in range(len(frames)):
+        image, ret = frames.load(index)
+        if ret == SUCCESS:
+            frame_shape = image.shape
+            break
+    frames.close()
+    if frame_shape is None:
+        raise ValueError('No frame of the sequence can be read')
+    job = {'image_paths': [os.path.abspath(image_path) for image_path in image_paths],
+           'division_pixel': division_pixel, 'precision': precision, 'mode': mode,
+           'prefilter': None if prefilter is None else prefilter.params(), 'task_size': task_size,
+           'frame_shape': frame_shape, 'n_frames': len(frames), 'n_tasks': -(-n_pairs // task_size)}
+    os.makedirs(os.path.join(queue_dir, CLAIM_DIR_NAME))
+    os.makedirs(os.path.join(queue_dir, SHARD_DIR_NAME))
+    job_path = os.path.join(queue_dir, JOB_FILE_NAME)
+    with open(job_path + '.tmp', 'w') as f:
+        json.dump(job, f, indent=1)
+    os.replace(job_path + '.tmp', job_path)
+    return job
+
+
+def read_job(queue_dir):
+    with open(os.path.join(queue_dir, JOB_FILE_NAME)) as f:
+        return json.load(f)
+
+
+def job_analyser(job):
+    """
+    PivAnalyser for the frame size of the job
+    """
+    # queues created before correlation modes and filters existed use plain cross-correlation
+    prefilter = job.get('prefilter')
+    return PivAnalyser(tuple(job['frame_shape']), job['division_pixel'], precision=job['precision'],
+                       mode=job.get('mode', DEF_MODE), prefilter=None if prefilter is None else PreFilter(**prefilter))
+
+
+def shard_path(queue_dir, task):
+    return os.path.join(queue_dir, SHARD_DIR_NAME, TASK_NAME.format(task) + '.npz')
+
+
+def claim_path(queue_dir, task):
+    return os.path.join(queue_dir, CLAIM_DIR_NAME, TASK_NAME.format(task))
+
+
+def claim_task(queue_dir, n_tasks, claim_timeout=DEF_CLAIM_TIMEOUT):
+    """
+    Claim the first task that has no shard and no live claim
+
+    :return: the task number, or None if every task is finished or claimed
+    """
+    for task in range(n_tasks):
+        if os.path.exists(shard_path(queue_dir, task)):
+            continue
+        path = claim_path(queue_dir, task)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(path) > claim_timeout
+                except OSError:
+                    # released in the meantime
+                    continue
+                if not stale:
+                    break
+                # only one of the workers that find the stale claim renames it away
+                try:
+                    os.rename(path, '{}.stale.{}'.format(path, worker_name()))
+                except OSError:
+                    break
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(worker_name() + '\n')
+            # the shard may have been renamed into place since the check above
+            if os.path.exists(shard_path(queue_dir, task)):
+                os.remove(path)
+                break
+            return task
+    return None
+
+
+def release_claim(path):
+    """
+    Remove a claim of this worker; a claim that was taken over by another worker is left alone
+    """
+    try:
+        with open(path) as f:
+            if f.read().strip() != worker_name():
+                return
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def run_task(job, task, claim=None, analyser=None, frames=None):
+    """
+    Analyse the pairs of one task
+
+    Every readable frame in the task's range is paired with the next readable frame of the
+    sequence, which may lie in the next task's range, so the shards join up exactly as a
+    single batch run would. Unreadable or wrongly sized frames are reported and skipped.
+
+    :param job: job description from create_queue
+    :param task: task number
+    :param claim: optional claim file, touched after every pair to keep the claim alive
+    :param analyser: optional PivAnalyser of the job to reuse, see job_analyser
+    :param frames: optional FrameSequence of the job to reuse
+    :return: y_position, displacements (n_pairs, n_stripes), frames [(frame_a, frame_b)], skipped paths
+    """
+    if analyser is None:
+        analyser = job_analyser(job)
+    if frames is None:
+        frames = FrameSequence(job['image_paths'])
+    start = task * job['task_size']
+    last = len(frames) - 1
+    stop = min(start + job['task_size'], last)
+    y_position = np.empty(0)
+    displacements = []
+    pairs = []
+    skipped = []
+    previous = None
+    for index in range(start, len(frames)):
+        image, ret = frames.load(index)
+        if ret == SUCCESS and image.shape != analyser.frame_shape:
+            ret = 'size {} differs from {}'.format(image.shape, analyser.frame_shape)
+        if ret != SUCCESS:
+            # a frame after the range is reported by the task that owns it
+            if index < stop or index == stop == last:
+                warning("Skipping frame {}:".format(frames.name(index)), ret)
+                skipped.append(frames.name(index))
+            continue
+        if previous is not None:
+            piv_results = analyser.analyse(previous_image, image)
+            y_position = piv_results[:, 0].copy()
+            displacements.append(piv_results[:, 1].copy())
+            pairs.append((os.path.basename(frames.name(previous)), os.path.basename(frames.name(index))))
+            if claim is not None:
+                try:
+                    os.utime(claim)
+                except OSError:
+                    # taken over as stale; the shard is still valid
+                    claim = None
+        if index >= stop:
+            break
+        previous, previous_image = index, image
+    displacements = np.array(displacements).reshape(len(pairs), y_position.size)
+    return y_position, displacements, pairs, skipped
+
+
+def write_shard(queue_dir, task, y_position, displacements, frames, skipped):
+    """
+    Write the results of a task under a temporary name and rename them into place
+    """
+    path = shard_path(queue_dir, task)
+    tmp_path = '{}.{}.tmp'.format(path, worker_name())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, y_position=y_position, displacements=displacements,
+                 frames=np.array(frames, dtype=str).reshape(len(frames), 2), skipped=np.array(skipped, dtype=str))
+    os.replace(tmp_path, path)
+
+
+def run_worker(queue_dir, claim_timeout=DEF_CLAIM_TIMEOUT, max_tasks=None):
+    """
+    Claim and analyse tasks until none is left
+
+    :param queue_dir: directory of the queue
+    :param claim_timeout: seconds after which a claim that is not refreshed is taken over
+    :param max_tasks: optional largest number of tasks to do
+    :return: the numbers of the tasks this worker finished
+    """
+    job = read_job(queue_dir)
+    analyser = job_analyser(job)
+    frames = FrameSequence(job['image_paths'])
+    done = []
+    try:
+        while max_tasks is None or len(done) < max_tasks:
+            task = claim_task(queue_dir, job['n_tasks'], claim_timeout)
+            if task is None:
+                break
+            claim = claim_path(queue_dir, task)
+            y_position, displacements, pairs, skipped = run_task(job, task, claim, analyser, frames)
+            write_shard(queue_dir, task, y_position, displacements, pairs, skipped)
+            release_claim(claim)
+            done.append(task)
+    finally:
+        frames.close()
+    return done
+
+
+def queue_status(queue_dir):
+    """
+    Numbers of finished, claimed and waiting tasks
+    """
+    job = read_job(queue_dir)
+    finished = claimed = 0
+    for task in range(job['n_tasks']):
+        if os.path.exists(shard_path(queue_dir, task)):
+            finished += 1
+        elif os.path.exists(claim_path(queue_dir, task)):
+            claimed += 1
+    return {'finished': finished, 'claimed': claimed, 'waiting': job['n_tasks'] - finished - claimed}
+
+
+def merge_queue(queue_dir, store_path, chunk_size=DEF_CHUNK_SIZE):
+    """
+    Assemble the shards of a finished queue, in pair order, into a ResultStore
+
+    The store gets a completed checkpoint, as if it had been written by a single batch run.
+
+    :return: the closed ResultStore, or None if the sequence has fewer than two readable frames;
+             raises ValueError if a task has no shard yet
+    """
+    job = read_job(queue_dir)
+    missing = [task for task in range(job['n_tasks']) if not os.path.exists(shard_path(queue_dir, task))]
+    if missing:
+        raise ValueError('Tasks of queue {} are not finished: {}'.format(queue_dir, ', '.join(map(str, missing))))
+    store = None
+    skipped = []
+    for task in range(job['n_tasks']):
+        with np.load(shard_path(queue_dir, task)) as shard:
+            skipped.extend(shard['skipped'].tolist())
+            frames = shard['frames']
+            if not len(frames):
+                continue
+            if store is None:
+                store = ResultStore.create(store_path, shard['y_position'], chunk_size=chunk_size,
+                                           attrs={'division_pixel': job['division_pixel'],
+                                                  'precision': job['precision'],
+                                                  'mode': job.get('mode', DEF_MODE),
+                                                  'prefilter': job.get('prefilter')})
+            for (frame_a, frame_b), displacement in zip(frames, shard['displacements']):
+                store.append(frame_a, frame_b, displacement)
+    if store is None:
+        return None
+    store.close()
+    write_checkpoint(store_path, {'sequence': sequence_digest(job['image_paths']),
+                                  'n_frames': job['n_frames'], 'n_pairs': len(store),
+                                  'next_frame': job['n_frames'] - 1, 'skipped': skipped, 'complete': True})
+    return store
@@ -28,6 +28,7 @@ setup(
                   },
 
     entry_points={'console_scripts': ['image_proc = che696_proj_yufei.image_proc:main',
+                                      'image_proc_client = che696_proj_yufei.client:main',
                                       ],
                   },     package_dir={'che696_proj_yufei': 'che696_proj_yufei'},
 
@@ -1 +1,11 @@
 # -*- coding: utf-8 -*-
+
+import atexit
+import os
+import shutil
+import tempfile
+
+# the auto-tuner's backend cache of the test run, instead of the one in the home directory
+_CACHE_DIR = tempfile.mkdtemp()
+os.environ['PIV_CACHE_DIR'] = _CACHE_DIR
+atexit.register(shutil.rmtree, _CACHE_DIR, ignore_errors=True)
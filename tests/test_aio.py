@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the asyncio interface.
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from che696_proj_yufei.image_proc import piv_analysis, IO_ERROR, INVALID_DATA
+from che696_proj_yufei.correlation import PreFilter
+from che696_proj_yufei.aio import piv_analysis_async, AsyncPairIterator, decode_frame
+from .test_sequence import drifting_frames
+from .test_image_proc import capture_stderr
+
+CURRENT_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    # thread pool that counts its calls and the most of them running at once, each taking at least delay seconds
+    def __init__(self, max_workers=4, delay=0.0):
+        super(CountingExecutor, self).__init__(max_workers)
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(self.delay)
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        self.calls.append((fn, args))
+        return super(CountingExecutor, self).submit(self._run, fn, *args)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestPivAnalysisAsync(unittest.TestCase):
+    def testSampleData(self):
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)
+        piv_results = run(piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5))
+        self.assertTrue(np.array_equal(piv_results, expected_results))
+
+    def testErrors(self):
+        self.assertEqual(run(piv_analysis_async("ghost.bmp", SAMPLE_DATA_FILE_LOC[1], 5)), IO_ERROR)
+        different = [os.path.join(CURRENT_DIR, 'data_proc', 'sample2_im1.bmp'),
+                     os.path.join(CURRENT_DIR, 'data_proc', 'sample2_im2_crop.jpg')]
+        with capture_stderr(run, piv_analysis_async(different[0], different[1], 5)) as output:
+            self.assertTrue("different sizes" in output)
+        self.assertEqual(run(piv_analysis_async(different[0], different[1], 5)), INVALID_DATA)
+
+    def testConcurrent(self):
+        # Pairs run concurrently up to the semaphore, and the event loop keeps running meanwhile
+        executor = CountingExecutor(max_workers=8, delay=0.05)
+        ticks = []
+
+        async def ticker(done):
+            while not done.is_set():
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.005)
+
+        async def analyse_all():
+            semaphore = asyncio.Semaphore(2)
+            done = asyncio.Event()
+            ticking = asyncio.ensure_future(ticker(done))
+            results = await asyncio.gather(*[piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                                                correlate_executor=executor, semaphore=semaphore)
+                                             for _ in range(6)])
+            done.set()
+            await ticking
+            return results
+
+        try:
+            results = run(analyse_all())
+        finally:
+            executor.shutdown()
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20)
+        for piv_results in results:
+            self.assertTrue(np.array_equal(piv_results, expected_results))
+        self.assertEqual(executor.most_running, 2)
+        self.assertTrue(len(ticks) > 10)
+
+    def testCancel(self):
+        executor = CountingExecutor(delay=0.3)
+
+        async def cancel_one():
+            semaphore = asyncio.Semaphore(1)
+            task = asyncio.ensure_future(piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5,
+                                                            decode_executor=executor, semaphore=semaphore))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # the semaphore was released
+            self.assertFalse(semaphore.locked())
+
+        try:
+            run(cancel_one())
+        finally:
+            executor.shutdown()
+
+    def testModes(self):
+        prefilter = PreFilter(highpass=4, taper='hann')
+        for mode, pair_filter in (('zncc', None), ('phase', prefilter), ('cross', prefilter)):
+            piv_results = run(piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20, mode=mode,
+                                                 prefilter=pair_filter))
+            self.assertTrue(np.array_equal(piv_results, piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1],
+                                                                     20, mode=mode, prefilter=pair_filter)), mode)
+        with self.assertRaises(ValueError):
+            run(piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20, mode='zncc',
+                                   prefilter=prefilter))
+
+    def testProcessPool(self):
+        with ProcessPoolExecutor(2) as executor:
+            piv_results = run(piv_analysis_async(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5,
+                                                 correlate_executor=executor))
+        self.assertTrue(np.array_equal(piv_results, piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)))
+
+
+class TestAsyncPairIterator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_paths = []
+        for i, frame in enumerate(drifting_frames(9, 2)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            Image.fromarray(np.roll(frame, i * i % 5, axis=1).astype(np.uint8)).save(image_path)
+            self.image_paths.append(image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def collect(self, pairs):
+        async def collect():
+            results = []
+            async with pairs:
+                async for result in pairs:
+                    results.append(result)
+            return results
+        return run(collect())
+
+    def testSequence(self):
+        # Pairs come in order, each frame is decoded once and at most max_in_flight pairs are correlated at once
+        decode_executor = CountingExecutor()
+        correlate_executor = CountingExecutor(max_workers=8, delay=0.02)
+        try:
+            results = self.collect(AsyncPairIterator(self.image_paths, 20, max_in_flight=3,
+                                                     decode_executor=decode_executor,
+                                                     correlate_executor=correlate_executor))
+        finally:
+            decode_executor.shutdown()
+            correlate_executor.shutdown()
+        self.assertEqual([result[:2] for result in results], list(zip(self.image_paths[:-1], self.image_paths[1:])))
+        for image_a_path, image_b_path, piv_results in results:
+            self.assertTrue(np.array_equal(piv_results, piv_analysis(image_a_path, image_b_path, 20)))
+        self.assertEqual(sorted(args[0] for fn, args in decode_executor.calls), self.image_paths)
+        self.assertTrue(all(fn is decode_frame for fn, args in decode_executor.calls))
+        self.assertEqual(correlate_executor.most_running, 3)
+
+    def testModes(self):
+        prefilter = PreFilter(lowpass=1.0, taper='tukey')
+        results = self.collect(AsyncPairIterator(self.image_paths[:4], 20, mode='phase', prefilter=prefilter))
+        for image_a_path, image_b_path, piv_results in results:
+            self.assertTrue(np.array_equal(piv_results, piv_analysis(image_a_path, image_b_path, 20, mode='phase',
+                                                                     prefilter=prefilter)))
+        with self.assertRaises(ValueError):
+            AsyncPairIterator(self.image_paths, 20, mode='ghost')
+
+    def testBadFrame(self):
+        with open(self.image_paths[4], 'wb') as f:
+            f.write(b'not an image')
+        with self.assertRaises(OSError):
+            self.collect(AsyncPairIterator(self.image_paths, 20))
+
+    def testClose(self):
+        # Leaving the loop early cancels the pairs in flight
+        async def first():
+            async with AsyncPairIterator(self.image_paths, 20, max_in_flight=4) as pairs:
+                async for result in pairs:
+                    tasks = [task for pair, task in pairs._in_flight]
+                    break
+            await asyncio.sleep(0)
+            return tasks
+        tasks = run(first())
+        self.assertEqual(len(tasks), 4)
+        self.assertTrue(all(task.done() for task in tasks))
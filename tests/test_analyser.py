@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the reusable PivAnalyser.
+"""
+
+import os
+import tracemalloc
+import unittest
+import numpy as np
+from che696_proj_yufei.analyser import PivAnalyser
+from che696_proj_yufei.benchmark import synthetic_pair
+from che696_proj_yufei.correlation import MODES, PreFilter
+from che696_proj_yufei.image_proc import load_image, piv_analysis, analyse_images
+
+CURRENT_DIR = os.path.dirname(__file__)
+TEST_DATA_DIR = os.path.join(CURRENT_DIR, 'data_proc')
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class TestPivAnalyser(unittest.TestCase):
+    def setUp(self):
+        self.image_a = load_image(SAMPLE_DATA_FILE_LOC[0])[0]
+        self.image_b = load_image(SAMPLE_DATA_FILE_LOC[1])[0]
+
+    def testSampleData(self):
+        # Same results as piv_analysis, in both precisions
+        for division_pixel in (5, 20):
+            expected_results = np.loadtxt(fname=os.path.join(TEST_DATA_DIR, "sample_results_ndiv{}.csv".format(
+                division_pixel)), delimiter=',')
+            for precision in ('double', 'single'):
+                analyser = PivAnalyser(self.image_a.shape, division_pixel, precision=precision)
+                self.assertTrue(np.allclose(expected_results, analyser.analyse(self.image_a, self.image_b)))
+
+    def testReuse(self):
+        # Results of a second, different pair do not depend on the first one
+        image_a, image_b = synthetic_pair(200, 300, 1.0, 0.04)
+        analyser = PivAnalyser(image_a.shape, 10)
+        analyser.analyse(self.image_a[:200, :300], self.image_b[:200, :300])
+        out = np.empty((analyser.n_stripes, 2))
+        analyser.analyse(image_a, image_b, out=out)
+        fresh = PivAnalyser(image_a.shape, 10).analyse(image_a, image_b)
+        self.assertTrue(np.array_equal(out, fresh))
+
+    def testModes(self):
+        # Same results as analyse_images with the scipy_fft backend, in every correlation mode
+        for mode in MODES:
+            for precision in ('double', 'single'):
+                analyser = PivAnalyser(self.image_a.shape, 5, precision=precision, mode=mode)
+                expected_results = analyse_images(self.image_a, self.image_b, 5, backend='scipy_fft',
+                                                  precision=precision, mode=mode)
+                self.assertTrue(np.array_equal(expected_results, analyser.analyse(self.image_a, self.image_b)),
+                                mode + ' ' + precision)
+        with self.assertRaises(ValueError):
+            PivAnalyser(self.image_a.shape, 5, mode='ghost')
+
+    def testUniformBand(self):
+        # Phase correlation of each stripe is whitened on its own, so a uniform stripe changes no other
+        image_a, image_b = synthetic_pair(60, 200, 4.0, 0.0)
+        analyser = PivAnalyser(image_a.shape, 10, mode='phase')
+        expected = analyser.analyse(image_a, image_b).copy()
+        image_a[:10] = image_b[:10] = 0
+        with np.errstate(invalid='ignore'):
+            results = analyser.analyse(image_a, image_b)
+            self.assertTrue(np.array_equal(results, analyse_images(image_a, image_b, 10, mode='phase')))
+        self.assertTrue(np.array_equal(results[1:], expected[1:]))
+
+    def testPreFilter(self):
+        for prefilter in (PreFilter(highpass=4, lowpass=1), PreFilter(taper='hann')):
+            for mode in ('cross', 'phase'):
+                analyser = PivAnalyser(self.image_a.shape, 5, mode=mode, prefilter=prefilter)
+                expected_results = analyse_images(self.image_a, self.image_b, 5, backend='scipy_fft', mode=mode,
+                                                  prefilter=prefilter)
+                self.assertTrue(np.array_equal(expected_results, analyser.analyse(self.image_a, self.image_b)), mode)
+        with self.assertRaises(ValueError):
+            PivAnalyser(self.image_a.shape, 5, mode='zncc', prefilter=PreFilter(highpass=4))
+
+    def testNoAllocation(self):
+        # In steady state an analysis allocates no arrays, only a few small Python objects
+        for mode, prefilter in [(mode, None) for mode in MODES] + [('cross', PreFilter(4, 1, 'hann'))]:
+            analyser = PivAnalyser(self.image_a.shape, 5, mode=mode, prefilter=prefilter)
+            out = np.empty((analyser.n_stripes, 2))
+            analyser.analyse(self.image_a, self.image_b, out=out)
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                analyser.analyse(self.image_a, self.image_b, out=out)
+                peak = tracemalloc.get_traced_memory()[1] - start
+            finally:
+                tracemalloc.stop()
+            # far less than a single row of stripes
+            self.assertLess(peak, 2 * self.image_a.shape[1] * 8, mode)
+
+    def testWrongShape(self):
+        analyser = PivAnalyser((100, 100), 5)
+        with self.assertRaises(ValueError):
+            analyser.analyse(self.image_a, self.image_b)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the rolling background of sequences.
+"""
+
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+import numpy as np
+from PIL import Image
+from che696_proj_yufei.analyser import PivAnalyser
+from che696_proj_yufei.background import Background, RollingWindow
+from che696_proj_yufei.image_proc import main, SUCCESS, INVALID_DATA
+from che696_proj_yufei.sequence import run_batch, read_checkpoint
+from che696_proj_yufei.store import ResultStore
+from .test_sequence import drifting_frames, Interrupted, CrashingStatistics
+from .test_image_proc import capture_stderr
+
+
+def scratched_frames(n_frames, step):
+    # drifting frames behind bright static scratches and a reflection that varies along x
+    rng = np.random.RandomState(3)
+    static = 40 * rng.rand(1, 400) + np.zeros((200, 400))
+    static[:, 50:53] += 400
+    static[:, 200:202] += 300
+    return [frame + static for frame in drifting_frames(n_frames, step)]
+
+
+def iter_pairs(frames, division_pixel, background=None):
+    # displacement profiles of consecutive frames, with the background run_batch subtracts
+    analyser = PivAnalyser(frames[0].shape, division_pixel, background=background)
+    for i, image in enumerate(frames):
+        if background is not None:
+            analyser.push_background(image)
+        if i:
+            yield analyser.analyse(frames[i - 1], image).copy()
+
+
+class TestRollingWindow(unittest.TestCase):
+    def testBruteForce(self):
+        # Incremental updates give the mean or minimum of the most recent frames
+        rng = np.random.RandomState(0)
+        for method, func in (('mean', np.mean), ('min', np.min)):
+            for window in (2, 3, 5):
+                rolling = RollingWindow((4, 6), window, method)
+                history = []
+                for _ in range(23):
+                    history.append(rng.rand(4, 6))
+                    rolling.push(history[-1])
+                    self.assertTrue(np.allclose(rolling.value, func(history[-window:], axis=0)), method)
+                self.assertEqual(len(rolling), window)
+                rolling.reset()
+                self.assertEqual(len(rolling), 0)
+                self.assertTrue(np.array_equal(rolling.push(history[0]), history[0]))
+
+    def testNoAllocation(self):
+        # Memory does not grow with the length of the sequence
+        for method in ('mean', 'min'):
+            rolling = RollingWindow((300, 400), 4, method)
+            frame = np.ones((300, 400))
+            for _ in range(6):
+                rolling.push(frame)
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                for _ in range(9):
+                    rolling.push(frame)
+                peak = tracemalloc.get_traced_memory()[1] - start
+            finally:
+                tracemalloc.stop()
+            self.assertLess(peak, 400 * 8, method)
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            Background('median')
+        with self.assertRaises(ValueError):
+            Background(window=1)
+        with self.assertRaises(ValueError):
+            Background(level='pixel')
+        self.assertEqual(Background(**Background('mean', 5, 'stripe').params()).params(),
+                         {'method': 'mean', 'window': 5, 'level': 'stripe'})
+
+
+class TestBackgroundSequence(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.directory, 'run.pivstore')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testStaticScratches(self):
+        # Static features pin the peak at zero lag until the background is subtracted; after
+        # the first pair, whose background comes from only two frames, the drift is found
+        frames = scratched_frames(16, 3)
+        for piv_results in iter_pairs(frames, 20):
+            self.assertTrue(np.all(piv_results[:, 1] == 0))
+        for method in ('mean', 'min'):
+            for level in ('frame', 'stripe'):
+                shifts = np.array([piv_results[:, 1] for piv_results in
+                                   iter_pairs(frames, 20, background=Background(method, 6, level))])
+                self.assertTrue(np.all(shifts[1:] == 3), method + ' ' + level)
+
+    def testStripeLevelMean(self):
+        # The mean is linear, so its stripe-level background gives the frame-level results; the
+        # first pair is left out: less their two-frame mean, its frames are mirror images and
+        # rounding decides between equal peaks
+        frames = scratched_frames(8, 2)
+        frame_level = list(iter_pairs(frames, 10, background=Background('mean', 4, 'frame')))
+        stripe_level = list(iter_pairs(frames, 10, background=Background('mean', 4, 'stripe')))
+        self.assertTrue(np.array_equal(frame_level[1:], stripe_level[1:]))
+
+    def testAnalyserNoAllocation(self):
+        frames = scratched_frames(12, 3)
+        analyser = PivAnalyser(frames[0].shape, 5, background=Background('min', 4))
+        out = np.empty((analyser.n_stripes, 2))
+        for frame in frames[:10]:
+            analyser.push_background(frame)
+        analyser.analyse(frames[8], frames[9], out=out)
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            analyser.push_background(frames[10])
+            analyser.analyse(frames[9], frames[10], out=out)
+            peak = tracemalloc.get_traced_memory()[1] - start
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 2 * frames[0].shape[1] * 8)
+        with self.assertRaises(ValueError):
+            analyser.push_background(frames[0][:100])
+
+    def testResume(self):
+        # A resumed run refills the background window with the frames before its first frame
+        image_paths = []
+        for i, frame in enumerate(scratched_frames(15, 2)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            if i == 5:
+                with open(image_path, 'wb') as f:
+                    f.write(b'not an image')
+            else:
+                Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(image_path)
+            image_paths.append(image_path)
+        background = Background('min', 5)
+        with capture_stderr(run_batch, image_paths, 20, os.path.join(self.directory, 'reference.pivstore'),
+                            background=background):
+            pass
+        reference = ResultStore(os.path.join(self.directory, 'reference.pivstore'))
+        with capture_stderr(self.assertRaises, Interrupted, run_batch, image_paths, 20, self.store_path,
+                            chunk_size=4, statistics=CrashingStatistics(10), background=background):
+            pass
+        self.assertEqual(read_checkpoint(self.store_path)['next_frame'], 9)
+        with capture_stderr(run_batch, image_paths, 20, self.store_path, chunk_size=4, background=background):
+            pass
+        store = ResultStore(self.store_path)
+        self.assertEqual(store.frames, reference.frames)
+        self.assertTrue(np.array_equal(store.displacements(), reference.displacements()))
+        self.assertEqual(store.attrs['background'], background.params())
+
+    def testMain(self):
+        image_paths = []
+        for i, frame in enumerate(scratched_frames(8, 3)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(image_path)
+            image_paths.append(image_path)
+        self.assertEqual(main(["-s"] + image_paths + ["-d", "20", "-o", self.store_path, "--background", "min",
+                               "--background_window", "4", "--background_level", "stripe"]), SUCCESS)
+        displacements = ResultStore(self.store_path).displacements()
+        self.assertTrue(np.all(displacements[1:] == 3))
+        with capture_stderr(main, ["-m"] + image_paths[:2] + ["--background", "min"]) as output:
+            self.assertTrue("--background" in output)
+        self.assertEqual(main(["-s"] + image_paths + ["--background", "min", "--background_window", "1"]),
+                         INVALID_DATA)
+        self.assertEqual(main(["-s"] + image_paths + ["--background", "min", "-l", "2"]), INVALID_DATA)
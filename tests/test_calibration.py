@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the rotation and dewarp of frames.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+from che696_proj_yufei.benchmark import synthetic_pair
+from che696_proj_yufei.calibration import Calibration
+from che696_proj_yufei.image_proc import main, piv_analysis, analyse_images, load_image, SUCCESS, INVALID_DATA
+from che696_proj_yufei.sequence import run_batch, run_stream
+from che696_proj_yufei.store import ResultStore
+from .test_image_proc import silent_remove, capture_stdout, capture_stderr, DISABLE_REMOVE
+
+
+def tilted_frames(angle):
+    # a uniform flow of 8 pixels per frame along a direction at angle degrees to the x axis
+    image_a, image_b = synthetic_pair(400, 600, 8.0, 0.0)
+    return [ndimage.rotate(image.astype(float), angle, reshape=False, order=1) for image in (image_a, image_b)]
+
+
+class TestCalibration(unittest.TestCase):
+    def testLinearField(self):
+        # Bilinear interpolation reproduces a linear brightness field at every source point
+        y, x = np.mgrid[:300, :500]
+        frame = 2.0 * x + 3.0 * y + 1
+        for calibration in (Calibration(3.0), Calibration(-2.0, -0.05, 0.01), Calibration(0, 0.03, center=(200, 140))):
+            corrected = calibration.apply(frame)
+            self.assertLess(corrected.shape[0], 300)
+            x_source, y_source = calibration.source_points(frame.shape, corrected.shape)
+            self.assertTrue(np.allclose(corrected, 2.0 * x_source + 3.0 * y_source + 1, atol=1e-3))
+            self.assertTrue(x_source.min() >= 0 and x_source.max() <= 499)
+            self.assertTrue(y_source.min() >= 0 and y_source.max() <= 299)
+        nearest = Calibration(3.0, interpolation='nearest').apply(frame)
+        self.assertTrue(np.allclose(nearest, Calibration(3.0).apply(frame), atol=2.5))
+
+    def testCache(self):
+        # The remap table is computed once per frame shape
+        calibration = Calibration(2.0, -0.02)
+        table = calibration.remap_table((120, 200))
+        self.assertIs(calibration.remap_table((120, 200)), table)
+        self.assertIsNot(calibration.remap_table((100, 200)), table)
+        self.assertEqual(table.index.dtype, np.int32)
+        frame = np.arange(120 * 200).reshape(120, 200)
+        self.assertEqual(calibration.apply(frame).shape, table.shape)
+        with self.assertRaises(ValueError):
+            table.apply(frame[:100])
+        # without tilt or distortion, frames are unchanged
+        self.assertTrue(np.allclose(Calibration().apply(frame), frame))
+
+    def testTilt(self):
+        # Stripes across a tilted flow decorrelate; the corrected frames give the displacement
+        frames = tilted_frames(20)
+        self.assertFalse(np.all(analyse_images(frames[0][100:300, 150:450], frames[1][100:300, 150:450],
+                                               4)[:, 1] == 8))
+        calibration = Calibration(20)
+        piv_results = analyse_images(calibration.apply(frames[0]), calibration.apply(frames[1]), 4)
+        self.assertTrue(np.all(piv_results[:, 1] == 8))
+        # the opposite tilt makes it worse
+        calibration = Calibration(-20)
+        piv_results = analyse_images(calibration.apply(frames[0]), calibration.apply(frames[1]), 4)
+        self.assertFalse(np.all(piv_results[:, 1] == 8))
+
+    def testParams(self):
+        calibration = Calibration(1.5, -0.1, 0.02, (100, 50), 'nearest')
+        self.assertEqual(Calibration(**calibration.params()).params(), calibration.params())
+        self.assertEqual(calibration.reduced(2).center, (49.75, 24.75))
+        with self.assertRaises(ValueError):
+            Calibration(interpolation='cubic')
+        with self.assertRaises(ValueError):
+            Calibration(center=(1, 2, 3))
+        with self.assertRaises(ValueError):
+            Calibration(center=(-100, 40)).remap_table((50, 80))
+
+
+class TestCalibrationLoader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_paths = []
+        for i, frame in enumerate(tilted_frames(20)):
+            self.image_paths.append(os.path.join(self.directory, 'tilted_{}.bmp'.format(i)))
+            Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(self.image_paths[-1])
+        self.calibration_path = os.path.join(self.directory, 'camera.json')
+        with open(self.calibration_path, 'w') as f:
+            json.dump({'angle': 20}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testLoadImage(self):
+        calibration = Calibration(20)
+        image, ret = load_image(self.image_paths[0], calibration=calibration)
+        self.assertEqual(ret, SUCCESS)
+        self.assertEqual(image.shape, calibration.remap_table((400, 600)).shape)
+        with capture_stderr(load_image, self.image_paths[0], calibration=Calibration(center=(-100, 40))) as output:
+            self.assertTrue("Cannot correct image" in output)
+        # quick look of the corrected frames
+        piv_results = piv_analysis(self.image_paths[0], self.image_paths[1], 8, reduce=2, calibration=calibration)
+        self.assertTrue(np.all(piv_results[:, 1] == 8))
+
+    def testSequence(self):
+        store_path = os.path.join(self.directory, 'run.pivstore')
+        calibration = Calibration(20)
+        run_batch(self.image_paths, 4, store_path, calibration=calibration)
+        store = ResultStore(store_path)
+        self.assertTrue(np.all(store.displacements() == 8))
+        self.assertEqual(store.attrs['calibration'], calibration.params())
+        # raw frames of the camera
+        frames = [np.asarray(Image.open(image_path)) for image_path in self.image_paths]
+        stream = io.BytesIO(b''.join(frame.tobytes() for frame in frames))
+        stream_store = run_stream(stream, frames[0].shape, 4, os.path.join(self.directory, 'raw.pivstore'),
+                                  calibration=calibration)
+        self.assertTrue(np.array_equal(ResultStore(stream_store.path).displacements(), store.displacements()))
+
+    def testMain(self):
+        out_names = ["piv_results_tilted_0_tilted_1.csv", "piv_results_tilted_0_tilted_1.png"]
+        try:
+            with capture_stdout(main, ["-m"] + self.image_paths + ["-d", "4", "--calibration",
+                                                                   self.calibration_path]) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.all(np.loadtxt(out_names[0], delimiter=',')[:, 1] == 8))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+        with open(self.calibration_path, 'w') as f:
+            json.dump({'tilt': 20}, f)
+        with capture_stderr(main, ["-m"] + self.image_paths + ["--calibration", self.calibration_path]) as output:
+            self.assertTrue("tilt" in output)
+        self.assertEqual(main(["-m"] + self.image_paths + ["--windows", "32", "--calibration",
+                                                           self.calibration_path]), INVALID_DATA)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the SQLite catalogue of result stores.
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+from che696_proj_yufei.catalogue import add_store, connect, file_hash, find_pairs, profile_summary
+from che696_proj_yufei.correlation import PreFilter
+from che696_proj_yufei.image_proc import main, SUCCESS
+from che696_proj_yufei.store import ResultStore
+
+CURRENT_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class TestProfileSummary(unittest.TestCase):
+    def testLinearProfile(self):
+        y_position = np.arange(2.5, 100, 5.0)
+        displacements = np.array([0.2 * y_position + 1, -0.1 * y_position])
+        summary = profile_summary(y_position, displacements)
+        self.assertTrue(np.allclose(summary['shear_rate'], [0.2, -0.1]))
+        self.assertTrue(np.allclose(summary['wall'], displacements[:, -1]))
+        self.assertTrue(np.allclose(summary['mean'], displacements.mean(axis=1)))
+
+
+class TestCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'catalogue.sqlite')
+        y_position = np.arange(5.0, 100, 10.0)
+        self.stores = []
+        for run, division_pixel in enumerate((10, 20)):
+            store = ResultStore.create(os.path.join(self.directory, 'run{}.pivstore'.format(run)), y_position,
+                                       chunk_size=4, attrs={'division_pixel': division_pixel, 'precision': 'double'})
+            for pair in range(10):
+                store.append('f{}.bmp'.format(pair), 'f{}.bmp'.format(pair + 1), 0.1 * pair * y_position)
+            store.close()
+            self.stores.append(store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testQuery(self):
+        for store in self.stores:
+            add_store(self.db_path, store)
+        rows = find_pairs(self.db_path, division_pixel=10, min_wall_displacement=50)
+        # wall displacement is 9.5 * pair
+        self.assertEqual([row[1] for row in rows], [6, 7, 8, 9])
+        store_path, pair, frame_a, frame_b, frame_time, wall, shear_rate, chunk, chunk_row = rows[0]
+        self.assertEqual((frame_a, frame_b, chunk, chunk_row), ('f6.bmp', 'f7.bmp', 1, 2))
+        self.assertAlmostEqual(shear_rate, 0.6)
+        # the pointer leads back to the full profile
+        self.assertTrue(np.allclose(ResultStore(store_path).displacement(pair), 0.6 * np.arange(5.0, 100, 10.0)))
+        # pair 9 of both runs
+        self.assertEqual(len(find_pairs(self.db_path, min_shear_rate=0.85)), 2)
+
+    def testReplace(self):
+        # Cataloguing a store again replaces its rows
+        add_store(self.db_path, self.stores[0])
+        add_store(self.db_path, self.stores[0])
+        conn = connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM pairs").fetchone()[0], 10)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0], 1)
+        conn.close()
+
+    def testMain(self):
+        store_path = os.path.join(self.directory, 'sample.pivstore')
+        test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], "-d", "20", "-o", store_path,
+                      "-c", self.db_path]
+        self.assertEqual(main(test_input), SUCCESS)
+        conn = connect(self.db_path)
+        hash_a, hash_b, frame_time = conn.execute("SELECT hash_a, hash_b, frame_time FROM pairs").fetchone()
+        conn.close()
+        self.assertEqual(hash_a, file_hash(SAMPLE_DATA_FILE_LOC[0]))
+        self.assertEqual(hash_b, file_hash(SAMPLE_DATA_FILE_LOC[1]))
+        self.assertEqual(frame_time, os.path.getmtime(SAMPLE_DATA_FILE_LOC[0]))
+        self.assertEqual(find_pairs(self.db_path, division_pixel=20)[0][2], 'sample_im1.bmp')
+
+    def testRunParameters(self):
+        store_path = os.path.join(self.directory, 'phase.pivstore')
+        test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], "-d", "20", "-o", store_path,
+                      "-c", self.db_path, "--mode", "phase", "--highpass", "4"]
+        self.assertEqual(main(test_input), SUCCESS)
+        conn = connect(self.db_path)
+        mode, prefilter, background = conn.execute("SELECT mode, prefilter, background FROM runs").fetchone()
+        conn.close()
+        self.assertEqual(mode, 'phase')
+        self.assertEqual(json.loads(prefilter), PreFilter(highpass=4).params())
+        self.assertIsNone(background)
+
+    def testOldCatalogue(self):
+        # A catalogue written before the runs table had the mode and filter columns gains them
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE runs (run_id INTEGER PRIMARY KEY, store_path TEXT UNIQUE NOT NULL, "
+                     "division_pixel INTEGER, precision TEXT, n_stripes INTEGER, n_pairs INTEGER, catalogued REAL)")
+        conn.close()
+        add_store(self.db_path, self.stores[0])
+        self.assertEqual(len(find_pairs(self.db_path, division_pixel=10)), 10)
+
+    def testSameFileNames(self):
+        # Frames of different directories with the same file name are told apart by their full path
+        image_paths = []
+        for i, image_path in enumerate(SAMPLE_DATA_FILE_LOC):
+            os.makedirs(os.path.join(self.directory, 'camera{}'.format(i)))
+            image_paths.append(os.path.join(self.directory, 'camera{}'.format(i), 'frame.bmp'))
+            shutil.copy(image_path, image_paths[-1])
+        store = ResultStore.create(os.path.join(self.directory, 'cameras.pivstore'), np.arange(5.0, 100, 10.0))
+        store.append(image_paths[0], image_paths[1], np.zeros(10))
+        store.close()
+        add_store(self.db_path, store, image_paths)
+        conn = connect(self.db_path)
+        hash_a, hash_b = conn.execute("SELECT hash_a, hash_b FROM pairs").fetchone()
+        conn.close()
+        self.assertEqual((hash_a, hash_b), (file_hash(SAMPLE_DATA_FILE_LOC[0]), file_hash(SAMPLE_DATA_FILE_LOC[1])))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the correlation backends.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from che696_proj_yufei import correlation
+from che696_proj_yufei.correlation import BACKENDS, MODES, select_backend, correlate_stripes, PreFilter
+from che696_proj_yufei.image_proc import (main, piv_analysis, x_corr, analyse_images, divid_image, stripe_mask,
+                                         reduce_mask, INVALID_DATA, SUCCESS)
+from che696_proj_yufei.benchmark import synthetic_pair
+from .test_image_proc import silent_remove, capture_stdout, capture_stderr, DISABLE_REMOVE
+
+CURRENT_DIR = os.path.dirname(__file__)
+TEST_DATA_DIR = os.path.join(CURRENT_DIR, 'data_proc')
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class TestBackends(unittest.TestCase):
+    def testSampleData(self):
+        # Every backend must reproduce the saved reference results
+        for division_pixel in (5, 20):
+            expected_results = np.loadtxt(fname=os.path.join(TEST_DATA_DIR, "sample_results_ndiv{}.csv".format(
+                division_pixel)), delimiter=',')
+            for backend in BACKENDS:
+                analysis_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], division_pixel,
+                                                backend=backend)
+                self.assertTrue(np.allclose(expected_results, analysis_results), backend)
+
+    def testSineShift(self):
+        x1 = np.linspace(0, 20, 500)
+        for backend in BACKENDS:
+            self.assertEqual(x_corr([np.sin(x1)], [np.sin(x1 + 1)], backend=backend)[0], -23., backend)
+
+    def testMaxLag(self):
+        # Restricting the search window clips the peak to the window edge
+        x1 = np.linspace(0, 20, 500)
+        for backend in BACKENDS:
+            self.assertEqual(x_corr([np.sin(x1)], [np.sin(x1 + 1)], backend=backend, max_lag=10)[0], -10., backend)
+
+    def testUnknownBackend(self):
+        stripes = np.zeros((2, 8))
+        with self.assertRaises(ValueError):
+            correlate_stripes(stripes, stripes, backend='ghost')
+
+
+class TestModes(unittest.TestCase):
+    def testZncc(self):
+        # Running sums give the Pearson correlation of the overlapping points at every searched lag
+        rng = np.random.RandomState(2)
+        n = 40
+        stripes_a = rng.rand(3, n) + np.linspace(0, 2, n)
+        stripes_b = rng.rand(3, n) * np.linspace(1, 3, n)
+        for backend in BACKENDS:
+            xcorr = correlate_stripes(stripes_a, stripes_b, backend=backend, mode='zncc')
+            for lag in range(-n // 2, n // 2 + 1):
+                for row in range(3):
+                    if lag >= 0:
+                        expected = np.corrcoef(stripes_a[row, lag:], stripes_b[row, :n - lag])[0, 1]
+                    else:
+                        expected = np.corrcoef(stripes_a[row, :n + lag], stripes_b[row, -lag:])[0, 1]
+                    self.assertAlmostEqual(xcorr[row, lag + n - 1], expected, 10, backend)
+            # lags beyond half the stripe are not searched
+            self.assertTrue(np.all(np.isneginf(xcorr[:, :n // 2 - 1])))
+
+    def testIllumination(self):
+        # A brightness ramp along the stripes pulls the plain cross-correlation peak to zero lag;
+        # zncc still finds the shift, and phase correlation copes with an uneven gain
+        image_a, image_b = synthetic_pair(200, 512, 3.0, 0.02)
+        expected = np.rint(3.0 + 0.02 * np.asarray(divid_image(image_a, 20)[1]))
+        ramp = 60 + 200 * np.arange(512) / 512.0
+        shifts = {mode: analyse_images(image_a * 0.5 + ramp, image_b * 0.5 + ramp, 20, mode=mode)[:, 1]
+                  for mode in MODES}
+        self.assertFalse(np.any(shifts['cross'] == expected))
+        self.assertTrue(np.array_equal(shifts['zncc'], expected))
+        gain = 0.3 + 0.7 * np.arange(512) / 512.0
+        shifts = analyse_images(image_a * gain, image_b * gain, 20, mode='phase')[:, 1]
+        self.assertTrue(np.array_equal(shifts, expected))
+
+    def testUniformBand(self):
+        # A uniform stripe has no displacement to find, but must not change the phase correlation of the others
+        image_a, image_b = synthetic_pair(60, 200, 4.0, 0.0)
+        expected = analyse_images(image_a, image_b, 10, mode='phase')
+        image_a[:10] = image_b[:10] = 0
+        with np.errstate(invalid='ignore'):
+            results = {mode: analyse_images(image_a, image_b, 10, mode=mode) for mode in MODES}
+        self.assertTrue(np.array_equal(results['phase'][1:], expected[1:]))
+        self.assertEqual(results['phase'][0, 1], results['cross'][0, 1])
+
+    def testSampleData(self):
+        # On evenly lit images every mode agrees with the reference results
+        expected_results = np.loadtxt(fname=os.path.join(TEST_DATA_DIR, "sample_results_ndiv20.csv"), delimiter=',')
+        for mode in MODES:
+            for precision in ('double', 'single'):
+                analysis_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                                precision=precision, mode=mode)
+                self.assertTrue(np.all(np.abs(analysis_results[:, 1] - expected_results[:, 1]) <= 1), mode)
+
+    def testMain(self):
+        out_names = ["piv_results_sample_im1_sample_im2.csv", "piv_results_sample_im1_sample_im2.png"]
+        try:
+            with capture_stdout(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["-d", "20", "--mode", "phase"]) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.allclose(np.loadtxt(out_names[0], delimiter=','),
+                                        piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                                     mode='phase')))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+
+    def testUnknownMode(self):
+        stripes = np.zeros((2, 8))
+        with self.assertRaises(ValueError):
+            correlate_stripes(stripes, stripes, mode='ghost')
+
+
+class TestPreFilter(unittest.TestCase):
+    def setUp(self):
+        self.image_a, self.image_b = synthetic_pair(200, 512, 3.0, 0.02)
+        self.expected = np.rint(3.0 + 0.02 * np.asarray(divid_image(self.image_a, 20)[1]))
+
+    def testGain(self):
+        gain = PreFilter(highpass=4).gain(64)
+        self.assertEqual(gain.shape, (33,))
+        self.assertEqual(gain[0], 0)
+        self.assertTrue(np.all(np.diff(gain) >= 0) and np.isclose(gain[-1], 1))
+        gain = PreFilter(lowpass=2).gain(64, np.float32)
+        self.assertEqual((gain[0], gain.dtype), (1, np.float32))
+        self.assertTrue(np.all(np.diff(gain) < 0))
+        self.assertIsNone(PreFilter(taper='hann').gain(64))
+        self.assertIsNone(PreFilter(highpass=4).window(64))
+        self.assertEqual(PreFilter(**PreFilter(4, 1, 'tukey').params()).params(), PreFilter(4, 1, 'tukey').params())
+        with self.assertRaises(ValueError):
+            PreFilter(taper='ghost')
+        with self.assertRaises(ValueError):
+            PreFilter(highpass=0)
+        with self.assertRaises(ValueError):
+            correlate_stripes(np.zeros((2, 8)), np.zeros((2, 8)), mode='zncc', prefilter=PreFilter(highpass=4))
+
+    def testBackground(self):
+        # A bright static blob pulls the peak to zero lag, unless the high-pass removes it;
+        # spectral filters use the FFT path whatever the backend
+        blob = 300 * np.exp(-((np.arange(512) - 256) / 30.0) ** 2)
+        image_a, image_b = self.image_a + blob, self.image_b + blob
+        self.assertFalse(np.any(analyse_images(image_a, image_b, 20)[:, 1] == self.expected))
+        for backend in BACKENDS:
+            shifts = analyse_images(image_a, image_b, 20, backend=backend, prefilter=PreFilter(highpass=4))[:, 1]
+            self.assertTrue(np.array_equal(shifts, self.expected), backend)
+
+    def testTaper(self):
+        # An illumination ramp leaves steps at the ends of the stripes, which a taper removes
+        ramp = 60 + 200 * np.arange(512) / 512.0
+        image_a, image_b = self.image_a * 0.5 + ramp, self.image_b * 0.5 + ramp
+        self.assertFalse(np.any(analyse_images(image_a, image_b, 20, mode='phase')[:, 1] == self.expected))
+        for mode in MODES:
+            for backend in BACKENDS:
+                shifts = analyse_images(image_a, image_b, 20, backend=backend, mode=mode,
+                                        prefilter=PreFilter(taper='hann'))[:, 1]
+                self.assertTrue(np.array_equal(shifts, self.expected), mode + ' ' + backend)
+
+    def testQuickLook(self):
+        # filter widths are given in full resolution pixels
+        self.assertEqual(PreFilter(8, 2, 'hann').reduced(4).params(), PreFilter(2, 0.5, 'hann').params())
+
+    def testMain(self):
+        out_names = ["piv_results_sample_im1_sample_im2.csv", "piv_results_sample_im1_sample_im2.png"]
+        try:
+            with capture_stdout(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["-d", "20", "--highpass", "4", "--lowpass",
+                                                                       "1", "--taper", "tukey"]) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.allclose(np.loadtxt(out_names[0], delimiter=','),
+                                        piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                                     prefilter=PreFilter(4, 1, 'tukey'))))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+        with capture_stderr(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["--highpass", "-1"]) as output:
+            self.assertTrue("positive" in output)
+        self.assertEqual(main(["-m"] + SAMPLE_DATA_FILE_LOC + ["--mode", "zncc", "--highpass", "4"]), INVALID_DATA)
+        # lag sweeps and interrogation windows only use plain cross-correlation
+        with capture_stderr(main, ["-s"] + SAMPLE_DATA_FILE_LOC + ["-l", "1", "--mode", "phase"]) as output:
+            self.assertTrue("--lag_sweep" in output)
+        self.assertEqual(main(["-m"] + SAMPLE_DATA_FILE_LOC + ["--windows", "64", "--taper", "hann"]), INVALID_DATA)
+
+
+class TestMask(unittest.TestCase):
+    def setUp(self):
+        self.image_a, self.image_b = synthetic_pair(200, 400, 3.0, 0.02)
+        self.expected = np.rint(3.0 + 0.02 * np.asarray(divid_image(self.image_a, 20)[1]))
+        # a fixed probe and a column of dead pixels, the same in both frames
+        self.mask = np.zeros(self.image_a.shape, dtype=bool)
+        self.mask[40:160, 150:210] = True
+        self.mask[:, 300] = True
+        self.obstructed = []
+        for image in (self.image_a, self.image_b):
+            image = image.astype(float)
+            image[40:160, 150:210] = 250 + 5 * np.sin(np.arange(60) / 3.0)
+            image[:, 300] = 255
+            self.obstructed.append(image)
+
+    def testStripes(self):
+        # Profile points are means over the unmasked pixels of their column
+        image = np.arange(11 * 4, dtype=float).reshape(11, 4)
+        mask = np.zeros(image.shape, dtype=bool)
+        mask[0:3, 1] = True
+        mask[0:5, 2] = True
+        self.assertTrue(np.array_equal(stripe_mask(mask, 5), [[False, False, True, False], [False] * 4]))
+        masked = divid_image(image, 5, mask=mask)[0][0]
+        profile = np.array([8.0, 15.0, 0.0, 11.0])
+        profile[[0, 1, 3]] -= profile[[0, 1, 3]].mean()
+        self.assertTrue(np.allclose(masked, profile / np.sqrt(np.sum(profile ** 2) / 3)))
+        # without masked pixels, the stripes of divid_image
+        unmasked = divid_image(self.image_a, 20)[0]
+        self.assertTrue(np.allclose(divid_image(self.image_a, 20, mask=np.zeros_like(self.mask))[0], unmasked))
+        self.assertTrue(np.array_equal(reduce_mask(self.mask, 4)[:, 75], np.ones(50, dtype=bool)))
+        self.assertEqual(reduce_mask(self.mask, 3).shape, (67, 134))
+
+    def testUnmaskedIsZncc(self):
+        stripes_a = np.asarray(divid_image(self.image_a, 20)[0])
+        stripes_b = np.asarray(divid_image(self.image_b, 20)[0])
+        zncc = correlate_stripes(stripes_a, stripes_b, mode='zncc')
+        for precision in (np.float64, np.float32):
+            masked = correlate_stripes(stripes_a.astype(precision), stripes_b.astype(precision),
+                                       mask=np.zeros(stripes_a.shape, dtype=bool))
+            self.assertEqual(masked.dtype, precision)
+            self.assertTrue(np.array_equal(np.isfinite(masked), np.isfinite(zncc)))
+            self.assertTrue(np.allclose(masked[np.isfinite(zncc)], zncc[np.isfinite(zncc)], atol=1e-5))
+
+    def testObstacle(self):
+        # The probe and dead column pin the peak at zero lag unless they are masked
+        for mode in ('cross', 'zncc'):
+            self.assertFalse(np.all(analyse_images(self.obstructed[0], self.obstructed[1], 20,
+                                                   mode=mode)[:, 1] == self.expected))
+            shifts = analyse_images(self.obstructed[0], self.obstructed[1], 20, mode=mode, mask=self.mask)[:, 1]
+            self.assertTrue(np.array_equal(shifts, self.expected), mode)
+        # column windows, one of them within the probe
+        piv_results = analyse_images(self.obstructed[0], self.obstructed[1], 20, n_columns=4, mask=self.mask)
+        self.assertTrue(np.array_equal(piv_results[:, [1, 2, 4]], np.column_stack([self.expected] * 3)))
+        with self.assertRaises(ValueError):
+            correlate_stripes(np.zeros((2, 8)), np.zeros((2, 8)), mode='phase', mask=np.zeros((2, 8), dtype=bool))
+        with self.assertRaises(ValueError):
+            correlate_stripes(np.zeros((2, 8)), np.zeros((2, 8)), prefilter=PreFilter(highpass=4),
+                              mask=np.zeros((2, 8), dtype=bool))
+        self.assertEqual(analyse_images(self.image_a, self.image_b, 20, mask=self.mask[:100]), INVALID_DATA)
+
+    def testFullyMasked(self):
+        # stripes without unmasked points have no displacement
+        mask = np.zeros(self.mask.shape, dtype=bool)
+        mask[:40] = True
+        shifts = analyse_images(self.image_a, self.image_b, 20, mask=mask)[:, 1]
+        self.assertTrue(np.all(np.isnan(shifts[:2])))
+        self.assertTrue(np.array_equal(shifts[2:], self.expected[2:]))
+
+    def testMain(self):
+        directory = tempfile.mkdtemp()
+        try:
+            from PIL import Image
+            image_paths = []
+            for name, image in (('obstructed_a', self.obstructed[0]), ('obstructed_b', self.obstructed[1]),
+                                ('mask', 255 * self.mask)):
+                image_paths.append(os.path.join(directory, name + '.bmp'))
+                Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(image_paths[-1])
+            out_names = ["piv_results_obstructed_a_obstructed_b_masked.csv",
+                         "piv_results_obstructed_a_obstructed_b_masked.png"]
+            try:
+                with capture_stdout(main, ["-m"] + image_paths[:2] + ["-d", "20", "--mask", image_paths[2]]) as output:
+                    self.assertTrue(out_names[0] in output)
+                self.assertTrue(np.array_equal(np.loadtxt(out_names[0], delimiter=',')[:, 1], self.expected))
+                self.assertEqual(main(["-m"] + image_paths[:2] + ["-d", "20", "--mask", image_paths[2],
+                                       "--quick_look", "2"]), SUCCESS)
+            finally:
+                for out_name in out_names + [name.replace('_masked', '_quick2_masked') for name in out_names]:
+                    silent_remove(out_name, disable=DISABLE_REMOVE)
+            with capture_stderr(main, ["-m"] + image_paths[:2] + ["--mask", image_paths[2], "--mode", "phase"]) \
+                    as output:
+                self.assertTrue("Phase" in output)
+            self.assertEqual(main(["-s"] + image_paths[:2] + ["--mask", image_paths[2]]), INVALID_DATA)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_env = os.environ.get(correlation.CACHE_DIR_ENV)
+        os.environ[correlation.CACHE_DIR_ENV] = self.cache_dir
+        correlation._tuned_backends.clear()
+
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ[correlation.CACHE_DIR_ENV]
+        else:
+            os.environ[correlation.CACHE_DIR_ENV] = self.old_env
+        correlation._tuned_backends.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def testCacheWritten(self):
+        name = select_backend(64, 4, np.float64)
+        self.assertIn(name, BACKENDS)
+        with open(correlation.cache_path()) as f:
+            cache = json.load(f)
+        self.assertEqual(cache["64,4,float64"], name)
+
+    def testCacheRead(self):
+        # A cached choice is used without re-tuning
+        with open(correlation.cache_path(), 'w') as f:
+            json.dump({"64,4,float64": "direct"}, f)
+        self.assertEqual(select_backend(64, 4, np.float64), "direct")
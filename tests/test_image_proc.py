@@ -7,12 +7,18 @@ Unit and regression test for the che696_proj_yufei package.
 import errno
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 from contextlib import contextmanager
 from io import StringIO
 import numpy as np
 import logging
-from che696_proj_yufei.image_proc import main, piv_analysis, x_corr, divid_image
+from PIL import Image
+from che696_proj_yufei.image_proc import (main, piv_analysis, x_corr, divid_image, divid_columns, analyse_images,
+                                          load_image, INVALID_DATA)
+from che696_proj_yufei.correlation import BACKENDS
+from che696_proj_yufei.benchmark import synthetic_pair, synthetic_set
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -79,6 +85,8 @@ class TestMainFailWell(unittest.TestCase):
             main(test_input)
         with capture_stderr(main, test_input) as output:
             self.assertTrue("invalid image" in output)
+        # a failed analysis leaves no results file
+        self.assertFalse(os.path.exists("piv_results_invalid_im1_invalid_im2.csv"))
     def testInvalidImagePair(self):
         # Make sure to capture errors due to invalid image files
         input_image_1 = os.path.join(TEST_DATA_DIR, "sample2_im1.bmp")
@@ -88,6 +96,7 @@ class TestMainFailWell(unittest.TestCase):
             main(test_input)
         with capture_stderr(main, test_input) as output:
             self.assertTrue("different sizes" in output)
+        self.assertFalse(os.path.exists("piv_results_sample2_im1_sample2_im2_crop.csv"))
 
 class TestPivAnalysis(unittest.TestCase):
     def testSampleData(self):
@@ -127,6 +136,136 @@ class TestDividImage(unittest.TestCase):
         out_a, out_b = divid_image(my_input, 5)
         self.assertEqual(out_b, [2.5, 7.5, 12.5, 17.0])
 
+    def testSinglePrecision(self):
+        # Single precision stripes stay single precision
+        np.random.seed(1)
+        out_a, out_b = divid_image(np.random.rand(20, 5), 5, precision='single')
+        self.assertEqual(out_a[0].dtype, np.float32)
+
+class TestPrecision(unittest.TestCase):
+    def testSampleData(self):
+        # The float32 path must find exactly the same shifts as the float64 path
+        for division_pixel in (5, 20):
+            for backend in BACKENDS:
+                double_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], division_pixel,
+                                              backend=backend)
+                single_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], division_pixel,
+                                              backend=backend, precision='single')
+                self.assertTrue(np.array_equal(double_results, single_results), backend)
+
+    def testSyntheticSet(self):
+        for label, image_a, image_b in synthetic_set():
+            for backend in BACKENDS:
+                double_shift = x_corr(divid_image(image_a, 5)[0], divid_image(image_b, 5)[0], backend=backend)
+                single_shift = x_corr(divid_image(image_a, 5, precision='single')[0],
+                                      divid_image(image_b, 5, precision='single')[0],
+                                      backend=backend, precision='single')
+                self.assertTrue(np.array_equal(double_shift, single_shift), label + ' ' + backend)
+
+class TestSyntheticPair(unittest.TestCase):
+    def testKnownShear(self):
+        # The synthetic images move by slip + shear * y, which the analysis must recover
+        image_a, image_b = synthetic_pair(200, 400, 3.0, 0.05)
+        segments_a, y_position = divid_image(image_a, 20)
+        segments_b = divid_image(image_b, 20)[0]
+        shift = x_corr(segments_a, segments_b)
+        self.assertTrue(np.all(np.abs(shift - (3.0 + 0.05 * np.asarray(y_position))) <= 1.0))
+
+class TestLoadImage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gray = Image.open(SAMPLE_DATA_FILE_LOC[0])
+        self.colour = self.gray.convert('RGB')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testColour(self):
+        # Colour images are decoded to luminance, so they are 2D like gray ones
+        image_path = os.path.join(self.directory, 'colour.png')
+        self.colour.save(image_path)
+        image = load_image(image_path)[0]
+        self.assertEqual(image.shape, (1245, 1027))
+        self.assertTrue(np.array_equal(image, load_image(SAMPLE_DATA_FILE_LOC[0])[0]))
+
+    def testReduce(self):
+        image_path = os.path.join(self.directory, 'colour.jpg')
+        self.colour.save(image_path, quality=95)
+        self.assertEqual(load_image(image_path)[0].shape, (1245, 1027))
+        # the JPEG decoder and block averaging both keep the partial blocks at the edges
+        self.assertEqual(load_image(image_path, 4)[0].shape, (312, 257))
+        self.assertEqual(load_image(SAMPLE_DATA_FILE_LOC[0], 4)[0].shape, (312, 257))
+        # factors the decoder cannot scale by are partly reduced by block averaging
+        for reduce, shape in ((3, (415, 343)), (6, (208, 172)), (16, (78, 65))):
+            self.assertEqual(load_image(image_path, reduce)[0].shape, shape)
+        image_path = os.path.join(self.directory, 'gray16.tif')
+        self.gray.convert('I;16').save(image_path)
+        self.assertTrue(np.array_equal(load_image(image_path, 2)[0], load_image(SAMPLE_DATA_FILE_LOC[0], 2)[0]))
+
+    def testQuickLook(self):
+        # A quick look gives a coarse version of the full resolution profile, in full resolution pixels
+        full_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20)
+        for reduce in (2, 4):
+            piv_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20, reduce=reduce)
+            self.assertTrue(abs(piv_results[-1, 0] - full_results[-1, 0]) < 20)
+            expected = np.interp(piv_results[:, 0], full_results[:, 0], full_results[:, 1])
+            self.assertTrue(np.median(np.abs(piv_results[:, 1] - expected)) <= reduce)
+
+    def testQuickLookMain(self):
+        out_names = ["piv_results_sample_im1_sample_im2_quick4.csv", "piv_results_sample_im1_sample_im2_quick4.png"]
+        try:
+            with capture_stdout(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["-d", "20", "--quick_look", "4"]) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.allclose(np.loadtxt(out_names[0], delimiter=','),
+                                        piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20, reduce=4)))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+
+class TestColumns(unittest.TestCase):
+    def testDividColumns(self):
+        image_a = synthetic_pair(200, 410, 0.0, 0.0)[0]
+        segments, y_position = divid_columns(image_a, 20, 4)
+        self.assertEqual(segments.shape, (len(y_position), 4, 102))
+        self.assertTrue(np.allclose(segments.mean(axis=2), 0) and np.allclose(segments.std(axis=2), 1))
+        stripes = divid_image(image_a, 20)[0]
+        window = stripes[3][204:306]
+        self.assertTrue(np.allclose(segments[3, 2], (window - window.mean()) / window.std()))
+
+    def testStreamwiseVariation(self):
+        # The left and right halves of the pair move by different amounts, which full-width stripes average out
+        image_a, image_b = synthetic_pair(200, 512, 2.0, 0.0)
+        image_b[:, 256:] = synthetic_pair(200, 512, 6.0, 0.0)[1][:, 256:]
+        for precision in ('double', 'single'):
+            piv_results = analyse_images(image_a, image_b, 20, precision=precision, n_columns=4)
+            self.assertEqual(piv_results.shape, (10, 5))
+            self.assertTrue(np.array_equal(piv_results[:, 0], divid_image(image_a, 20)[1]))
+            self.assertTrue(np.all(piv_results[:, 1:3] == 2) and np.all(piv_results[:, 3:] == 6))
+        self.assertTrue(np.array_equal(analyse_images(image_a, image_b, 20, n_columns=1),
+                                       analyse_images(image_a, image_b, 20)))
+        with capture_stderr(analyse_images, image_a, image_b, 20, n_columns=300) as output:
+            self.assertTrue("column windows" in output)
+        self.assertEqual(analyse_images(image_a, image_b, 20, n_columns=300), INVALID_DATA)
+
+    def testMain(self):
+        out_names = ["piv_results_sample_im1_sample_im2_columns4.csv",
+                     "piv_results_sample_im1_sample_im2_columns4.png"]
+        try:
+            with capture_stdout(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["-d", "20", "--columns", "4"]) as output:
+                self.assertTrue(out_names[0] in output)
+            with open(out_names[0]) as f:
+                self.assertEqual(f.readline().strip(), "# y_position,x_127.5,x_383.5,x_639.5,x_895.5")
+            piv_results = np.loadtxt(out_names[0], delimiter=',')
+            self.assertTrue(np.allclose(piv_results, piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1],
+                                                                  20, n_columns=4)))
+            # the column windows see the profile of the full-width stripes
+            full_width = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20)
+            self.assertTrue(np.median(np.abs(piv_results[:, 1:] - full_width[:, 1:])) <= 1)
+            self.assertTrue(os.path.isfile(out_names[1]))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+
 
 # Utility functions
 # From http://schinckel.net/2013/04/15/capture-and-test-sys.stdout-sys.stderr-in-unittest.testcase/
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for several regions of interest per pair.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from PIL import Image
+from che696_proj_yufei import rois as rois_module
+from che696_proj_yufei.benchmark import synthetic_pair
+from che696_proj_yufei.correlation import PreFilter
+from che696_proj_yufei.image_proc import main, analyse_images, INVALID_DATA, IO_ERROR
+from che696_proj_yufei.rois import Roi, check_rois, analyse_rois, piv_analysis_rois
+from .test_image_proc import silent_remove, capture_stdout, capture_stderr, DISABLE_REMOVE
+
+
+def two_gaps():
+    # two shear gaps of different widths and flows in one frame
+    upper_a, upper_b = synthetic_pair(120, 400, 3.0, 0.02, seed=1)
+    lower_a, lower_b = synthetic_pair(100, 300, -5.0, 0.0, seed=2)
+    frames = []
+    for upper, lower in ((upper_a, lower_a), (upper_b, lower_b)):
+        frame = np.zeros((240, 420), dtype=np.int32)
+        frame[0:120, 10:410] = upper
+        frame[130:230, 60:360] = lower
+        frames.append(frame)
+    return frames, [Roi('upper', 0, 120, 10, 410), Roi('lower', 130, 230, 60, 360)]
+
+
+class TestRois(unittest.TestCase):
+    def setUp(self):
+        (self.image_a, self.image_b), self.rois = two_gaps()
+
+    def testSeparateCrops(self):
+        # Every ROI gets the profile of a separate run on its crop, in one correlation call
+        for mode, prefilter in (('cross', None), ('cross', PreFilter(taper='hann')), ('zncc', None),
+                                ('phase', PreFilter(highpass=4))):
+            with mock.patch.object(rois_module, 'correlate_stripes', wraps=rois_module.correlate_stripes) as spy:
+                piv_results = analyse_rois(self.image_a, self.image_b, self.rois, 10, mode=mode, prefilter=prefilter)
+            self.assertEqual(spy.call_count, 1)
+            for roi in self.rois:
+                expected = analyse_images(roi.crop(self.image_a), roi.crop(self.image_b), 10, mode=mode,
+                                          prefilter=prefilter)
+                expected[:, 0] += roi.top
+                self.assertTrue(np.array_equal(piv_results[roi.name], expected), mode + ' ' + roi.name)
+        self.assertTrue(np.all(piv_results['lower'][:, 1] == -5))
+
+    def testPhase(self):
+        # Phase correlation of ROIs of different widths and contrasts in one call, each whitened on its own
+        y, x = np.mgrid[:300, :600]
+        image_a = synthetic_pair(300, 600, 4.0, 0.01, seed=3)[0] + 0.5 * x + 0.2 * y
+        image_b = np.roll(image_a, 4, axis=1)
+        rois = [Roi('wide', 0, 100, 0, 600), Roi('middle', 100, 220, 150, 450), Roi('narrow', 220, 300, 400, 520)]
+        piv_results = analyse_rois(image_a, image_b, rois, 20, mode='phase')
+        expected = analyse_images(rois[0].crop(image_a), rois[0].crop(image_b), 20, mode='phase')
+        self.assertTrue(np.array_equal(piv_results['wide'], expected))
+        for roi in rois[1:]:
+            # narrower ROIs are correlated over the padded length, whichever other ROIs share the call
+            alone = analyse_rois(image_a, image_b, [rois[0], roi], 20, mode='phase')
+            self.assertTrue(np.array_equal(piv_results[roi.name], alone[roi.name]), roi.name)
+            self.assertTrue(np.all(np.abs(piv_results[roi.name][:, 1] - 4) <= 1), roi.name)
+
+    def testMask(self):
+        mask = np.zeros(self.image_a.shape, dtype=bool)
+        mask[:, 200] = True
+        piv_results = analyse_rois(self.image_a, self.image_b, self.rois, 10, mask=mask)
+        for roi in self.rois:
+            expected = analyse_images(roi.crop(self.image_a), roi.crop(self.image_b), 10, mask=roi.crop(mask))
+            self.assertTrue(np.array_equal(piv_results[roi.name][:, 1], expected[:, 1]), roi.name)
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            Roi('upper', 10, 11, 0, 100)
+        with self.assertRaises(ValueError):
+            Roi(os.path.join('a', 'b'), 0, 10, 0, 100)
+        with self.assertRaises(ValueError):
+            check_rois([Roi('gap', 0, 10, 0, 100), Roi('gap', 10, 20, 0, 100)])
+        with self.assertRaises(ValueError):
+            check_rois([])
+        with self.assertRaises(ValueError):
+            analyse_rois(self.image_a, self.image_b, [Roi('wide', 0, 10, 0, 500)], 5)
+
+
+class TestRoisMain(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        (image_a, image_b), self.rois = two_gaps()
+        self.image_paths = []
+        for name, image in (('gaps_a', image_a), ('gaps_b', image_b)):
+            self.image_paths.append(os.path.join(self.directory, name + '.bmp'))
+            Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(self.image_paths[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testMain(self):
+        out_names = ["piv_results_gaps_a_gaps_b_{}.{}".format(roi.name, extension) for roi in self.rois
+                     for extension in ('csv', 'png')]
+        roi_args = ["--roi", "upper", "0", "120", "10", "410", "--roi", "lower", "130", "230", "60", "360"]
+        try:
+            with capture_stdout(main, ["-m"] + self.image_paths + ["-d", "10"] + roi_args) as output:
+                self.assertTrue(out_names[0] in output and out_names[2] in output)
+            piv_results = piv_analysis_rois(self.image_paths[0], self.image_paths[1], self.rois, 10)
+            for roi, out_name in zip(self.rois, out_names[::2]):
+                self.assertTrue(np.allclose(np.loadtxt(out_name, delimiter=','), piv_results[roi.name]))
+                self.assertTrue(os.path.isfile(out_name.replace('.csv', '.png')))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+        with capture_stderr(main, ["-m"] + self.image_paths + ["--roi", "upper", "0", "120", "10", "410", "--roi",
+                                                               "upper", "130", "230", "60", "360"]) as output:
+            self.assertTrue("unique" in output)
+        self.assertEqual(main(["-m"] + self.image_paths + ["--roi", "upper", "0", "120", "10", "410",
+                                                           "--columns", "2"]), INVALID_DATA)
+        self.assertEqual(main(["-m"] + self.image_paths + ["--roi", "tall", "0", "300", "10", "410"]), INVALID_DATA)
+        self.assertEqual(main(["-m", self.image_paths[0], "ghost.bmp", "--roi", "upper", "0", "120", "10", "410"]),
+                         IO_ERROR)
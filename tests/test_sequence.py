@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for sequence analysis.
+"""
+
+import io
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+from PIL import Image
+from che696_proj_yufei.benchmark import synthetic_pair
+from che696_proj_yufei.image_proc import main, piv_analysis, analyse_images, IO_ERROR, SUCCESS
+from che696_proj_yufei.correlation import PreFilter
+from che696_proj_yufei.store import ResultStore
+from che696_proj_yufei.sequence import (iter_frames, iter_lag_sweep, lag_sweep, run_batch, read_checkpoint,
+                                        iter_raw_frames, run_stream, FrameSequence, FolderWatcher, watch)
+from che696_proj_yufei.stats import ProfileStatistics, ShearFitSeries
+from .test_image_proc import silent_remove, capture_stderr, DISABLE_REMOVE
+
+CURRENT_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+def drifting_frames(n_frames, step):
+    # frames of one particle pattern moving by step pixels per frame
+    base = synthetic_pair(200, 400, 0.0, 0.0)[0]
+    return [np.roll(base, step * i, axis=1) for i in range(n_frames)]
+
+
+class TestLagSweep(unittest.TestCase):
+    def testDrift(self):
+        # The displacement grows linearly with the frame lag
+        y_position, mean_shift, n_pairs = lag_sweep(drifting_frames(6, 2), 20, 3)
+        self.assertEqual(list(n_pairs), [5, 4, 3])
+        for lag in range(1, 4):
+            self.assertTrue(np.all(mean_shift[lag - 1] == 2 * lag))
+
+    def testSequenceEnd(self):
+        # The last frames have fewer later frames to correlate with
+        sweeps = list(iter_lag_sweep(drifting_frames(4, 1), 20, 2))
+        self.assertEqual(len(sweeps), 3)
+        self.assertTrue(np.all(np.isnan(sweeps[-1][1][1])))
+
+    def testSampleData(self):
+        # A lag of one frame reproduces the pair analysis
+        frames = iter_frames(SAMPLE_DATA_FILE_LOC)
+        y_position, mean_shift, n_pairs = lag_sweep(frames, 5, 1)
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)
+        self.assertTrue(np.array_equal(expected_results, np.column_stack((y_position, mean_shift[0]))))
+
+
+class TestSequenceMain(unittest.TestCase):
+    def testSampleData(self):
+        out_name = "piv_lag_sweep_sample_im1_sample_im1.csv"
+        test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], SAMPLE_DATA_FILE_LOC[0], "-l", "2",
+                      "-d", "20"]
+        try:
+            self.assertEqual(main(test_input), SUCCESS)
+            results = np.loadtxt(out_name, delimiter=',')
+            self.assertEqual(results.shape[1], 3)
+            # going forward and back again gives no net displacement
+            self.assertTrue(np.all(results[:, 2] == 0))
+        finally:
+            silent_remove(out_name, disable=DISABLE_REMOVE)
+
+    def testMissingFile(self):
+        test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], "ghost.bmp"]
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("ghost" in output)
+        self.assertEqual(main(test_input), IO_ERROR)
+
+
+def write_frames_slowly(directory, frames, pause=0.15):
+    # each frame is written in two halves with a pause, like a camera streaming to disk
+    for i, frame in enumerate(frames):
+        buffer = io.BytesIO()
+        Image.fromarray(frame.astype(np.uint8)).save(buffer, format='BMP')
+        data = buffer.getvalue()
+        with open(os.path.join(directory, 'frame_{:04d}.bmp'.format(i)), 'wb') as f:
+            f.write(data[:len(data) // 2])
+            f.flush()
+            time.sleep(pause)
+            f.write(data[len(data) // 2:])
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.out_name = os.path.join(self.directory, 'results.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def checkWatch(self, use_inotify):
+        watcher = FolderWatcher(self.directory, pattern='frame_*.bmp', poll_interval=0.02, use_inotify=use_inotify)
+        writer = threading.Thread(target=write_frames_slowly, args=(self.directory, drifting_frames(4, 3)))
+        writer.start()
+        try:
+            n_pairs, latency = watch(watcher, 20, self.out_name, max_pairs=3, idle_timeout=5)
+        finally:
+            writer.join()
+            watcher.close()
+        self.assertEqual(n_pairs, 3)
+        with open(self.out_name) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0].startswith('# frame_a,frame_b,10'))
+        self.assertEqual(lines[1].split(',')[:2], ['frame_0000.bmp', 'frame_0001.bmp'])
+        shifts = np.array([line.split(',')[2:] for line in lines[1:]], dtype=float)
+        self.assertTrue(np.all(shifts == 3))
+
+    def testInotify(self):
+        self.checkWatch(True)
+
+    def testPolling(self):
+        self.checkWatch(False)
+
+    def testSizeChange(self):
+        # Frames that change size restart the statistics; the fits go on with the new stripes
+        frames = drifting_frames(6, 3)
+        frames[3:] = [np.vstack((frame, frame[:40])) for frame in frames[3:]]
+        stats_name = os.path.join(self.directory, 'results_stats')
+        fit_name = os.path.join(self.directory, 'results_fit.csv')
+        statistics = ProfileStatistics(snapshot_name=stats_name)
+        watcher = FolderWatcher(self.directory, pattern='frame_*.bmp', poll_interval=0.02, use_inotify=False)
+        writer = threading.Thread(target=write_frames_slowly, args=(self.directory, frames, 0.02))
+        writer.start()
+        try:
+            with capture_stderr(watch, watcher, 20, self.out_name, max_pairs=4, idle_timeout=5,
+                                statistics=statistics, fit_series=ShearFitSeries(fit_name)) as output:
+                self.assertTrue('frame_0003.bmp' in output)
+        finally:
+            writer.join()
+            watcher.close()
+        summary = np.loadtxt(stats_name + '_part1.csv', delimiter=',')
+        self.assertEqual(summary.shape[0], 10)
+        self.assertTrue(np.all(summary[:, 1:3] == [2, 3]))
+        self.assertEqual((statistics.count, len(statistics.mean)), (2, 12))
+        fits = np.loadtxt(fit_name, delimiter=',', usecols=(0, 3))
+        self.assertTrue(np.array_equal(fits[:, 0], np.arange(4)))
+        self.assertTrue(np.allclose(fits[:, 1], 3))
+
+    def testExistingFramesIgnored(self):
+        write_frames_slowly(self.directory, drifting_frames(2, 1), pause=0)
+        watcher = FolderWatcher(self.directory, pattern='frame_*.bmp', use_inotify=False)
+        self.assertEqual(watcher.poll(timeout=0.2), [])
+
+    def testMainMissingDirectory(self):
+        test_input = ["-w", os.path.join(self.directory, "ghost")]
+        with capture_stderr(main, test_input) as output:
+            self.assertTrue("ghost" in output)
+
+
+class TestBatchMain(unittest.TestCase):
+    def testSampleData(self):
+        # Every pair of the sequence is stored and exports to the single pair format
+        store_path = "piv_results_sample_im1_sample_im1.pivstore"
+        csv_name = "piv_results_sample_im2_sample_im1.csv"
+        test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], SAMPLE_DATA_FILE_LOC[0], "--csv"]
+        try:
+            self.assertEqual(main(test_input), SUCCESS)
+            store = ResultStore(store_path)
+            self.assertEqual(store.frames, [('sample_im1.bmp', 'sample_im2.bmp'),
+                                            ('sample_im2.bmp', 'sample_im1.bmp')])
+            expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)
+            self.assertTrue(np.array_equal(expected_results[:, 1], store.displacement(0)))
+            self.assertTrue(np.allclose(np.loadtxt(csv_name, delimiter=','),
+                                        piv_analysis(SAMPLE_DATA_FILE_LOC[1], SAMPLE_DATA_FILE_LOC[0], 5)))
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
+            silent_remove(csv_name)
+            silent_remove("piv_results_sample_im1_sample_im2.csv", disable=DISABLE_REMOVE)
+
+
+class TestConvergence(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_paths = []
+        for i, frame in enumerate(drifting_frames(12, 2)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            Image.fromarray(frame.astype(np.uint8)).save(image_path)
+            self.image_paths.append(image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testEarlyStop(self):
+        # A steady drift has no scatter, so the run stops after min_pairs pairs
+        store = run_batch(self.image_paths, 20, os.path.join(self.directory, 'run.pivstore'), tolerance=0.1,
+                          min_pairs=4)
+        self.assertEqual(len(store), 4)
+        self.assertTrue(np.all(store.displacements() == 2))
+
+    def testNotConverged(self):
+        # Skipping every third frame makes the displacement alternate; every pair is analysed
+        image_paths = [image_path for i, image_path in enumerate(self.image_paths) if i % 3 != 2]
+        store = run_batch(image_paths, 20, os.path.join(self.directory, 'run.pivstore'), tolerance=1e-3,
+                          min_pairs=4)
+        self.assertEqual(len(store), 7)
+
+    def testMain(self):
+        store_path = "piv_results_frame_000_frame_011.pivstore"
+        test_input = ["-s"] + self.image_paths + ["-d", "20", "--tolerance", "0.1", "--min_pairs", "3"]
+        try:
+            self.assertEqual(main(test_input), SUCCESS)
+            self.assertEqual(len(ResultStore(store_path)), 3)
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
+
+
+    def testTooFewPairs(self):
+        # A single pair gives no standard error to report
+        store_path = "piv_results_frame_000_frame_001.pivstore"
+        test_input = ["-s"] + self.image_paths[:2] + ["-d", "20", "--tolerance", "0.1"]
+        try:
+            with capture_stderr(main, test_input) as output:
+                self.assertTrue("not enough pairs" in output)
+                self.assertFalse("nan" in output)
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
+
+class Interrupted(Exception):
+    pass
+
+
+class CrashingStatistics(ProfileStatistics):
+    # stands in for a crash after a given number of pairs
+    def __init__(self, crash_after):
+        super(CrashingStatistics, self).__init__()
+        self.crash_after = crash_after
+
+    def update(self, piv_results):
+        if self.count == self.crash_after:
+            raise Interrupted()
+        super(CrashingStatistics, self).update(piv_results)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.directory, 'run.pivstore')
+        self.image_paths = []
+        for i, frame in enumerate(drifting_frames(15, 1)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            Image.fromarray(np.roll(frame, i * i % 7, axis=1).astype(np.uint8)).save(image_path)
+            self.image_paths.append(image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def reference(self, image_paths):
+        store = run_batch(image_paths, 20, os.path.join(self.directory, 'reference.pivstore'))
+        return store.frames, store.displacements()
+
+    def testResume(self):
+        # An interrupted run resumes after its last completed chunk and gives the same results
+        with self.assertRaises(Interrupted):
+            run_batch(self.image_paths, 20, self.store_path, chunk_size=4, statistics=CrashingStatistics(10))
+        checkpoint = read_checkpoint(self.store_path)
+        self.assertEqual((checkpoint['n_pairs'], checkpoint['next_frame']), (8, 8))
+        self.assertFalse(checkpoint['complete'])
+        statistics = ProfileStatistics()
+        store = run_batch(self.image_paths, 20, self.store_path, chunk_size=4, statistics=statistics)
+        frames, displacements = self.reference(self.image_paths)
+        self.assertEqual(store.frames, frames)
+        self.assertTrue(np.array_equal(ResultStore(self.store_path).displacements(), displacements))
+        # the stored pairs were replayed into the statistics
+        self.assertEqual(statistics.count, 14)
+        self.assertTrue(np.allclose(statistics.mean, displacements.mean(axis=0)))
+        self.assertTrue(read_checkpoint(self.store_path)['complete'])
+        # a finished run is not repeated
+        self.assertEqual(len(run_batch(self.image_paths, 20, self.store_path, chunk_size=4)), 14)
+
+    def testResumeOtherParameters(self):
+        # Resuming with other analysis parameters fails and leaves the interrupted store as it is
+        with self.assertRaises(Interrupted):
+            run_batch(self.image_paths, 20, self.store_path, chunk_size=4, statistics=CrashingStatistics(10))
+        frames = ResultStore(self.store_path).frames
+        displacements = ResultStore(self.store_path).displacements()
+        for kwargs in ({'mode': 'phase', 'precision': 'single'}, {'division_pixel': 40},
+                       {'prefilter': PreFilter(taper='hann')}):
+            args = dict({'division_pixel': 20, 'chunk_size': 4}, **kwargs)
+            with self.assertRaises(ValueError) as context:
+                run_batch(self.image_paths, store_path=self.store_path, **args)
+            self.assertTrue(sorted(kwargs)[0] in str(context.exception))
+            store = ResultStore(self.store_path)
+            self.assertEqual(store.frames, frames)
+            self.assertTrue(np.array_equal(store.displacements(), displacements))
+        self.assertEqual(len(run_batch(self.image_paths, 20, self.store_path, chunk_size=4)), 14)
+
+    def testOtherSequence(self):
+        run_batch(self.image_paths[:5], 20, self.store_path)
+        with self.assertRaises(ValueError):
+            run_batch(self.image_paths, 20, self.store_path)
+
+    def testBadFrames(self):
+        # Unreadable and wrongly sized frames are skipped; their neighbours make a pair
+        with open(self.image_paths[3], 'wb') as f:
+            f.write(b'not an image')
+        Image.fromarray(np.zeros((100, 400), dtype=np.uint8)).save(self.image_paths[9])
+        with capture_stderr(run_batch, self.image_paths, 20, self.store_path) as output:
+            self.assertTrue("frame_003" in output)
+            self.assertTrue("frame_009" in output)
+        good_paths = [image_path for i, image_path in enumerate(self.image_paths) if i not in (3, 9)]
+        frames, displacements = self.reference(good_paths)
+        store = ResultStore(self.store_path)
+        self.assertEqual(store.frames[2], ('frame_002.bmp', 'frame_004.bmp'))
+        self.assertEqual(store.frames, frames)
+        self.assertTrue(np.array_equal(store.displacements(), displacements))
+        self.assertEqual(read_checkpoint(self.store_path)['skipped'], [self.image_paths[3], self.image_paths[9]])
+
+
+class TestRawStream(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.directory, 'raw.pivstore')
+        self.frames = [np.roll(frame, i * i % 5, axis=1) for i, frame in enumerate(drifting_frames(6, 3))]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testBuffers(self):
+        # Two buffers take turns, whatever the byte order of the pixels
+        frames = [(frame * 200).astype('>u2') for frame in self.frames]
+        stream = io.BytesIO(b''.join(frame.tobytes() for frame in frames) + b'\0' * 7)
+        with capture_stderr(list, iter_raw_frames(stream, frames[0].shape, '>u2')) as output:
+            self.assertTrue("7 of 160000 bytes" in output)
+        stream.seek(0)
+        buffers = []
+        for frame, expected in zip(iter_raw_frames(stream, frames[0].shape, '>u2'), frames):
+            self.assertTrue(np.array_equal(frame, expected))
+            buffers.append(frame)
+        self.assertIs(buffers[0], buffers[2])
+        self.assertIsNot(buffers[0], buffers[1])
+
+    def testPipe(self):
+        # Short reads from a pipe are completed
+        read_fd, write_fd = os.pipe()
+        writer = threading.Thread(target=write_slowly, args=(write_fd, self.frames[0].astype(np.uint8).tobytes()))
+        writer.start()
+        with os.fdopen(read_fd, 'rb', buffering=0) as stream:
+            frames = [frame.copy() for frame in iter_raw_frames(stream, self.frames[0].shape)]
+        writer.join()
+        self.assertEqual(len(frames), 1)
+        self.assertTrue(np.array_equal(frames[0], self.frames[0]))
+
+    def testRunStream(self):
+        stream = io.BytesIO(b''.join(frame.astype(np.uint8).tobytes() for frame in self.frames))
+        store = run_stream(stream, self.frames[0].shape, 20, self.store_path, max_pairs=4)
+        self.assertEqual(store.frames, [('frame_{:06d}'.format(i), 'frame_{:06d}'.format(i + 1)) for i in range(4)])
+        for pair in range(4):
+            expected_results = analyse_images(self.frames[pair], self.frames[pair + 1], 20)
+            self.assertTrue(np.array_equal(store.displacement(pair), expected_results[:, 1]))
+
+    def testRunStreamMode(self):
+        stream = io.BytesIO(b''.join(frame.astype(np.uint8).tobytes() for frame in self.frames))
+        store = run_stream(stream, self.frames[0].shape, 20, self.store_path, max_pairs=2, mode='zncc',
+                           prefilter=PreFilter(taper='hann'))
+        self.assertEqual(store.attrs['mode'], 'zncc')
+        self.assertEqual(store.attrs['prefilter']['taper'], 'hann')
+        for pair in range(2):
+            expected_results = analyse_images(self.frames[pair], self.frames[pair + 1], 20, backend='scipy_fft',
+                                              mode='zncc', prefilter=PreFilter(taper='hann'))
+            self.assertTrue(np.array_equal(store.displacement(pair), expected_results[:, 1]))
+
+    def testMainStdin(self):
+        height, width = self.frames[0].shape
+        process = subprocess.Popen([sys.executable, '-m', 'che696_proj_yufei.image_proc', '-r', str(width),
+                                    str(height), '-d', '20', '-o', self.store_path],
+                                   cwd=os.path.join(CURRENT_DIR, '..'), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.communicate(b''.join(frame.astype(np.uint8).tobytes() for frame in self.frames))
+        self.assertEqual(process.returncode, SUCCESS)
+        store = ResultStore(self.store_path)
+        self.assertEqual(len(store), 5)
+        self.assertTrue(np.array_equal(store.displacement(4),
+                                       analyse_images(self.frames[4], self.frames[5], 20)[:, 1]))
+
+    def testMainFile(self):
+        raw_path = os.path.join(self.directory, 'frames.raw')
+        with open(raw_path, 'wb') as f:
+            f.write(self.frames[0].astype(np.uint8).tobytes())
+        height, width = self.frames[0].shape
+        with capture_stderr(main, ["-r", str(width), str(height), "--raw_input", raw_path]) as output:
+            self.assertTrue("fewer than two" in output)
+        self.assertEqual(main(["-r", str(width), str(height), "--raw_input", "ghost.raw"]), IO_ERROR)
+
+
+def write_slowly(fd, data, n_parts=5):
+    with os.fdopen(fd, 'wb', buffering=0) as f:
+        for part in np.array_split(np.frombuffer(data, dtype=np.uint8), n_parts):
+            f.write(part.tobytes())
+            time.sleep(0.02)
+
+
+class TestMultiPage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.frames = [np.roll(frame, i * i % 5, axis=1).astype(np.uint8)
+                       for i, frame in enumerate(drifting_frames(7, 2))]
+        self.stack_path = os.path.join(self.directory, 'stack.tif')
+        pages = [Image.fromarray(frame) for frame in self.frames[:5]]
+        pages[0].save(self.stack_path, save_all=True, append_images=pages[1:])
+        self.image_paths = [self.stack_path]
+        for i, frame in enumerate(self.frames[5:]):
+            self.image_paths.append(os.path.join(self.directory, 'single_{}.bmp'.format(i)))
+            Image.fromarray(frame).save(self.image_paths[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testFrameSequence(self):
+        # Pages are loaded one at a time from the open container
+        frames = FrameSequence(self.image_paths)
+        self.assertEqual(len(frames), 7)
+        self.assertEqual(frames.name(3), os.path.join(self.directory, 'stack_p000003'))
+        self.assertEqual(frames.name(5), self.image_paths[1])
+        containers = []
+        for index in (0, 1, 4, 2, 6):
+            image, ret = frames.load(index)
+            self.assertEqual(ret, SUCCESS)
+            self.assertEqual(image.dtype, np.int32)
+            self.assertTrue(np.array_equal(image, self.frames[index]))
+            containers.append(frames._container[1])
+        # the stack is opened once for all its pages
+        self.assertTrue(all(container is containers[0] for container in containers))
+        frames.close()
+        self.assertTrue(all(np.array_equal(image, frame) for image, frame in zip(iter_frames(self.image_paths),
+                                                                                 self.frames)))
+
+    def testGif(self):
+        gif_path = os.path.join(self.directory, 'stack.gif')
+        pages = [Image.fromarray(frame) for frame in self.frames]
+        pages[0].save(gif_path, save_all=True, append_images=pages[1:])
+        loaded = list(iter_frames([gif_path]))
+        self.assertEqual(len(loaded), 7)
+        self.assertTrue(all(image.ndim == 2 for image in loaded))
+
+    def testBatch(self):
+        # A stack gives the same pairs as one file per frame
+        store = run_batch(self.image_paths, 20, os.path.join(self.directory, 'stack.pivstore'))
+        self.assertEqual(store.frames[4], ('stack_p000004', 'single_0.bmp'))
+        self.assertEqual(len(store), 6)
+        for pair in range(6):
+            expected_results = analyse_images(self.frames[pair], self.frames[pair + 1], 20)
+            self.assertTrue(np.array_equal(store.displacement(pair), expected_results[:, 1]))
+
+    def testMain(self):
+        store_path = os.path.join(self.directory, 'main.pivstore')
+        self.assertEqual(main(["-s", self.stack_path, "-d", "20", "-o", store_path]), SUCCESS)
+        self.assertEqual(len(ResultStore(store_path)), 4)
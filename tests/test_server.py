@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the analysis server and its client.
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+import numpy as np
+from che696_proj_yufei.image_proc import load_image, piv_analysis, SUCCESS, INVALID_DATA, IO_ERROR
+from che696_proj_yufei.correlation import PreFilter
+from che696_proj_yufei.server import PivService, make_server, encode_frame, decode_frame
+from che696_proj_yufei import client
+from .test_image_proc import silent_remove, capture_stdout, DISABLE_REMOVE
+
+CURRENT_DIR = os.path.dirname(__file__)
+PACKAGE_ROOT = os.path.join(CURRENT_DIR, '..')
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class TestPivService(unittest.TestCase):
+    def setUp(self):
+        self.service = PivService(max_analysers=2)
+        self.expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)
+
+    def testPaths(self):
+        response = self.service.handle({'id': 7, 'image_a': SAMPLE_DATA_FILE_LOC[0],
+                                        'image_b': SAMPLE_DATA_FILE_LOC[1]})
+        self.assertEqual((response['id'], response['status'], response['files']), (7, SUCCESS, []))
+        self.assertTrue(np.array_equal(response['displacement'], self.expected_results[:, 1]))
+        self.assertTrue(np.array_equal(response['y_position'], self.expected_results[:, 0]))
+
+    def testFrames(self):
+        frames = [load_image(image_path)[0] for image_path in SAMPLE_DATA_FILE_LOC]
+        self.assertTrue(np.array_equal(decode_frame(encode_frame(frames[0])), frames[0]))
+        response = self.service.handle({'frame_a': encode_frame(frames[0]), 'frame_b': encode_frame(frames[1])})
+        self.assertTrue(np.array_equal(response['displacement'], self.expected_results[:, 1]))
+
+    def testModes(self):
+        response = self.service.handle({'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1],
+                                        'mode': 'zncc'})
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5, mode='zncc')
+        self.assertTrue(np.array_equal(response['displacement'], expected_results[:, 1]))
+        response = self.service.handle({'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1],
+                                        'prefilter': {'highpass': 4, 'taper': 'hann'}})
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5,
+                                        prefilter=PreFilter(highpass=4, taper='hann'))
+        self.assertTrue(np.array_equal(response['displacement'], expected_results[:, 1]))
+        response = self.service.handle({'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1],
+                                        'prefilter': {'bandwidth': 4}})
+        self.assertEqual(response['status'], INVALID_DATA)
+        response = self.service.handle({'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1],
+                                        'mode': 'ghost'})
+        self.assertEqual(response['status'], INVALID_DATA)
+
+    def testErrors(self):
+        response = self.service.handle({'image_a': 'ghost.bmp', 'image_b': SAMPLE_DATA_FILE_LOC[1]})
+        self.assertEqual(response['status'], IO_ERROR)
+        self.assertTrue('ghost' in response['error'])
+        response = self.service.handle({'frame_a': encode_frame(np.zeros((20, 30))),
+                                        'frame_b': encode_frame(np.zeros((20, 31)))})
+        self.assertEqual(response['status'], INVALID_DATA)
+        self.assertEqual(self.service.handle({'op': 'reboot'})['status'], INVALID_DATA)
+
+    def testAnalyserCache(self):
+        analyser = self.service.analyser((100, 200), 5, 'double', None)
+        self.assertIs(self.service.analyser((100, 200), 5, 'double', None), analyser)
+        self.service.analyser((100, 200), 10, 'double', None)
+        self.service.analyser((100, 200), 5, 'single', None)
+        # the least recently used analyser was dropped
+        self.assertIsNot(self.service.analyser((100, 200), 5, 'double', None), analyser)
+
+    def testServeLines(self):
+        requests = [{'id': 1, 'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1]},
+                    {'id': 2, 'op': 'shutdown'}, {'id': 3, 'op': 'ping'}]
+        rfile = io.StringIO('\n'.join(json.dumps(request) for request in requests) + '\nnot json\n')
+        wfile = io.StringIO()
+        self.assertTrue(self.service.serve_lines(rfile, wfile))
+        responses = [json.loads(line) for line in wfile.getvalue().splitlines()]
+        self.assertEqual([response['id'] for response in responses], [1, 2])
+        wfile = io.StringIO()
+        self.assertFalse(self.service.serve_lines(io.StringIO('not json\n[1]\n'), wfile))
+        self.assertEqual([json.loads(line)['status'] for line in wfile.getvalue().splitlines()],
+                         [INVALID_DATA, INVALID_DATA])
+
+
+class TestSocketServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'piv.sock')
+        self.server = make_server(self.socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testClient(self):
+        expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20)
+        piv_results = client.analyse_pair(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                          socket_path=self.socket_path)
+        self.assertTrue(np.array_equal(piv_results, expected_results))
+        frames = [load_image(image_path)[0] for image_path in SAMPLE_DATA_FILE_LOC]
+        piv_results = client.analyse_frames(frames[0], frames[1], 20, socket_path=self.socket_path)
+        self.assertTrue(np.array_equal(piv_results, expected_results))
+        with self.assertRaises(ValueError):
+            client.analyse_pair('ghost.bmp', SAMPLE_DATA_FILE_LOC[1], socket_path=self.socket_path)
+        prefilter = PreFilter(highpass=4, taper='hann')
+        piv_results = client.analyse_pair(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                          socket_path=self.socket_path, prefilter=prefilter)
+        self.assertTrue(np.array_equal(piv_results, piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1],
+                                                                 20, prefilter=prefilter)))
+
+    def testClientMain(self):
+        # The client writes the same files as image_proc, through the server
+        out_names = ["piv_results_sample_im1_sample_im2.csv", "piv_results_sample_im1_sample_im2.png"]
+        test_input = ["-m"] + SAMPLE_DATA_FILE_LOC + ["--socket", self.socket_path]
+        try:
+            with capture_stdout(client.main, test_input) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.allclose(np.loadtxt(out_names[0], delimiter=','),
+                                        piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 5)))
+            self.assertTrue(os.path.isfile(out_names[1]))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+
+    def testStaleSocket(self):
+        # A second server refuses to take over a live socket
+        with self.assertRaises(OSError):
+            make_server(self.socket_path)
+
+
+class TestClientFallback(unittest.TestCase):
+    def testNoServer(self):
+        out_name = "piv_results_sample_im1_sample_im2.csv"
+        test_input = ["-m"] + SAMPLE_DATA_FILE_LOC + ["--socket", os.path.join(tempfile.gettempdir(), 'ghost.sock')]
+        try:
+            with capture_stdout(client.main, test_input) as output:
+                self.assertTrue(out_name in output)
+            self.assertTrue(os.path.isfile(out_name))
+        finally:
+            silent_remove(out_name, disable=DISABLE_REMOVE)
+            silent_remove("piv_results_sample_im1_sample_im2.png", disable=DISABLE_REMOVE)
+
+    def testFilters(self):
+        # The filter options reach the analysis in this process too
+        out_name = "piv_results_sample_im1_sample_im2.csv"
+        test_input = ["-m"] + SAMPLE_DATA_FILE_LOC + ["-d", "20", "--lowpass", "1.5", "--taper", "tukey", "--socket",
+                                                      os.path.join(tempfile.gettempdir(), 'ghost.sock')]
+        try:
+            with capture_stdout(client.main, test_input):
+                pass
+            expected_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 20,
+                                            prefilter=PreFilter(lowpass=1.5, taper='tukey'))
+            self.assertTrue(np.allclose(np.loadtxt(out_name, delimiter=','), expected_results))
+        finally:
+            silent_remove(out_name, disable=DISABLE_REMOVE)
+            silent_remove("piv_results_sample_im1_sample_im2.png", disable=DISABLE_REMOVE)
+        self.assertEqual(client.main(["-m"] + SAMPLE_DATA_FILE_LOC + ["--mode", "zncc", "--highpass", "4"]),
+                         INVALID_DATA)
+
+
+class TestStdio(unittest.TestCase):
+    def testRequests(self):
+        requests = [{'id': 'a', 'image_a': SAMPLE_DATA_FILE_LOC[0], 'image_b': SAMPLE_DATA_FILE_LOC[1],
+                     'division_pixel': 20},
+                    {'id': 'b', 'image_a': SAMPLE_DATA_FILE_LOC[1], 'image_b': SAMPLE_DATA_FILE_LOC[0],
+                     'division_pixel': 20, 'precision': 'single'}]
+        server = subprocess.Popen([sys.executable, '-m', 'che696_proj_yufei.image_proc', '--stdio'],
+                                  cwd=PACKAGE_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = server.communicate(''.join(json.dumps(request) + '\n' for request in requests).encode('utf-8'))[0]
+        self.assertEqual(server.returncode, SUCCESS)
+        responses = [json.loads(line) for line in out.decode('utf-8').splitlines()]
+        self.assertEqual([response['id'] for response in responses], ['a', 'b'])
+        self.assertTrue(np.array_equal(responses[1]['displacement'],
+                                       piv_analysis(SAMPLE_DATA_FILE_LOC[1], SAMPLE_DATA_FILE_LOC[0], 20)[:, 1]))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the streaming profile statistics.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from che696_proj_yufei.image_proc import main, SUCCESS
+from che696_proj_yufei.stats import ProfileStatistics, ShearFitSeries, fit_profiles
+
+CURRENT_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+def random_profiles(n_pairs, n_stripes=12, seed=0):
+    rng = np.random.RandomState(seed)
+    y_position = np.arange(n_stripes) * 5.0 + 2.5
+    return y_position, rng.randint(-80, 80, (n_pairs, n_stripes)).astype(float)
+
+
+def accumulate(y_position, displacements, **kwargs):
+    statistics = ProfileStatistics(**kwargs)
+    for displacement in displacements:
+        statistics.update(np.column_stack((y_position, displacement)))
+    return statistics
+
+
+class TestProfileStatistics(unittest.TestCase):
+    def testMatchesBatch(self):
+        y_position, displacements = random_profiles(200)
+        statistics = accumulate(y_position, displacements)
+        self.assertEqual(statistics.count, 200)
+        self.assertTrue(np.allclose(statistics.mean, displacements.mean(axis=0)))
+        self.assertTrue(np.allclose(statistics.variance, displacements.var(axis=0, ddof=1)))
+        self.assertTrue(np.array_equal(statistics.min, displacements.min(axis=0)))
+        self.assertTrue(np.array_equal(statistics.max, displacements.max(axis=0)))
+        # out-of-range displacements land in the edge bins
+        expected_histogram = np.array([np.bincount(np.clip(column, -64, 64).astype(int) + 64, minlength=129)
+                                       for column in displacements.T])
+        self.assertTrue(np.array_equal(statistics.histogram, expected_histogram))
+
+    def testMerge(self):
+        y_position, displacements = random_profiles(90)
+        merged = accumulate(y_position, displacements[:40])
+        merged.merge(accumulate(y_position, displacements[40:]))
+        whole = accumulate(y_position, displacements)
+        self.assertEqual(merged.count, 90)
+        self.assertTrue(np.allclose(merged.mean, whole.mean))
+        self.assertTrue(np.allclose(merged.variance, whole.variance))
+        self.assertTrue(np.array_equal(merged.histogram, whole.histogram))
+
+    def testConverged(self):
+        y_position, displacements = random_profiles(50)
+        statistics = accumulate(y_position, displacements[:1])
+        self.assertFalse(statistics.converged(100.0))
+        statistics = accumulate(y_position, displacements)
+        largest = statistics.std_error.max()
+        self.assertTrue(statistics.converged(largest))
+        self.assertFalse(statistics.converged(0.99 * largest))
+        self.assertFalse(statistics.converged(largest, min_count=51))
+        # only the stripes inside the range count
+        inside = np.argmin(statistics.std_error)
+        y_range = (y_position[inside], y_position[inside])
+        self.assertTrue(statistics.converged(statistics.std_error[inside], y_range=y_range))
+
+    def testSnapshots(self):
+        directory = tempfile.mkdtemp()
+        try:
+            base_f_name = os.path.join(directory, 'run_stats')
+            y_position, displacements = random_profiles(25)
+            accumulate(y_position, displacements, snapshot_name=base_f_name, snapshot_every=10)
+            # the last automatic snapshot was taken after 20 profiles
+            summary = np.loadtxt(base_f_name + '.csv', delimiter=',')
+            self.assertTrue(np.all(summary[:, 1] == 20))
+            self.assertTrue(np.allclose(summary[:, 2], displacements[:20].mean(axis=0)))
+            histogram = np.loadtxt(base_f_name + '_hist.csv', delimiter=',')
+            self.assertTrue(np.all(histogram[:, 1:].sum(axis=1) == 20))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestStatsMain(unittest.TestCase):
+    def testBatch(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store_path = os.path.join(directory, 'run.pivstore')
+            test_input = ["-s", SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], SAMPLE_DATA_FILE_LOC[0],
+                          "-d", "20", "-o", store_path, "--stats", "--fit"]
+            self.assertEqual(main(test_input), SUCCESS)
+            summary = np.loadtxt(os.path.join(directory, 'run_stats.csv'), delimiter=',')
+            self.assertTrue(np.all(summary[:, 1] == 2))
+            with open(os.path.join(directory, 'run_fit.csv')) as f:
+                rows = f.read().splitlines()[1:]
+            self.assertEqual([row.split(',')[1] for row in rows], ['sample_im2.bmp', 'sample_im1.bmp'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFitProfiles(unittest.TestCase):
+    def testLinear(self):
+        y_position = np.arange(2.5, 200, 5.0)
+        displacements = np.array([0.05 * y_position + 2.0, -0.02 * y_position])
+        shear_rate, intercept, residual = fit_profiles(y_position, displacements)
+        self.assertTrue(np.allclose(shear_rate, [0.05, -0.02]))
+        self.assertTrue(np.allclose(intercept, [2.0, 0.0]))
+        self.assertTrue(np.allclose(residual, 0.0))
+
+    def testMatchesPolyfit(self):
+        y_position, displacements = random_profiles(30)
+        shear_rate, intercept, residual = fit_profiles(y_position, displacements)
+        for pair in (0, 17):
+            slope, offset = np.polyfit(y_position, displacements[pair], 1)
+            self.assertAlmostEqual(shear_rate[pair], slope)
+            self.assertAlmostEqual(intercept[pair], offset)
+
+    def testRange(self):
+        # Stripes outside the range, e.g. near the walls, are ignored
+        y_position = np.arange(2.5, 100, 5.0)
+        displacement = 0.1 * y_position
+        displacement[:3] = 40
+        shear_rate, intercept, residual = fit_profiles(y_position, displacement, y_range=(20, 100))
+        self.assertAlmostEqual(shear_rate[0], 0.1)
+        self.assertAlmostEqual(residual[0], 0.0)
+
+
+class TestShearFitSeries(unittest.TestCase):
+    def testBlocks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            out_name = os.path.join(directory, 'fit.csv')
+            y_position, displacements = random_profiles(10)
+            series = ShearFitSeries(out_name, block_size=4)
+            for pair, displacement in enumerate(displacements):
+                series.update(np.column_stack((y_position, displacement)), label='f{}'.format(pair))
+            # two full blocks are written, the last two profiles wait for flush
+            self.assertEqual(len(np.atleast_2d(np.loadtxt(out_name, delimiter=',', usecols=(0, 2)))), 8)
+            series.flush()
+            rows = np.loadtxt(out_name, delimiter=',', usecols=(0, 2, 3, 4))
+            self.assertEqual(len(series), 10)
+            self.assertTrue(np.array_equal(rows[:, 0], np.arange(10)))
+            shear_rate, intercept, residual = fit_profiles(y_position, displacements)
+            self.assertTrue(np.allclose(rows[:, 1], shear_rate))
+            self.assertTrue(np.allclose(rows[:, 2], intercept))
+            self.assertTrue(np.allclose(rows[:, 3], residual))
+            with open(out_name) as f:
+                self.assertEqual([row.split(',')[1] for row in f.read().splitlines()[1:]],
+                                 ['f{}'.format(pair) for pair in range(10)])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the binary result store.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from che696_proj_yufei.store import ResultStore, encode_y_position, decode_y_position
+
+
+def y_positions(height, division_pixel):
+    # stripe centres as produced by divid_image
+    index_divid = np.arange(0, height - 1, division_pixel)
+    if index_divid[-1] != height - 1:
+        index_divid = np.append(index_divid, height - 1)
+    return (index_divid[:-1] + index_divid[1:]) / 2.0
+
+
+class TestYPosition(unittest.TestCase):
+    def testRoundTrip(self):
+        for height, division_pixel in ((1245, 5), (1245, 20), (100, 3), (20, 19)):
+            y_position = y_positions(height, division_pixel)
+            self.assertTrue(np.array_equal(y_position, decode_y_position(encode_y_position(y_position))))
+
+    def testUneven(self):
+        with self.assertRaises(ValueError):
+            encode_y_position([1.0, 2.0, 5.0, 6.0])
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'run.pivstore')
+        self.y_position = y_positions(100, 10)
+        rng = np.random.RandomState(0)
+        self.displacements = rng.randint(-20, 20, (23, self.y_position.size)).astype(float)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fill(self, store, pairs):
+        for pair in pairs:
+            store.append('f{}.bmp'.format(pair), 'f{}.bmp'.format(pair + 1), self.displacements[pair])
+
+    def testRandomAccess(self):
+        with ResultStore.create(self.path, self.y_position, chunk_size=5, attrs={'division_pixel': 10}) as store:
+            self.fill(store, range(23))
+        store = ResultStore(self.path)
+        self.assertEqual(len(store), 23)
+        self.assertEqual(store.attrs, {'division_pixel': 10})
+        self.assertEqual(store.frames[7], ('f7.bmp', 'f8.bmp'))
+        for pair in (0, 4, 5, 22, -1):
+            self.assertTrue(np.array_equal(store.displacement(pair), self.displacements[pair]))
+        self.assertEqual(store.displacement(3).dtype, np.float32)
+        self.assertTrue(np.array_equal(store.displacements(), self.displacements))
+        with self.assertRaises(IndexError):
+            store.displacement(23)
+
+    def testAppendAfterReopen(self):
+        # A partial last chunk is continued, not duplicated
+        with ResultStore.create(self.path, self.y_position, chunk_size=5) as store:
+            self.fill(store, range(12))
+        with ResultStore(self.path) as store:
+            self.fill(store, range(12, 23))
+        store = ResultStore(self.path)
+        self.assertEqual(len(store), 23)
+        self.assertTrue(np.array_equal(store.displacements(), self.displacements))
+
+    def testTruncate(self):
+        # Pairs written after a checkpoint are dropped and then rewritten
+        with ResultStore.create(self.path, self.y_position, chunk_size=5) as store:
+            self.fill(store, range(18))
+        for n_pairs in (13, 10):
+            with ResultStore(self.path) as store:
+                store.truncate(n_pairs)
+                self.assertEqual(len(store), n_pairs)
+            self.assertEqual(len(ResultStore(self.path)), n_pairs)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'chunk_000002.npy')))
+        with ResultStore(self.path) as store:
+            store.truncate(7)
+            self.fill(store, range(7, 23))
+        store = ResultStore(self.path)
+        self.assertEqual(store.frames[7], ('f7.bmp', 'f8.bmp'))
+        self.assertTrue(np.array_equal(store.displacements(), self.displacements))
+
+    def testCommaInName(self):
+        # Frame names with commas or quotes survive the index, also after a truncation
+        frames = [('run 1,2.bmp', 'run "3".bmp'), ('a,b,c.bmp', 'plain.bmp'), ('x.bmp', 'y.bmp')]
+        with ResultStore.create(self.path, self.y_position, chunk_size=2) as store:
+            for pair, (frame_a, frame_b) in enumerate(frames):
+                store.append(frame_a, frame_b, self.displacements[pair])
+        self.assertEqual(ResultStore(self.path).frames, frames)
+        with ResultStore(self.path) as store:
+            store.truncate(2)
+        self.assertEqual(ResultStore(self.path).frames, frames[:2])
+
+    def testExportCsv(self):
+        with ResultStore.create(self.path, self.y_position) as store:
+            self.fill(store, range(3))
+        out_names = ResultStore(self.path).export_csv(self.directory)
+        self.assertEqual(os.path.basename(out_names[1]), 'piv_results_f1_f2.csv')
+        results = np.loadtxt(out_names[1], delimiter=',')
+        self.assertTrue(np.array_equal(results, np.column_stack((self.y_position, self.displacements[1]))))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the 2D interrogation window analysis.
+"""
+
+import os
+import unittest
+import numpy as np
+from che696_proj_yufei.image_proc import main, piv_analysis, INVALID_DATA
+from che696_proj_yufei.windows import (extract_windows, window_grid, window_step, correlate_windows, analyse_windows,
+                                       piv_analysis_2d)
+from che696_proj_yufei.benchmark import synthetic_pair
+from .test_image_proc import silent_remove, capture_stdout, capture_stderr, DISABLE_REMOVE
+
+CURRENT_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(CURRENT_DIR, '..', 'che696_proj_yufei', 'data')
+SAMPLE_DATA_FILE_LOC = [os.path.join(DATA_DIR, 'sample_im1.bmp'), os.path.join(DATA_DIR, 'sample_im2.bmp')]
+
+
+class TestWindows(unittest.TestCase):
+    def testExtract(self):
+        # Windows are views of the image at the grid positions
+        image = np.arange(20 * 30).reshape(20, 30)
+        step = window_step((8, 10), 0.5)
+        self.assertEqual(step, (4, 5))
+        y_position, x_position = window_grid(image.shape, (8, 10), step)
+        self.assertTrue(np.array_equal(y_position, [3.5, 7.5, 11.5, 15.5]))
+        self.assertTrue(np.array_equal(x_position, [4.5, 9.5, 14.5, 19.5, 24.5]))
+        windows = extract_windows(image, (8, 10), step)
+        self.assertEqual(windows.shape, (4, 5, 8, 10))
+        self.assertTrue(np.shares_memory(windows, image))
+        self.assertTrue(np.array_equal(windows[2, 3], image[8:16, 15:25]))
+        with self.assertRaises(ValueError):
+            window_step(32, 1.0)
+        with self.assertRaises(ValueError):
+            window_grid(image.shape, 32, (16, 16))
+
+    def testTranslation(self):
+        image_a = synthetic_pair(256, 512, 0.0, 0.0)[0]
+        image_b = np.roll(np.roll(image_a, 6, axis=1), -3, axis=0)
+        for precision in ('double', 'single'):
+            u, v = correlate_windows(extract_windows(image_a, 64, (64, 64)), extract_windows(image_b, 64, (64, 64)),
+                                     precision=precision)
+            self.assertTrue(np.all(u == 6))
+            self.assertTrue(np.all(v == -3))
+        # displacements beyond max_lag are not found
+        u = correlate_windows(extract_windows(image_a, 64, (64, 64)), extract_windows(image_b, 64, (64, 64)),
+                              max_lag=4)[0]
+        self.assertTrue(np.all(u <= 4))
+
+    def testKnownShear(self):
+        # u follows slip + shear * y across the whole grid; the flow has no y component
+        image_a, image_b = synthetic_pair(256, 512, 3.0, 0.05)
+        y_position, x_position, u, v = analyse_windows(image_a, image_b, 32, 0.5, block_windows=100)
+        self.assertEqual(u.shape, (15, 31))
+        error = np.abs(u - (3.0 + 0.05 * y_position)[:, np.newaxis])
+        self.assertTrue(np.mean(error <= 1.0) > 0.99)
+        self.assertTrue(np.all(v == 0))
+        # blocks of windows give the same field as a single batch
+        self.assertTrue(np.array_equal(analyse_windows(image_a, image_b, 32, 0.5)[2], u))
+
+    def testFlatWindows(self):
+        image_a, image_b = synthetic_pair(128, 128, 0.0, 0.0)
+        image_a[:64] = 7
+        u, v = analyse_windows(image_a, image_b, 32, 0.0)[2:]
+        self.assertTrue(np.all(np.isnan(u[:2])) and np.all(np.isnan(v[:2])))
+        self.assertTrue(np.all(u[2:] == 0))
+
+    def testSampleData(self):
+        # Each row of windows of the sample pair moves like the stripes at its height
+        field_results = piv_analysis_2d(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 64, 0.5)
+        self.assertEqual(field_results.shape[1], 4)
+        piv_results = piv_analysis(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 16)
+        for y in np.unique(field_results[:, 0]):
+            row = field_results[field_results[:, 0] == y]
+            self.assertTrue(abs(np.median(row[:, 2]) - np.interp(y, piv_results[:, 0], piv_results[:, 1])) <= 1.5)
+
+
+class TestWindowsMain(unittest.TestCase):
+    def testMain(self):
+        out_names = ["piv_results_sample_im1_sample_im2_windows.csv", "piv_results_sample_im1_sample_im2_windows.png"]
+        try:
+            with capture_stdout(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["--windows", "64"]) as output:
+                self.assertTrue(out_names[0] in output)
+            self.assertTrue(np.allclose(np.loadtxt(out_names[0], delimiter=','),
+                                        piv_analysis_2d(SAMPLE_DATA_FILE_LOC[0], SAMPLE_DATA_FILE_LOC[1], 64),
+                                        equal_nan=True))
+            self.assertTrue(os.path.isfile(out_names[1]))
+        finally:
+            for out_name in out_names:
+                silent_remove(out_name, disable=DISABLE_REMOVE)
+
+    def testInvalidOverlap(self):
+        with capture_stderr(main, ["-m"] + SAMPLE_DATA_FILE_LOC + ["--windows", "64", "--overlap", "1"]) as output:
+            self.assertTrue("overlap" in output)
+        self.assertEqual(main(["-m"] + SAMPLE_DATA_FILE_LOC + ["--windows", "64", "--overlap", "1.5"]),
+                         INVALID_DATA)
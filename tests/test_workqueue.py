@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Unit and regression tests for the shared-filesystem work queue.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import numpy as np
+from PIL import Image
+from che696_proj_yufei.image_proc import main, SUCCESS, INVALID_DATA
+from che696_proj_yufei.sequence import run_batch, read_checkpoint
+from che696_proj_yufei.store import ResultStore
+from che696_proj_yufei.workqueue import (create_queue, claim_task, claim_path, merge_queue, queue_status,
+                                         run_worker)
+from .test_sequence import drifting_frames
+from .test_image_proc import capture_stderr
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.directory, 'queue')
+        self.image_paths = []
+        for i, frame in enumerate(drifting_frames(18, 1)):
+            image_path = os.path.join(self.directory, 'frame_{:03d}.bmp'.format(i))
+            Image.fromarray(np.roll(frame, i * i % 7, axis=1).astype(np.uint8)).save(image_path)
+            self.image_paths.append(image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def assertMatchesBatch(self, store_path):
+        with capture_stderr(run_batch, self.image_paths, 20, os.path.join(self.directory, 'batch.pivstore')):
+            pass
+        batch = ResultStore(os.path.join(self.directory, 'batch.pivstore'))
+        store = ResultStore(store_path)
+        self.assertEqual(store.frames, batch.frames)
+        self.assertTrue(np.array_equal(store.displacements(), batch.displacements()))
+        self.assertEqual(read_checkpoint(store_path)['skipped'],
+                         read_checkpoint(os.path.join(self.directory, 'batch.pivstore'))['skipped'])
+
+    def testWorkerProcesses(self):
+        # Several worker processes share the tasks; bad frames at and next to task boundaries
+        # give the same pairs as a single batch run
+        for i in (4, 7, 17):
+            with open(self.image_paths[i], 'wb') as f:
+                f.write(b'not an image')
+        create_queue(self.queue_dir, self.image_paths, 20, task_size=4)
+        workers = [subprocess.Popen([sys.executable, '-m', 'che696_proj_yufei.image_proc', '--work', self.queue_dir],
+                                    cwd=PACKAGE_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                   for _ in range(3)]
+        for worker in workers:
+            worker.communicate()
+            self.assertEqual(worker.returncode, SUCCESS)
+        self.assertEqual(queue_status(self.queue_dir), {'finished': 5, 'claimed': 0, 'waiting': 0})
+        store_path = os.path.join(self.directory, 'merged.pivstore')
+        merge_queue(self.queue_dir, store_path)
+        self.assertMatchesBatch(store_path)
+
+    def testStaleClaim(self):
+        create_queue(self.queue_dir, self.image_paths, 20, task_size=8)
+        self.assertEqual(claim_task(self.queue_dir, 3), 0)
+        self.assertEqual(claim_task(self.queue_dir, 3), 1)
+        # the claim of a worker that stopped refreshing it is taken over
+        old = time.time() - 1000
+        os.utime(claim_path(self.queue_dir, 0), (old, old))
+        self.assertEqual(claim_task(self.queue_dir, 3, claim_timeout=100), 0)
+        self.assertEqual(claim_task(self.queue_dir, 3, claim_timeout=100), 2)
+        self.assertIsNone(claim_task(self.queue_dir, 3, claim_timeout=100))
+        self.assertEqual(run_worker(self.queue_dir), [])
+
+    def testMergeUnfinished(self):
+        create_queue(self.queue_dir, self.image_paths, 20, task_size=8)
+        self.assertEqual(run_worker(self.queue_dir, max_tasks=2), [0, 1])
+        with self.assertRaises(ValueError):
+            merge_queue(self.queue_dir, os.path.join(self.directory, 'merged.pivstore'))
+
+    def testMultiPage(self):
+        # Pages of a stack are split between tasks like single frames
+        stack_path = os.path.join(self.directory, 'stack.tif')
+        pages = [Image.open(image_path) for image_path in self.image_paths[:10]]
+        pages[0].save(stack_path, save_all=True, append_images=pages[1:])
+        self.image_paths = [stack_path] + self.image_paths[10:]
+        create_queue(self.queue_dir, self.image_paths, 20, task_size=4)
+        self.assertEqual(run_worker(self.queue_dir), [0, 1, 2, 3, 4])
+        store_path = os.path.join(self.directory, 'merged.pivstore')
+        merge_queue(self.queue_dir, store_path)
+        self.assertMatchesBatch(store_path)
+        self.assertEqual(ResultStore(store_path).frames[9], ('stack_p000009', 'frame_010.bmp'))
+
+    def testMain(self):
+        store_path = os.path.join(self.directory, 'merged.pivstore')
+        self.assertEqual(main(["-s"] + self.image_paths + ["-d", "20", "-q", self.queue_dir, "--task_size", "5"]),
+                         SUCCESS)
+        self.assertEqual(main(["--merge", self.queue_dir, "-o", store_path]), INVALID_DATA)
+        self.assertEqual(main(["--work", self.queue_dir]), SUCCESS)
+        self.assertEqual(main(["--merge", self.queue_dir, "-o", store_path]), SUCCESS)
+        self.assertMatchesBatch(store_path)